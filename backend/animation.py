@@ -0,0 +1,226 @@
+"""
+Background removal for animated and multi-page images.
+
+Animated GIF, WebP and PNG uploads and multi-page TIFFs are processed frame
+by frame and returned as an animated PNG, or an animated WebP when WebP
+output is requested. Frames that barely differ from the last one that went
+through the model reuse its mask, so a mostly static animation costs a
+handful of inferences. The frames that do need the model are submitted
+together, letting the micro-batcher run them as batches.
+"""
+
+import io
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps, ImageSequence
+
+import config
+import tiling
+from matting import refine_edges
+from postprocess import apply_alpha, cover_rows, resize_mask
+from processing import (
+    MASK_THRESHOLD, ImageTooLargeError, MemoryLimitError, ProcessingOptions, load_background,
+    model_input, normalize_mode, prepare_image, refine_mask,
+)
+
+# Side of the grayscale thumbnails consecutive frames are compared on
+COMPARE_SIZE = 64
+
+# Frame duration in milliseconds when the file does not give one
+DEFAULT_FRAME_DURATION = 100
+
+# Peak memory per pixel over all frames: the decoded RGBA frames, their
+# cutouts and the encoder's buffers are all held at once
+ANIMATION_BYTES_PER_PIXEL = 16
+
+
+class TooManyFramesError(ImageTooLargeError):
+    """The animation has more frames, or pixels over all frames, than allowed"""
+
+
+def frame_count(file_content: bytes) -> int:
+    """Number of frames (or pages) in an image, 1 for still images"""
+    img = Image.open(io.BytesIO(file_content))
+    return getattr(img, 'n_frames', 1)
+
+
+def prepare_upload(file_content: bytes, options: ProcessingOptions):
+    """prepare_animation for multi-frame cutouts and masks, prepare_image otherwise.
+
+    Bounding boxes are computed on the first frame.
+    """
+    if options.mode != 'bbox' and frame_count(file_content) > 1:
+        return prepare_animation(file_content, options)
+    return prepare_image(file_content, options)
+
+
+@dataclass
+class PreparedAnimation:
+    frames: List[Image.Image]  # decoded, normalized frames
+    durations: List[int]  # display time of each frame in milliseconds
+    loop: int  # 0 loops forever
+    # Index of the frame whose mask each frame uses
+    mask_sources: List[int]
+    # Model inputs of the frames that run through the model, by frame index
+    model_inputs: Dict[int, object]
+    full_size: Tuple[int, int]
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    @property
+    def keyframes(self) -> List[int]:
+        return sorted(self.model_inputs)
+
+
+def frame_thumbnail(frame: Image.Image) -> np.ndarray:
+    """Small grayscale copy of a frame, for cheap comparisons between frames"""
+    small = frame.convert('L').resize((COMPARE_SIZE, COMPARE_SIZE), Image.Resampling.BILINEAR)
+    return np.asarray(small, dtype=np.float32)
+
+
+def prepare_animation(file_content: bytes, options: ProcessingOptions) -> PreparedAnimation:
+    """Decode every frame and pick the ones that need the model"""
+    start_time = time.time()
+    img = Image.open(io.BytesIO(file_content))
+    n_frames = getattr(img, 'n_frames', 1)
+    if n_frames > config.MAX_ANIMATION_FRAMES:
+        raise TooManyFramesError(
+            f"Image has {n_frames} frames, the limit is {config.MAX_ANIMATION_FRAMES}"
+        )
+    if n_frames * img.width * img.height > config.MAX_IMAGE_PIXELS:
+        raise TooManyFramesError(
+            f"Image is {n_frames * img.width * img.height / 1e6:.0f} megapixels over {n_frames} "
+            f"frames, the limit is {config.MAX_IMAGE_PIXELS / 1e6:.0f} megapixels"
+        )
+    pixels = n_frames * img.width * img.height
+    needed = tiling.BASE_REQUEST_BYTES + pixels * ANIMATION_BYTES_PER_PIXEL
+    if config.MAX_REQUEST_MEMORY_BYTES and needed > config.MAX_REQUEST_MEMORY_BYTES:
+        raise MemoryLimitError(
+            f"Processing {n_frames} frames of {img.width}x{img.height} needs more than the "
+            f"{config.MAX_REQUEST_MEMORY_BYTES / 1024 ** 2:.0f}MB allowed per request"
+        )
+
+    frames = []
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        durations.append(int(frame.info.get('duration') or DEFAULT_FRAME_DURATION))
+        frame = normalize_mode(ImageOps.exif_transpose(frame.copy()))
+        frames.append(frame.convert('RGBA') if frame.mode != 'RGBA' else frame)
+    loop = int(img.info.get('loop', 0))
+    decode_time = time.time() - start_time
+
+    # Compare each frame with the last keyframe rather than its predecessor,
+    # so slow drift still gets a fresh mask eventually
+    mask_sources = []
+    model_inputs = {}
+    keyframe_thumbnail = None
+    for index, frame in enumerate(frames):
+        thumbnail = frame_thumbnail(frame)
+        reuse = (
+            keyframe_thumbnail is not None
+            and config.FRAME_REUSE_THRESHOLD > 0
+            and frame.size == frames[mask_sources[-1]].size
+            and float(np.abs(thumbnail - keyframe_thumbnail).mean()) < config.FRAME_REUSE_THRESHOLD
+        )
+        if reuse:
+            mask_sources.append(mask_sources[-1])
+            continue
+        keyframe_thumbnail = thumbnail
+        mask_sources.append(index)
+        tensor = model_input(frame, options.model)
+        model_inputs[index] = tensor if tensor is not None else frame
+
+    return PreparedAnimation(
+        frames=frames,
+        durations=durations,
+        loop=loop,
+        mask_sources=mask_sources,
+        model_inputs=model_inputs,
+        full_size=frames[0].size,
+        timings={'decode': decode_time, 'preprocess': time.time() - start_time - decode_time},
+    )
+
+
+def encode_animation(frames: List[Image.Image], durations: List[int], loop: int,
+                     options: ProcessingOptions, png_compression: int) -> Tuple[bytes, str]:
+    """Encode RGBA frames as animated WebP for WebP output, APNG otherwise"""
+    bio = io.BytesIO()
+    if options.output_format in ('webp', 'webp-lossless', 'avif'):
+        # Pillow cannot write animated AVIF; WebP is the closest match
+        lossless = options.output_format == 'webp-lossless'
+        quality = options.quality if options.quality is not None else 80
+        frames[0].save(
+            bio, 'WEBP', save_all=True, append_images=frames[1:], duration=durations,
+            loop=loop, lossless=lossless, quality=quality, alpha_quality=100, method=4,
+        )
+        return bio.getvalue(), 'image/webp'
+    # Each frame replaces the previous one entirely, transparency included
+    frames[0].save(
+        bio, 'PNG', save_all=True, append_images=frames[1:], duration=durations,
+        loop=loop, disposal=1, blend=0, compress_level=png_compression,
+    )
+    return bio.getvalue(), 'image/png'
+
+
+def finish_animation(prepared: PreparedAnimation, preds: Dict[int, np.ndarray],
+                     options: ProcessingOptions, background: Optional[bytes] = None):
+    """Cut out every frame with its (possibly reused) mask and encode the animation.
+
+    preds holds the predicted 0..1 mask of every keyframe. Returns
+    (data, media_type, timings).
+    """
+    start_time = time.time()
+    under = load_background(background, options)
+    masks = {}
+    cutouts = []
+    for frame, source in zip(prepared.frames, prepared.mask_sources):
+        width, height = frame.size
+        if source not in masks:
+            masks[source] = resize_mask(preds[source], np.empty((height, width), dtype=np.uint8))
+            if options.edge_refine == 'off':
+                refine_mask(masks[source], options)
+        pixels = np.asarray(frame)
+        if options.edge_refine == 'off':
+            mask = np.minimum(masks[source], pixels[..., 3])
+        else:
+            # Edges are refined against each frame's own pixels
+            mask = masks[source].copy()
+            pixels = refine_edges(mask, pixels, options.edge_refine)
+            np.minimum(refine_mask(mask, options), pixels[..., 3], out=mask)
+        if options.mode == 'mask':
+            cutouts.append(Image.fromarray(mask))
+            continue
+        if under is None:
+            cutout = apply_alpha(pixels, mask, np.empty((height, width, 4), dtype=np.uint8))
+        else:
+            if isinstance(under, Image.Image):
+                under = cover_rows(under, frame.size, 0, height)
+            cutout = apply_alpha(pixels, mask, np.empty((height, width, 3), dtype=np.uint8), under)
+        cutouts.append(Image.fromarray(cutout))
+    timings = {'composite' if options.mode == 'cutout' else 'postprocess': time.time() - start_time}
+
+    png_compression = options.png_compression
+    if png_compression is None:
+        png_compression = config.PNG_COMPRESS_LEVEL
+    start_time = time.time()
+    if options.mode == 'mask':
+        if options.mask_bits == 1:
+            # 1-bit frames, as encode_mask writes still masks
+            cutouts = [
+                mask.point(lambda value: 255 if value >= MASK_THRESHOLD else 0, mode='1')
+                for mask in cutouts
+            ]
+        bio = io.BytesIO()
+        cutouts[0].save(
+            bio, 'PNG', save_all=True, append_images=cutouts[1:], duration=prepared.durations,
+            loop=prepared.loop, compress_level=png_compression,
+        )
+        data, media_type = bio.getvalue(), 'image/png'
+    else:
+        data, media_type = encode_animation(
+            cutouts, prepared.durations, prepared.loop, options, png_compression
+        )
+    timings['encode'] = time.time() - start_time
+    return data, media_type, timings
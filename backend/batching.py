@@ -0,0 +1,106 @@
+"""
+Dynamic micro-batching of model inference.
+
+Concurrent requests for the same model are held for a few milliseconds and
+then run through the ONNX session as one batch, which costs far less than the
+same number of single-image runs. A batch is dispatched as soon as it is full
+or its oldest request has waited max_wait_ms, whichever comes first.
+"""
+
+import asyncio
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+from processing import predict_batch
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class BatchStats:
+    batch_size: int  # number of images run together with this one
+    batch_wait: float  # seconds spent waiting for the batch to fill
+
+
+@dataclass
+class _PendingItem:
+    model_input: object
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.time)
+
+
+class MicroBatcher:
+    """Collects model inputs per model and runs them as batches on the executor"""
+
+    def __init__(self, executor, max_batch_size: int = 8, max_wait_ms: float = 10):
+        self.executor = executor
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self._pending: Dict[str, List[_PendingItem]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        # Batch size -> number of batches dispatched with that size
+        self.histogram = Counter()
+
+    async def predict(self, model_name: str, model_input):
+        """Queue one model input and wait for its mask.
+
+        Returns (mask, ExecutionStats, BatchStats).
+        """
+        loop = asyncio.get_running_loop()
+        item = _PendingItem(model_input=model_input, future=loop.create_future())
+        pending = self._pending.setdefault(model_name, [])
+        pending.append(item)
+
+        if len(pending) >= self.max_batch_size:
+            self._flush(model_name)
+        elif len(pending) == 1:
+            self._timers[model_name] = loop.call_later(
+                self.max_wait, self._flush, model_name
+            )
+
+        return await item.future
+
+    def _flush(self, model_name: str):
+        timer = self._timers.pop(model_name, None)
+        if timer is not None:
+            timer.cancel()
+        items = self._pending.pop(model_name, [])
+        if items:
+            asyncio.ensure_future(self._run_batch(model_name, items))
+
+    async def _run_batch(self, model_name: str, items: List[_PendingItem]):
+        dispatched_at = time.time()
+        self.histogram[len(items)] += 1
+        try:
+            masks, stats = await self.executor.run(
+                predict_batch, model_name, [item.model_input for item in items]
+            )
+        except Exception as e:
+            # QueueFullError included: every request in the batch gets it
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(e)
+            return
+
+        for item, mask in zip(items, masks):
+            if not item.future.done():
+                batch_stats = BatchStats(
+                    batch_size=len(items),
+                    batch_wait=dispatched_at - item.enqueued_at,
+                )
+                item.future.set_result((mask, stats, batch_stats))
+
+    def describe(self) -> dict:
+        batches = sum(self.histogram.values())
+        images = sum(size * count for size, count in self.histogram.items())
+        return {
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batches": batches,
+            "images": images,
+            "mean_batch_size": images / batches if batches else 0.0,
+            "histogram": {str(size): count for size, count in sorted(self.histogram.items())},
+        }
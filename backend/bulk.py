@@ -0,0 +1,277 @@
+"""
+Bulk background removal.
+
+Processes many images from one request concurrently through the shared
+pipeline and streams the results back as a zip archive, writing each result
+as soon as it is ready. A manifest.json with per-file timings and errors is
+the last entry, so one bad image never fails the whole batch.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+import zlib
+from typing import AsyncIterator, List, Tuple, Union
+
+from PIL import UnidentifiedImageError
+
+from encoding import file_extension
+from inference import QueueFullError
+from pipeline import BackgroundRemovalPipeline
+from processing import ProcessingOptions
+from uploads import CHUNK_SIZE, InvalidImageError, check_image_content
+
+logger = logging.getLogger(__name__)
+
+# Times a file is retried when the inference queue is full
+QUEUE_FULL_RETRIES = 3
+
+ZIP_MAGIC = b'PK\x03\x04'
+
+
+class BulkInputError(ValueError):
+    """The bulk request itself is unusable (too many files, bad archive...)"""
+
+
+def is_zip(file_content: bytes) -> bool:
+    return file_content[:4] == ZIP_MAGIC
+
+
+class ZipEntries:
+    """The image entries of an uploaded zip archive, read one at a time.
+
+    Directories, macOS resource forks and hidden files are skipped. Only the
+    listing is read up front; each entry is decompressed when its turn comes,
+    so only the images in flight are held in memory. Declared sizes are
+    checked first but not trusted: entries are read through a byte counter
+    that stops at max_file_size, and together may inflate to at most
+    max_total_size, so a zip bomb is rejected without being inflated.
+    """
+
+    def __init__(self, file_content: bytes, max_files: int, max_file_size: int,
+                 max_total_size: int):
+        self.max_file_size = max_file_size
+        self.max_total_size = max_total_size
+        try:
+            self._archive = zipfile.ZipFile(io.BytesIO(file_content))
+        except zipfile.BadZipFile:
+            raise BulkInputError("Uploaded archive is not a valid zip file")
+
+        self._infos = [
+            info for info in self._archive.infolist()
+            if not info.is_dir()
+            and not info.filename.startswith('__MACOSX/')
+            and not os.path.basename(info.filename).startswith('.')
+        ]
+        if len(self._infos) > max_files:
+            self._archive.close()
+            raise BulkInputError(f"Archive contains {len(self._infos)} files, the limit is {max_files}")
+        # Entries declared over max_file_size are never read, so do not count
+        declared = sum(info.file_size for info in self._infos if info.file_size <= max_file_size)
+        if declared > max_total_size:
+            self._archive.close()
+            raise BulkInputError(
+                f"Archive inflates to {declared // (1024 * 1024)}MB, "
+                f"the limit is {max_total_size // (1024 * 1024)}MB"
+            )
+        # Entries are read from worker threads, one at a time
+        self._lock = threading.Lock()
+        self._total_read = 0
+
+    def __len__(self) -> int:
+        return len(self._infos)
+
+    @property
+    def names(self) -> List[str]:
+        return [info.filename for info in self._infos]
+
+    def read(self, index: int) -> bytes:
+        info = self._infos[index]
+        size_error = BulkInputError(f"File size exceeds {self.max_file_size // (1024 * 1024)}MB limit")
+        if info.file_size > self.max_file_size:
+            raise size_error
+        chunks = []
+        size = 0
+        with self._lock:
+            try:
+                with self._archive.open(info) as entry:
+                    while True:
+                        chunk = entry.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                        if size > self.max_file_size:
+                            raise size_error
+                        if self._total_read + size > self.max_total_size:
+                            raise BulkInputError(
+                                f"Archive exceeds the {self.max_total_size // (1024 * 1024)}MB "
+                                f"uncompressed limit"
+                            )
+                        chunks.append(chunk)
+            except (zipfile.BadZipFile, EOFError, OSError, zlib.error,
+                    RuntimeError, NotImplementedError) as e:
+                # Corrupt, encrypted or unsupported compression
+                raise BulkInputError(f"Could not read {info.filename} from the archive: {e}")
+            self._total_read += size
+        return b''.join(chunks)
+
+    def close(self):
+        self._archive.close()
+
+
+class UploadedFiles:
+    """The files of a multi-file bulk upload, read like ZipEntries"""
+
+    def __init__(self, files: List[Tuple[str, bytes]]):
+        self._files = files
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self._files]
+
+    def read(self, index: int) -> bytes:
+        return self._files[index][1]
+
+    def close(self):
+        self._files = []
+
+
+# Whatever stream_bulk_zip reads its images from
+BulkSource = Union[ZipEntries, UploadedFiles]
+
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """Write-only, unseekable sink that zipfile writes into and we drain"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def output_name(name: str, used: set, extension: str) -> str:
+    stem = os.path.splitext(os.path.basename(name))[0] or 'image'
+    candidate = f"{stem}.{extension}"
+    counter = 1
+    while candidate in used:
+        candidate = f"{stem}_{counter}.{extension}"
+        counter += 1
+    used.add(candidate)
+    return candidate
+
+
+async def _process_one(pipeline: BackgroundRemovalPipeline, semaphore: asyncio.Semaphore,
+                       source: BulkSource, index: int, name: str, options: ProcessingOptions,
+                       max_file_size: int):
+    entry = {"file": name, "success": False, "original_size": None}
+    start_time = time.time()
+    async with semaphore:
+        try:
+            # Read only once its turn comes, so only the images in flight are in memory
+            file_content = await asyncio.to_thread(source.read, index)
+            entry["original_size"] = len(file_content)
+            if len(file_content) > max_file_size:
+                raise BulkInputError(f"File size exceeds {max_file_size // (1024 * 1024)}MB limit")
+            # The same magic-byte and header checks single uploads get
+            check_image_content(file_content)
+
+            for attempt in range(QUEUE_FULL_RETRIES + 1):
+                try:
+                    result = await pipeline.run(file_content, options)
+                    break
+                except QueueFullError as e:
+                    if attempt == QUEUE_FULL_RETRIES:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+
+            entry.update({
+                "success": True,
+                "processed_size": len(result.data),
+                "processing_time": result.stats.run_time,
+                "queue_wait_time": result.stats.wait_time,
+                "cache_hit": result.cache_hit,
+            })
+            data = (result.data, result.media_type)
+        except UnidentifiedImageError:
+            entry["error"] = "Not a valid image"
+            data = None
+        except (BulkInputError, InvalidImageError) as e:
+            entry["error"] = str(e)
+            data = None
+        except Exception as e:
+            logger.warning(f"Bulk item {name} failed: {e}")
+            entry["error"] = str(e)
+            data = None
+    entry["elapsed"] = time.time() - start_time
+    return index, entry, data
+
+
+async def stream_bulk_zip(pipeline: BackgroundRemovalPipeline, source: BulkSource,
+                          options: ProcessingOptions, concurrency: int,
+                          max_file_size: int) -> AsyncIterator[bytes]:
+    """Process the source's images concurrently and yield a zip archive as results arrive.
+
+    Closes source when done.
+    """
+    start_time = time.time()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    tasks = [
+        asyncio.ensure_future(
+            _process_one(pipeline, semaphore, source, index, name, options, max_file_size)
+        )
+        for index, name in enumerate(source.names)
+    ]
+
+    sink = _ZipStreamBuffer()
+    archive = zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED)
+    manifest = [None] * len(tasks)
+    used_names = {'manifest.json'}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            index, entry, data = await next_done
+            if data is not None:
+                output_data, media_type = data
+                entry["output"] = output_name(entry["file"], used_names, file_extension(media_type))
+                # Encoded images are already compressed, storing avoids a second pass
+                archive.writestr(entry["output"], output_data)
+            manifest[index] = entry
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+
+        succeeded = sum(1 for entry in manifest if entry["success"])
+        summary = {
+            "total": len(manifest),
+            "succeeded": succeeded,
+            "failed": len(manifest) - succeeded,
+            "elapsed": time.time() - start_time,
+            "files": manifest,
+        }
+        archive.writestr('manifest.json', json.dumps(summary, indent=2),
+                         compress_type=zipfile.ZIP_DEFLATED)
+        archive.close()
+        yield sink.drain()
+    finally:
+        # Client went away: stop the remaining work
+        for task in tasks:
+            task.cancel()
+        source.close()
@@ -0,0 +1,230 @@
+"""
+Content-addressed cache of processed images.
+
+Results are keyed by a hash of the uploaded bytes plus the model and the
+processing options, so re-submitting the same image returns the stored result
+without decoding or running the model again.
+
+Two tiers:
+    memory  LRU bounded by a byte budget
+    disk    optional directory bounded by total size, least recently used
+            files are removed first; gunicorn workers share the directory
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedResult:
+    data: bytes
+    media_type: str
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+
+def cache_key(file_content: bytes, params: dict) -> str:
+    """Hash of the upload and every parameter that affects the output"""
+    digest = hashlib.sha256(file_content)
+    digest.update(json.dumps(params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class MemoryTier:
+    """LRU of results bounded by the total size of their data"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: 'OrderedDict[str, CachedResult]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CachedResult):
+        # An entry that would take most of the budget just evicts everything
+        if entry.size > self.max_bytes // 2:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old.size
+        self._entries[key] = entry
+        self.current_bytes += entry.size
+        while self.current_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.size
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskTier:
+    """Directory of results bounded by total file size.
+
+    Each file holds the media type on its first line followed by the data.
+    Every worker process keeps its own index of the directory, which misses
+    the files other workers write. So the index is rebuilt from the directory
+    before evicting, and whenever this process has written RESCAN_FRACTION of
+    the limit since the last rebuild: with N workers the directory exceeds
+    the limit by at most N * max_bytes / RESCAN_FRACTION between rebuilds.
+    """
+
+    RESCAN_FRACTION = 10
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries: 'OrderedDict[str, int]' = OrderedDict()
+        self._written_since_scan = 0
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        # Rebuild the LRU order from modification times (bumped on every hit),
+        # including files written by other workers
+        self._entries.clear()
+        self.current_bytes = 0
+        self._written_since_scan = 0
+        found = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    # Evicted by another worker while walking
+                    continue
+                found.append((stat.st_mtime, name, stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self.current_bytes += size
+        self._evict()
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        # Not indexed may still mean written by another worker
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                media_type = f.readline().decode('ascii').strip()
+                data = f.read()
+                size = f.tell()
+            os.utime(path)
+        except OSError:
+            self._forget(key)
+            return None
+        if key not in self._entries:
+            self._entries[key] = size
+            self.current_bytes += size
+        self._entries.move_to_end(key)
+        return CachedResult(data=data, media_type=media_type)
+
+    def put(self, key: str, entry: CachedResult):
+        if entry.size > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(entry.media_type.encode('ascii') + b'\n')
+            f.write(entry.data)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        self._forget(key, remove=False)
+        self._entries[key] = size
+        self.current_bytes += size
+        self._written_since_scan += size
+        if (self.current_bytes > self.max_bytes
+                or self._written_since_scan * self.RESCAN_FRACTION >= self.max_bytes):
+            self._load_index()
+
+    def _forget(self, key: str, remove: bool = True):
+        size = self._entries.pop(key, None)
+        if size is not None:
+            self.current_bytes -= size
+        if remove:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._forget(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResultCache:
+    """Memory tier in front of an optional disk tier.
+
+    Methods block on disk I/O and hashing, so call them off the event loop.
+    """
+
+    def __init__(self, memory_bytes: int, disk_dir: str = '', disk_bytes: int = 0):
+        self.memory = MemoryTier(memory_bytes) if memory_bytes > 0 else None
+        self.disk = DiskTier(disk_dir, disk_bytes) if disk_dir and disk_bytes > 0 else None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.memory is not None or self.disk is not None
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        with self._lock:
+            entry = self.memory.get(key) if self.memory is not None else None
+            if entry is None and self.disk is not None:
+                entry = self.disk.get(key)
+                # Promote disk hits so the next one is served from memory
+                if entry is not None and self.memory is not None:
+                    self.memory.put(key, entry)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: CachedResult):
+        with self._lock:
+            if self.memory is not None:
+                self.memory.put(key, entry)
+            if self.disk is not None:
+                try:
+                    self.disk.put(key, entry)
+                except OSError as e:
+                    logger.warning(f"Could not write cache entry to disk: {e}")
+
+    def describe(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "memory_entries": len(self.memory) if self.memory is not None else 0,
+            "memory_bytes": self.memory.current_bytes if self.memory is not None else 0,
+            "disk_entries": len(self.disk) if self.disk is not None else 0,
+            "disk_bytes": self.disk.current_bytes if self.disk is not None else 0,
+        }
@@ -0,0 +1,174 @@
+"""
+Runtime configuration for the background removal backend.
+
+Every setting is read from the environment (see backend/.env) so the same
+image can be tuned per deployment without a rebuild.
+"""
+
+import os
+
+
+def _env_list(name, default):
+    """Read a comma separated environment variable into a list of strings"""
+    value = os.environ.get(name, default)
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+# Model used when a request does not ask for a specific one
+DEFAULT_MODEL = os.environ.get('REMBG_DEFAULT_MODEL', 'u2net')
+
+# Models loaded into the session registry at startup
+PRELOAD_MODELS = _env_list('REMBG_PRELOAD_MODELS', DEFAULT_MODEL)
+
+# Models a request may ask for with ?model=. The default is always allowed.
+ALLOWED_MODELS = list(dict.fromkeys([DEFAULT_MODEL] + _env_list('REMBG_ALLOWED_MODELS', DEFAULT_MODEL)))
+
+# ONNX Runtime execution providers, in priority order. Empty lets rembg pick.
+ONNX_PROVIDERS = _env_list('ONNX_PROVIDERS', '')
+
+# Directory of the quantized and optimized model variants written by
+# optimize_models.py. A variant is requested as "<model>:<variant>", e.g.
+# u2net:int8, wherever a model name is accepted.
+MODEL_VARIANTS_DIR = os.environ.get(
+    'MODEL_VARIANTS_DIR',
+    os.path.join(os.path.expanduser(os.environ.get('U2NET_HOME', os.path.join('~', '.u2net'))), 'variants'),
+)
+
+# Create the preloaded sessions before the server forks its workers (gunicorn
+# --preload), so N workers hold one copy of the weights. Only done when the
+# sessions are fork safe: ORT_INTRA_OP_THREADS=1 on the CPU provider.
+SHARE_MODEL_WEIGHTS = os.environ.get('SHARE_MODEL_WEIGHTS', '1') == '1'
+
+# ONNX Runtime session options. Thread counts of 0 let ONNX Runtime decide
+# (one intra-op thread per core); with several inference workers per process
+# a lower intra-op count avoids oversubscribing the CPU.
+ORT_INTRA_OP_THREADS = int(os.environ.get('ORT_INTRA_OP_THREADS', '0'))
+ORT_INTER_OP_THREADS = int(os.environ.get('ORT_INTER_OP_THREADS', '0'))
+# Graph optimization level: disabled, basic, extended or all
+ORT_GRAPH_OPTIMIZATION = os.environ.get('ORT_GRAPH_OPTIMIZATION', 'all')
+# Execution mode: sequential or parallel (inter-op parallelism)
+ORT_EXECUTION_MODE = os.environ.get('ORT_EXECUTION_MODE', 'sequential')
+
+# Inference executor: "thread" or "process" pool running model inference
+INFERENCE_EXECUTOR = os.environ.get('INFERENCE_EXECUTOR', 'thread')
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', '2'))
+
+# Image sizes (WIDTHxHEIGHT) run through the pipeline for every preloaded
+# model before the server reports ready on /api/ready. Empty skips warm-up.
+WARMUP_IMAGE_SIZES = _env_list('WARMUP_IMAGE_SIZES', '512x512,1920x1080')
+
+# Requests allowed to wait for a free worker before new ones get a 503
+INFERENCE_QUEUE_SIZE = int(os.environ.get('INFERENCE_QUEUE_SIZE', '16'))
+
+# Micro-batching: concurrent requests for the same model are collected for up
+# to BATCH_MAX_WAIT_MS or BATCH_MAX_SIZE images and run as one ONNX call.
+# BATCH_MAX_SIZE=1 disables batching.
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', '8'))
+BATCH_MAX_WAIT_MS = float(os.environ.get('BATCH_MAX_WAIT_MS', '10'))
+
+# Result cache: in-memory LRU byte budget (0 disables it) and an optional
+# on-disk tier, enabled by setting RESULT_CACHE_DIR
+RESULT_CACHE_MEMORY_BYTES = int(os.environ.get('RESULT_CACHE_MEMORY_BYTES', str(64 * 1024 * 1024)))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_BYTES = int(os.environ.get('RESULT_CACHE_DISK_BYTES', str(1024 * 1024 * 1024)))
+
+# Largest accepted upload
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', str(20 * 1024 * 1024)))
+
+# Largest background image uploaded alongside an image. Endpoints taking one
+# accept bodies up to MAX_FILE_SIZE plus this; the default keeps that total
+# under nginx's 25MB cap.
+MAX_BACKGROUND_SIZE = int(os.environ.get('MAX_BACKGROUND_SIZE', str(4 * 1024 * 1024)))
+
+# Bulk endpoint: most images per request and how many are processed at once
+BULK_MAX_FILES = int(os.environ.get('BULK_MAX_FILES', '100'))
+BULK_CONCURRENCY = int(os.environ.get('BULK_CONCURRENCY', '8'))
+
+# Most bytes the entries of one bulk zip archive may inflate to altogether;
+# entries are decompressed one at a time as their turn comes
+BULK_MAX_UNCOMPRESSED_SIZE = int(os.environ.get('BULK_MAX_UNCOMPRESSED_SIZE', str(512 * 1024 * 1024)))
+
+# Object storage (S3, or a compatible store such as MinIO) for
+# /api/storage/remove-background: the buckets requests may read from and
+# write to (empty disables the endpoint), the endpoint URL of a non-AWS store,
+# and region and credentials (boto3's own configuration chain when unset)
+S3_BUCKETS = _env_list('S3_BUCKETS', '')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL', '')
+S3_REGION = os.environ.get('S3_REGION', '')
+S3_ACCESS_KEY_ID = os.environ.get('S3_ACCESS_KEY_ID', '')
+S3_SECRET_ACCESS_KEY = os.environ.get('S3_SECRET_ACCESS_KEY', '')
+# Connections in each worker's pooled S3 client, objects of one request
+# fetched, processed and written back at once, and most objects per request
+S3_MAX_POOL_CONNECTIONS = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '32'))
+STORAGE_CONCURRENCY = int(os.environ.get('STORAGE_CONCURRENCY', '8'))
+STORAGE_MAX_OBJECTS = int(os.environ.get('STORAGE_MAX_OBJECTS', '1000'))
+
+# Asynchronous jobs: "memory" keeps them in this process, "mongo" shares them
+# between workers through MongoDB. Results expire after JOB_RESULT_TTL seconds.
+# "memory" cannot serve several workers: the server refuses to start with
+# WEB_CONCURRENCY above 1, and the entrypoint defaults to one worker with it.
+JOB_BACKEND = os.environ.get('JOB_BACKEND', 'memory')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '2'))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '100'))
+JOB_RESULT_TTL = int(os.environ.get('JOB_RESULT_TTL', '3600'))
+
+# Predict masks on a reduced decode no larger than this on its longest side
+# and upsample them onto the full image. 0 predicts at full resolution.
+MAX_INFERENCE_SIDE = int(os.environ.get('MAX_INFERENCE_SIDE', '0'))
+
+# Largest image accepted, in pixels, checked from the header before decoding
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', str(150_000_000)))
+
+# Animated and multi-page uploads: most frames accepted, and the mean
+# difference (0-255) below which a frame reuses the mask of the last frame
+# that went through the model (0 runs every frame)
+MAX_ANIMATION_FRAMES = int(os.environ.get('MAX_ANIMATION_FRAMES', '300'))
+FRAME_REUSE_THRESHOLD = float(os.environ.get('FRAME_REUSE_THRESHOLD', '2.0'))
+
+# Frame sequences (zip or tar archives of video frames): most frames per
+# request and how many are in flight at once, the weight (0-1) of the previous
+# keyframe's mask when consecutive masks are smoothed over time (0 disables
+# smoothing), and the mean difference (0-255) from the last keyframe from
+# which a frame counts as a scene cut and is not smoothed. Masks are reused as
+# for animations, by FRAME_REUSE_THRESHOLD.
+SEQUENCE_MAX_FRAMES = int(os.environ.get('SEQUENCE_MAX_FRAMES', '10000'))
+SEQUENCE_CONCURRENCY = int(os.environ.get('SEQUENCE_CONCURRENCY', '8'))
+SEQUENCE_TEMPORAL_SMOOTHING = float(os.environ.get('SEQUENCE_TEMPORAL_SMOOTHING', '0.4'))
+SEQUENCE_SCENE_CUT_THRESHOLD = float(os.environ.get('SEQUENCE_SCENE_CUT_THRESHOLD', '30.0'))
+
+# Memory one request may use, estimated from the image header. Larger cutouts
+# and masks are applied and PNG-encoded in strips of rows; images that do not
+# fit even that way get a 413. 0 disables the limit.
+MAX_REQUEST_MEMORY_BYTES = int(os.environ.get('MAX_REQUEST_MEMORY_BYTES', str(1024 * 1024 * 1024)))
+
+# Bytes of post-processing buffers each process keeps for reuse by later
+# requests (0 allocates fresh buffers every time)
+POSTPROCESS_POOL_BYTES = int(os.environ.get('POSTPROCESS_POOL_BYTES', str(128 * 1024 * 1024)))
+
+# Most pixels of the uncertain band around the subject's outline that
+# closed-form matting (edge_refine=matting) solves at full resolution; larger
+# bands are matted at reduced scale. The solver needs about 3KB per pixel.
+MATTING_MAX_PIXELS = int(os.environ.get('MATTING_MAX_PIXELS', str(150_000)))
+
+# Largest request body for the bulk endpoint (single-image endpoints allow
+# MAX_FILE_SIZE plus multipart overhead)
+BULK_MAX_UPLOAD_SIZE = int(os.environ.get('BULK_MAX_UPLOAD_SIZE', str(100 * 1024 * 1024)))
+
+# Largest request body for the sequence endpoint; the archive is spooled to
+# disk, not held in memory
+SEQUENCE_MAX_UPLOAD_SIZE = int(os.environ.get('SEQUENCE_MAX_UPLOAD_SIZE', str(1024 * 1024 * 1024)))
+
+# Output encoding when neither output_format nor the Accept header picks one,
+# and the zlib level (0-9) for PNG output
+DEFAULT_OUTPUT_FORMAT = os.environ.get('DEFAULT_OUTPUT_FORMAT', 'png')
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', '6'))
+
+# Request profiling, for admins sending X-Admin-Token with this value (empty
+# disables it). Profiles are kept in PROFILE_DIR, at most PROFILE_MAX_COUNT.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/profiles')
+PROFILE_MAX_COUNT = int(os.environ.get('PROFILE_MAX_COUNT', '50'))
+# Requests slower than this many seconds are re-run with profiling in the
+# background, at most once per PROFILE_SLOW_INTERVAL seconds. 0 disables it.
+PROFILE_SLOW_REQUEST_SECONDS = float(os.environ.get('PROFILE_SLOW_REQUEST_SECONDS', '0'))
+PROFILE_SLOW_INTERVAL = float(os.environ.get('PROFILE_SLOW_INTERVAL', '300'))
@@ -0,0 +1,155 @@
+"""
+Output encoders for processed images.
+
+A transparent PNG is often larger than the JPEG it came from, so besides PNG
+the API can return lossy or lossless WebP with alpha, AVIF where the Pillow
+build supports it, and palette-quantized PNG. The default comes from the
+client's Accept header when it asks for specific image types.
+"""
+
+import io
+from typing import Optional, Tuple
+
+from PIL import Image, features
+
+try:
+    # Older Pillow releases get AVIF through this optional plugin
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pass
+
+# output_format -> (media type, file extension)
+OUTPUT_FORMATS = {
+    'png': ('image/png', 'png'),
+    'png8': ('image/png', 'png'),  # palette quantized, 256 colours with alpha
+    'webp': ('image/webp', 'webp'),  # lossy colour, lossless alpha
+    'webp-lossless': ('image/webp', 'webp'),
+    'avif': ('image/avif', 'avif'),
+}
+
+MEDIA_TYPE_EXTENSIONS = {media: extension for media, extension in OUTPUT_FORMATS.values()}
+MEDIA_TYPE_EXTENSIONS['application/json'] = 'json'  # mode=bbox results
+
+DEFAULT_QUALITY = {
+    'webp': 80,
+    'webp-lossless': 80,  # compression effort for lossless
+    'avif': 60,
+}
+
+
+class UnsupportedFormatError(ValueError):
+    pass
+
+
+def avif_available() -> bool:
+    try:
+        return bool(features.check('avif'))
+    except Exception:
+        Image.init()
+        return 'AVIF' in Image.SAVE
+
+
+def available_formats():
+    return [fmt for fmt in OUTPUT_FORMATS if fmt != 'avif' or avif_available()]
+
+
+def media_type(output_format: str) -> str:
+    return OUTPUT_FORMATS[output_format][0]
+
+
+def file_extension(media_type: str) -> str:
+    return MEDIA_TYPE_EXTENSIONS.get(media_type, 'png')
+
+
+def negotiate_output_format(accept: Optional[str], default: str = 'png') -> str:
+    """Pick an output format from an Accept header.
+
+    Only image types the client lists explicitly count, in order of their q
+    value, so browsers' generic */* and XHR defaults get the default format.
+    """
+    if not accept:
+        return default
+    candidates = []
+    for position, part in enumerate(accept.split(',')):
+        fields = [field.strip() for field in part.split(';')]
+        quality = 1.0
+        for param in fields[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, fields[0].lower()))
+
+    preferred = {'image/png': 'png', 'image/webp': 'webp'}
+    if avif_available():
+        preferred['image/avif'] = 'avif'
+    for _, _, mime in sorted(candidates):
+        if mime in preferred:
+            return preferred[mime]
+    return default
+
+
+def encode_image(img: Image.Image, output_format: str = 'png', quality: Optional[int] = None,
+                 png_compression: int = 6) -> Tuple[bytes, str]:
+    """Encode an RGBA image, returning (data, media_type)"""
+    if output_format not in OUTPUT_FORMATS:
+        raise UnsupportedFormatError(f"Unknown output format: {output_format}")
+    if quality is None:
+        quality = DEFAULT_QUALITY.get(output_format)
+
+    bio = io.BytesIO()
+    if output_format == 'png':
+        img.save(bio, 'PNG', compress_level=png_compression)
+    elif output_format == 'png8':
+        # FASTOCTREE is the built-in quantizer that keeps the alpha channel
+        quantized = img.quantize(colors=256, method=Image.Quantize.FASTOCTREE)
+        quantized.save(bio, 'PNG', compress_level=png_compression, optimize=True)
+    elif output_format == 'webp':
+        img.save(bio, 'WEBP', quality=quality, alpha_quality=100, method=4)
+    elif output_format == 'webp-lossless':
+        img.save(bio, 'WEBP', lossless=True, quality=quality, method=4)
+    elif output_format == 'avif':
+        if not avif_available():
+            raise UnsupportedFormatError("AVIF output is not available on this server")
+        img.save(bio, 'AVIF', quality=quality)
+    return bio.getvalue(), media_type(output_format)
+
+
+def encode_mask(mask: Image.Image, bits: int = 8, threshold: int = 128,
+                png_compression: int = 6) -> Tuple[bytes, str]:
+    """Encode a single-channel mask as an 8-bit grayscale or 1-bit PNG"""
+    if bits == 1:
+        mask = mask.point(lambda value: 255 if value >= threshold else 0, mode='1')
+    bio = io.BytesIO()
+    mask.save(bio, 'PNG', compress_level=png_compression)
+    return bio.getvalue(), 'image/png'
+
+
+class EncodingStats:
+    """Running totals of output size and encode time per format"""
+
+    def __init__(self):
+        self._totals = {}
+
+    def record(self, output_format: str, original_size: int, output_size: int, encode_time: float):
+        totals = self._totals.setdefault(output_format, {
+            'count': 0, 'original_bytes': 0, 'output_bytes': 0, 'encode_time': 0.0,
+        })
+        totals['count'] += 1
+        totals['original_bytes'] += original_size
+        totals['output_bytes'] += output_size
+        totals['encode_time'] += encode_time
+
+    def describe(self):
+        formats = {}
+        for output_format, totals in self._totals.items():
+            count = totals['count']
+            formats[output_format] = {
+                **totals,
+                'avg_output_bytes': totals['output_bytes'] / count,
+                'avg_encode_time': totals['encode_time'] / count,
+                'size_ratio': totals['output_bytes'] / max(1, totals['original_bytes']),
+            }
+        return formats
@@ -0,0 +1,14 @@
+"""
+gunicorn settings read from the working directory (the backend directory in
+the image). Command line options in entrypoint.sh take precedence.
+"""
+
+import os
+
+
+def child_exit(server, worker):
+    # Drop the live gauges of a worker that exited so /metrics stops
+    # counting its in-flight requests and memory
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
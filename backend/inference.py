@@ -0,0 +1,153 @@
+"""
+Bounded executor for CPU-bound inference work.
+
+Model inference must not run on the asyncio event loop: a single slow image
+would stall every other request, health checks included. Work is handed to a
+thread or process pool instead, and the number of outstanding tasks is capped
+so overload turns into fast 503 responses rather than an ever-growing backlog.
+"""
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept more work"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Inference queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+@dataclass
+class ExecutionStats:
+    queue_depth: int  # tasks waiting ahead of this one when it was submitted
+    wait_time: float  # seconds between submission and a worker picking it up
+    run_time: float  # seconds spent running on the worker
+
+    def __add__(self, other: 'ExecutionStats') -> 'ExecutionStats':
+        # A request that hops through the pool several times reports the
+        # deepest queue it saw and its total wait and run time
+        return ExecutionStats(
+            queue_depth=max(self.queue_depth, other.queue_depth),
+            wait_time=self.wait_time + other.wait_time,
+            run_time=self.run_time + other.run_time,
+        )
+
+
+def _timed_call(fn, *args):
+    """Run fn on a worker and report when it started and finished.
+
+    Module level so it can be pickled for the process pool.
+    """
+    started_at = time.time()
+    result = fn(*args)
+    return result, started_at, time.time()
+
+
+def _preload_worker(model_names):
+    # Runs once in each spawned worker process so the first task does not pay
+    # for session creation
+    from model_registry import registry
+
+    for model_name in model_names:
+        registry.load(model_name)
+
+
+class InferenceExecutor:
+    """Thread or process pool with a bounded number of queued tasks"""
+
+    def __init__(self, kind: str = 'thread', max_workers: int = 2, max_queue: int = 16,
+                 preload_models=()):
+        if kind not in ('thread', 'process'):
+            raise ValueError(f"Unknown inference executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self.preload_models = tuple(preload_models)
+        self._pool: Executor = None
+        self._pending = 0
+        # Smoothed task run time, used to suggest a Retry-After value
+        self._avg_run_time = 1.0
+
+    def start(self):
+        if self._pool is not None:
+            return
+        if self.kind == 'process':
+            # Spawn rather than fork: ONNX Runtime thread pools do not survive
+            # a fork, and each worker loads its own sessions anyway
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_preload_worker,
+                initargs=(self.preload_models,),
+            )
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix='inference',
+            )
+        logger.info(
+            f"Inference executor started: {self.kind} pool, "
+            f"{self.max_workers} workers, queue limit {self.max_queue}"
+        )
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    @property
+    def capacity(self) -> int:
+        return self.max_workers + self.max_queue
+
+    @property
+    def pending(self) -> int:
+        """Tasks submitted but not finished (running + queued)"""
+        return self._pending
+
+    @property
+    def queue_depth(self) -> int:
+        """Tasks waiting for a free worker"""
+        return max(self._pending - self.max_workers, 0)
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until the backlog has drained"""
+        backlog = self._pending / self.max_workers
+        return max(1, math.ceil(backlog * self._avg_run_time))
+
+    async def run(self, fn, *args):
+        """Run fn(*args) on the pool and return (result, ExecutionStats).
+
+        Raises QueueFullError without queuing when the pool is saturated.
+        """
+        if self._pending >= self.capacity:
+            raise QueueFullError(self.retry_after())
+
+        self.start()
+        queue_depth = self.queue_depth
+        submitted_at = time.time()
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, started_at, finished_at = await loop.run_in_executor(
+                self._pool, _timed_call, fn, *args
+            )
+        finally:
+            self._pending -= 1
+
+        run_time = finished_at - started_at
+        self._avg_run_time = 0.8 * self._avg_run_time + 0.2 * run_time
+        stats = ExecutionStats(
+            queue_depth=queue_depth,
+            wait_time=max(started_at - submitted_at, 0.0),
+            run_time=run_time,
+        )
+        return result, stats
@@ -0,0 +1,244 @@
+"""
+Asynchronous background removal jobs.
+
+POST /api/jobs stores the upload and returns a job id immediately; a small
+pool of job workers feeds queued jobs through the shared pipeline. Clients
+poll GET /api/jobs/{id} for status and progress and fetch the result once it
+is complete, so no HTTP connection is held open for the whole inference.
+
+Jobs and results expire after a TTL. Two stores are available:
+    memory  in-process dicts, fine for a single worker
+    mongo   the jobs collection with results in GridFS, shared by all workers
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pydantic import BaseModel, Field
+
+from inference import QueueFullError
+from processing import ProcessingOptions
+
+logger = logging.getLogger(__name__)
+
+# Seconds between sweeps for expired jobs
+PURGE_INTERVAL = 60
+
+
+class Job(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    status: str = 'queued'  # queued, processing, completed, failed
+    stage: Optional[str] = None
+    progress: float = 0.0
+    filename: Optional[str] = None
+    original_size: int = 0
+    processed_size: Optional[int] = None
+    media_type: Optional[str] = None
+    processing_time: Optional[float] = None
+    cache_hit: Optional[bool] = None
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    completed_at: Optional[datetime] = None
+    expires_at: datetime
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class MemoryJobStore:
+    """Jobs and results in this process's memory"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._results = {}
+
+    async def create(self, job: Job):
+        self._jobs[job.id] = job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        job = self._jobs.get(job_id)
+        if job is not None and job.expires_at <= datetime.utcnow():
+            return None
+        return job
+
+    async def update(self, job_id: str, **fields):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            self._jobs[job_id] = job.model_copy(update=fields)
+
+    async def save_result(self, job_id: str, data: bytes):
+        self._results[job_id] = data
+
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        if await self.get(job_id) is None:
+            return None
+        return self._results.get(job_id)
+
+    async def purge_expired(self) -> int:
+        now = datetime.utcnow()
+        expired = [job_id for job_id, job in self._jobs.items() if job.expires_at <= now]
+        for job_id in expired:
+            self._jobs.pop(job_id, None)
+            self._results.pop(job_id, None)
+        return len(expired)
+
+
+class MongoJobStore:
+    """Jobs in a MongoDB collection, results in GridFS.
+
+    A TTL index removes expired job documents; result files carry their
+    expiry in metadata and are removed by purge_expired.
+    """
+
+    def __init__(self, db=None):
+        self.collection = None
+        self.results = None
+        self._indexes_ready = False
+        if db is not None:
+            self.attach(db)
+
+    def attach(self, db):
+        """Use db from now on. The server attaches it in each worker's
+        startup, once that worker has created its own Motor client."""
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+        self.collection = db.jobs
+        self.results = AsyncIOMotorGridFSBucket(db, bucket_name='job_results')
+
+    async def _ensure_indexes(self):
+        if not self._indexes_ready:
+            await self.collection.create_index('id', unique=True)
+            await self.collection.create_index('expires_at', expireAfterSeconds=0)
+            self._indexes_ready = True
+
+    async def create(self, job: Job):
+        await self._ensure_indexes()
+        await self.collection.insert_one(job.model_dump())
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        doc = await self.collection.find_one(
+            {'id': job_id, 'expires_at': {'$gt': datetime.utcnow()}}
+        )
+        return Job(**doc) if doc else None
+
+    async def update(self, job_id: str, **fields):
+        await self.collection.update_one({'id': job_id}, {'$set': fields})
+
+    async def save_result(self, job_id: str, data: bytes):
+        job = await self.get(job_id)
+        if job is None:
+            return
+        await self.results.upload_from_stream(
+            job_id, data, metadata={'job_id': job_id, 'expires_at': job.expires_at}
+        )
+
+    async def get_result(self, job_id: str) -> Optional[bytes]:
+        if await self.get(job_id) is None:
+            return None
+        cursor = self.results.find({'filename': job_id}).limit(1)
+        async for grid_out in cursor:
+            stream = await self.results.open_download_stream(grid_out._id)
+            return await stream.read()
+        return None
+
+    async def purge_expired(self) -> int:
+        purged = 0
+        cursor = self.results.find({'metadata.expires_at': {'$lte': datetime.utcnow()}})
+        async for grid_out in cursor:
+            await self.results.delete(grid_out._id)
+            purged += 1
+        return purged
+
+
+class JobManager:
+    """Queue of pending jobs drained by a fixed number of worker tasks"""
+
+    def __init__(self, store, pipeline, workers: int = 2, max_queue: int = 100,
+                 ttl_seconds: int = 3600):
+        self.store = store
+        self.pipeline = pipeline
+        self.workers = max(1, workers)
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max(1, max_queue))
+        self._tasks = []
+
+    def start(self):
+        if self._tasks:
+            return
+        self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.ensure_future(self._purge_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def submit(self, file_content: bytes, filename: Optional[str],
+                     options: ProcessingOptions) -> Job:
+        """Create a job and queue it. Raises JobQueueFullError when saturated."""
+        if self._queue.full():
+            raise JobQueueFullError()
+        job = Job(
+            filename=filename,
+            original_size=len(file_content),
+            expires_at=datetime.utcnow() + self.ttl,
+        )
+        await self.store.create(job)
+        self._queue.put_nowait((job.id, file_content, options))
+        return job
+
+    async def _worker(self):
+        while True:
+            job_id, file_content, options = await self._queue.get()
+            try:
+                await self._process(job_id, file_content, options)
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                await self.store.update(job_id, status='failed', error=str(e),
+                                        completed_at=datetime.utcnow())
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job_id: str, file_content: bytes, options: ProcessingOptions):
+        async def report(stage: str, progress: float):
+            await self.store.update(job_id, status='processing', stage=stage, progress=progress)
+
+        await report('starting', 0.0)
+        start_time = time.time()
+        while True:
+            try:
+                result = await self.pipeline.run(file_content, options, progress=report)
+                break
+            except QueueFullError as e:
+                # Jobs are already queued, so wait for capacity instead of failing
+                await report('waiting', 0.0)
+                await asyncio.sleep(e.retry_after)
+
+        await self.store.save_result(job_id, result.data)
+        await self.store.update(
+            job_id,
+            status='completed',
+            stage='done',
+            progress=1.0,
+            processed_size=len(result.data),
+            media_type=result.media_type,
+            processing_time=time.time() - start_time,
+            cache_hit=result.cache_hit,
+            completed_at=datetime.utcnow(),
+        )
+        logger.info(f"Job {job_id} completed in {time.time() - start_time:.2f}s")
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(PURGE_INTERVAL)
+            try:
+                purged = await self.store.purge_expired()
+                if purged:
+                    logger.info(f"Purged {purged} expired jobs")
+            except Exception as e:
+                logger.warning(f"Job purge failed: {e}")
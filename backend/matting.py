@@ -0,0 +1,256 @@
+"""
+Edge refinement of full-resolution masks.
+
+The model's mask is soft only in a thin band around the subject's outline;
+hair and fur live there, and everywhere else the mask is already 0 or 255.
+Both refinement modes split the mask into a trimap (certain foreground,
+certain background, unknown band) and only recompute the band:
+
+    guided   each band pixel's alpha from where its colour falls between
+             the foreground and background colours around it, cleaned up by
+             a colour guided filter; run tile by tile on the tiles the band
+             crosses. About two seconds for 12 megapixels.
+    matting  closed-form matting (PyMatting, as rembg's alpha_matting) on
+             the band's bounding box, plus an estimate of the foreground
+             colours so strands do not carry a fringe of the old
+             background. Far slower; bands of more than MATTING_MAX_PIXELS
+             are matted at reduced scale.
+
+Outside the band the mask becomes exactly 0 or 255.
+"""
+
+from typing import Tuple
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+import config
+
+EDGE_REFINE_MODES = ('off', 'guided', 'matting')
+
+# Mask values from which a pixel is certain foreground, and up to which it
+# is certain background (rembg's alpha matting defaults)
+FOREGROUND_THRESHOLD = 240
+BACKGROUND_THRESHOLD = 10
+
+# Both certain regions are eroded by this many pixels, widening the band
+ERODE_SIZE = 10
+
+# Window over which the foreground and background colours next to each band
+# pixel are averaged, as a fraction of the image's longer side; it has to
+# reach past the band into both certain regions
+COLOUR_WINDOW = 0.1
+
+# The colour averages are smooth, so they are computed on the image reduced
+# to about this longer side
+COLOUR_SIDE = 512
+
+# Guided filter window radius and regularization; a small eps keeps the
+# filter close to the image's edges
+GUIDED_RADIUS = 2
+GUIDED_EPS = 1e-4
+
+# Side of the tiles the guided filter runs on
+TILE_SIZE = 128
+
+# Peak memory of closed-form matting per unknown pixel (its sparse Laplacian
+# and preconditioner), measured
+MATTING_BYTES_PER_PIXEL = 3 * 1024
+
+UNKNOWN = 128
+
+
+def trimap(mask: np.ndarray) -> np.ndarray:
+    """0 for certain background, 255 for certain foreground, UNKNOWN in between"""
+    size = (ERODE_SIZE, ERODE_SIZE)
+    foreground = ndimage.minimum_filter(mask >= FOREGROUND_THRESHOLD, size, mode='nearest')
+    background = ndimage.minimum_filter(mask <= BACKGROUND_THRESHOLD, size, mode='nearest')
+    result = np.full(mask.shape, UNKNOWN, dtype=np.uint8)
+    result[foreground] = 255
+    result[background] = 0
+    return result
+
+
+def band_tiles(unknown: np.ndarray):
+    """(top, left) corners of the TILE_SIZE tiles holding unknown pixels"""
+    height, width = unknown.shape
+    # Whether each tile holds an unknown pixel, reduced a block of rows at a time
+    found = np.logical_or.reduceat(unknown, np.arange(0, height, TILE_SIZE), axis=0)
+    found = np.logical_or.reduceat(found, np.arange(0, width, TILE_SIZE), axis=1)
+    return [(row * TILE_SIZE, col * TILE_SIZE) for row, col in np.argwhere(found)]
+
+
+def _box(x: np.ndarray, size: int) -> np.ndarray:
+    return ndimage.uniform_filter(x, size, mode='nearest')
+
+
+def _guided_filter(guide: np.ndarray, mask: np.ndarray, radius: int, eps: float) -> np.ndarray:
+    """Guided filter of mask with an RGB guide (He et al.), as 0..1 floats"""
+    size = 2 * radius + 1
+    channels = [guide[..., c] for c in range(3)]
+    mean_i = [_box(channel, size) for channel in channels]
+    mean_p = _box(mask, size)
+    cov_ip = [_box(channel * mask, size) - mean * mean_p for channel, mean in zip(channels, mean_i)]
+    # Covariance of the guide's channels, regularized, and its inverse by cofactors
+    var = {
+        (i, j): _box(channels[i] * channels[j], size) - mean_i[i] * mean_i[j]
+        for i in range(3) for j in range(i, 3)
+    }
+    rr, gg, bb = var[0, 0] + eps, var[1, 1] + eps, var[2, 2] + eps
+    rg, rb, gb = var[0, 1], var[0, 2], var[1, 2]
+    inv_rr, inv_rg, inv_rb = gg * bb - gb * gb, gb * rb - rg * bb, rg * gb - gg * rb
+    inv_gg, inv_gb, inv_bb = rr * bb - rb * rb, rb * rg - rr * gb, rr * gg - rg * rg
+    det = rr * inv_rr + rg * inv_rg + rb * inv_rb
+    a = [
+        (inv_rr * cov_ip[0] + inv_rg * cov_ip[1] + inv_rb * cov_ip[2]) / det,
+        (inv_rg * cov_ip[0] + inv_gg * cov_ip[1] + inv_gb * cov_ip[2]) / det,
+        (inv_rb * cov_ip[0] + inv_gb * cov_ip[1] + inv_bb * cov_ip[2]) / det,
+    ]
+    b = mean_p - a[0] * mean_i[0] - a[1] * mean_i[1] - a[2] * mean_i[2]
+    result = _box(b, size)
+    for coefficient, channel in zip(a, channels):
+        result += _box(coefficient, size) * channel
+    return result
+
+
+def colour_means(rgb: np.ndarray, trimap_: np.ndarray):
+    """Mean certain-foreground and certain-background colour around each pixel.
+
+    Computed on the image reduced by factor; returns (layers, factor),
+    layers being eight float images at that scale: the foreground R, G, B
+    means, the background R, G, B means, and the fraction of each window
+    that was certain foreground and certain background.
+    """
+    height, width = trimap_.shape
+    factor = max(1, max(height, width) // COLOUR_SIDE)
+    window = max(3, int(max(height, width) * COLOUR_WINDOW / factor) * 2 + 1)
+    layers = []
+    fractions = []
+    for value in (255, 0):
+        certain = trimap_ == value
+        # Block means of the certain pixels' colours (others count as black)
+        pixels = rgb[..., :3] * certain[..., np.newaxis]
+        blocks = np.asarray(Image.fromarray(pixels).reduce(factor), dtype=np.float32)
+        weight = np.asarray(Image.fromarray(certain.astype(np.uint8) * 255).reduce(factor), dtype=np.float32)
+        weight = _box(weight / 255, window)
+        for channel in range(3):
+            mean = _box(blocks[..., channel], window) / np.maximum(weight, 1e-6)
+            layers.append(Image.fromarray(mean, 'F'))
+        fractions.append(Image.fromarray(weight, 'F'))
+    return layers + fractions, factor
+
+
+def _means_at(layers, factor: int, box: Tuple[int, int, int, int]) -> np.ndarray:
+    """colour_means upsampled bilinearly onto the full-resolution box (left, top, right, bottom)"""
+    left, top, right, bottom = box
+    source = tuple(max(0.0, edge / factor - 0.5) for edge in box)
+    return np.stack([
+        np.asarray(layer.resize((right - left, bottom - top), Image.Resampling.BILINEAR, box=source))
+        for layer in layers
+    ], axis=-1)
+
+
+def refine_guided(mask: np.ndarray, rgb: np.ndarray, trimap_: np.ndarray):
+    """Recompute the band of mask, in place, from the local colours.
+
+    Each band pixel's alpha is estimated by projecting its colour onto the
+    line between the mean foreground and background colours around it,
+    then cleaned up by a colour guided filter, tile by tile.
+    """
+    unknown = trimap_ == UNKNOWN
+    layers, factor = colour_means(rgb, trimap_)
+    height, width = mask.shape
+    margin = 2 * GUIDED_RADIUS
+    for top, left in band_tiles(unknown):
+        # Filter a margin around the tile so its windows see their full context
+        y0, x0 = max(0, top - margin), max(0, left - margin)
+        y1, x1 = min(height, top + TILE_SIZE + margin), min(width, left + TILE_SIZE + margin)
+        guide = rgb[y0:y1, x0:x1, :3] / np.float32(255)
+        local = _means_at(layers, factor, (x0, y0, x1, y1))
+        foreground, background = local[..., 0:3] / 255, local[..., 3:6] / 255
+        difference = foreground - background
+        estimate = ((guide - background) * difference).sum(axis=-1)
+        estimate /= np.maximum((difference * difference).sum(axis=-1), 1e-4)
+        # Without both kinds of certain pixels nearby the mask is kept
+        seen = (local[..., 6] > 1e-3) & (local[..., 7] > 1e-3)
+        estimate = np.where(seen, np.clip(estimate, 0, 1), mask[y0:y1, x0:x1] / np.float32(255))
+        alpha = _guided_filter(guide, estimate.astype(np.float32), GUIDED_RADIUS, GUIDED_EPS)
+
+        tile = (slice(top, min(height, top + TILE_SIZE)), slice(left, min(width, left + TILE_SIZE)))
+        inner = alpha[top - y0:tile[0].stop - y0, left - x0:tile[1].stop - x0]
+        band = unknown[tile]
+        mask[tile][band] = np.clip(inner[band] * 255 + 0.5, 0, 255).astype(np.uint8)
+
+
+def _band_box(unknown: np.ndarray, margin: int) -> Tuple[int, int, int, int]:
+    rows = np.flatnonzero(unknown.any(axis=1))
+    cols = np.flatnonzero(unknown.any(axis=0))
+    height, width = unknown.shape
+    return (max(0, cols[0] - margin), max(0, rows[0] - margin),
+            min(width, cols[-1] + 1 + margin), min(height, rows[-1] + 1 + margin))
+
+
+def refine_matting(mask: np.ndarray, rgb: np.ndarray, trimap_: np.ndarray) -> np.ndarray:
+    """Recompute the band of mask, in place, with closed-form matting.
+
+    Returns rgb with the band's colours replaced by the estimated foreground
+    (a copy when anything changed). Falls back to the guided filter when the
+    band does not border both certain foreground and certain background.
+    """
+    # Imported here: loading PyMatting compiles its numba kernels
+    from pymatting import estimate_alpha_cf, estimate_foreground_ml
+
+    unknown = trimap_ == UNKNOWN
+    left, top, right, bottom = _band_box(unknown, ERODE_SIZE)
+    box_width, box_height = right - left, bottom - top
+    pixels = rgb[top:bottom, left:right, :3]
+    known = trimap_[top:bottom, left:right]
+    if not ((known == 0).any() and (known == 255).any()):
+        # Matting propagates alpha from both certain regions, so needs both
+        refine_guided(mask, rgb, trimap_)
+        return rgb
+
+    # The solver's work grows with the unknown pixels, not the box
+    scale = min(1.0, (config.MATTING_MAX_PIXELS / np.count_nonzero(known == UNKNOWN)) ** 0.5)
+    if scale < 1.0:
+        size = (max(1, round(box_width * scale)), max(1, round(box_height * scale)))
+        pixels = np.asarray(Image.fromarray(pixels).resize(size, Image.Resampling.BILINEAR))
+        known = np.asarray(Image.fromarray(known).resize(size, Image.Resampling.NEAREST))
+
+    image = pixels / 255.0
+    alpha = estimate_alpha_cf(image, known / 255.0)
+    foreground = estimate_foreground_ml(image, alpha)
+    alpha = np.clip(alpha * 255 + 0.5, 0, 255).astype(np.uint8)
+    foreground = np.clip(foreground * 255 + 0.5, 0, 255).astype(np.uint8)
+    if scale < 1.0:
+        size = (box_width, box_height)
+        alpha = np.asarray(Image.fromarray(alpha).resize(size, Image.Resampling.BILINEAR))
+        foreground = np.asarray(Image.fromarray(foreground).resize(size, Image.Resampling.BILINEAR))
+
+    band = unknown[top:bottom, left:right]
+    mask[top:bottom, left:right][band] = alpha[band]
+    rgb = rgb.copy()
+    rgb[top:bottom, left:right, :3][band] = foreground[band]
+    return rgb
+
+
+def refine_edges(mask: np.ndarray, rgb: np.ndarray, mode: str) -> np.ndarray:
+    """Refine mask in place around the subject's outline, as mode asks.
+
+    rgb is the full-resolution image (RGB or RGBA). Returns the colours to
+    cut out: rgb itself, or for matting a copy with decontaminated edges.
+    """
+    if mode == 'off':
+        return rgb
+    if mode not in EDGE_REFINE_MODES:
+        raise ValueError(f"Unknown edge refinement mode: {mode}")
+    trimap_ = trimap(mask)
+    mask[trimap_ == 255] = 255
+    mask[trimap_ == 0] = 0
+    if not (trimap_ == UNKNOWN).any():
+        return rgb
+    if mode == 'guided':
+        refine_guided(mask, rgb, trimap_)
+        return rgb
+    return refine_matting(mask, rgb, trimap_)
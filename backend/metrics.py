@@ -0,0 +1,161 @@
+"""
+Prometheus metrics.
+
+Latency histograms per request and per pipeline stage, the size of inputs and
+outputs, cache lookups, in-flight requests, errors by type and process memory.
+The stage timings are the ones the processing steps already measure for the
+X-*-Time headers, so /metrics and the headers always agree.
+
+Under gunicorn every worker keeps its own values. With PROMETHEUS_MULTIPROC_DIR
+set (the entrypoint does), they are written to files there and /metrics
+aggregates all workers, whichever one answers the scrape.
+"""
+
+import functools
+import os
+import time
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+    generate_latest, multiprocess,
+)
+
+from model_registry import current_rss_bytes
+
+# Seconds, from cache hits to large images on a busy CPU
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MEGAPIXEL_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 12, 16, 24, 50, 100)
+BYTE_BUCKETS = tuple(2 ** exponent for exponent in range(12, 28, 2))  # 4KB to 64MB
+
+REQUEST_LATENCY = Histogram(
+    'bgremoval_request_duration_seconds',
+    'Time from request to the end of the response of the processing endpoints',
+    ['endpoint'], buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    'bgremoval_stage_duration_seconds',
+    'Time spent per pipeline stage: queue_wait, decode, preprocess, inference, '
+    'refine, composite, postprocess, encode',
+    ['stage'], buckets=LATENCY_BUCKETS,
+)
+INPUT_MEGAPIXELS = Histogram(
+    'bgremoval_input_megapixels',
+    'Size of the processed images in megapixels',
+    buckets=MEGAPIXEL_BUCKETS,
+)
+OUTPUT_BYTES = Histogram(
+    'bgremoval_output_bytes',
+    'Size of the encoded results',
+    ['output_format'], buckets=BYTE_BUCKETS,
+)
+CACHE_LOOKUPS = Counter(
+    'bgremoval_cache_lookups_total',
+    'Result cache lookups by result (hit or miss)',
+    ['result'],
+)
+IN_FLIGHT = Gauge(
+    'bgremoval_requests_in_flight',
+    'Processing requests currently being handled',
+    ['endpoint'], multiprocess_mode='livesum',
+)
+ERRORS = Counter(
+    'bgremoval_errors_total',
+    'Failed processing requests by endpoint and error type',
+    ['endpoint', 'type'],
+)
+PROCESS_RSS = Gauge(
+    'bgremoval_process_resident_memory_bytes',
+    'Resident set size of each server process',
+    multiprocess_mode='liveall',
+)
+
+
+def error_type(exc: Exception) -> str:
+    """Label for an error: the status of HTTP errors, or the exception class.
+
+    Handlers turn unexpected exceptions into a 500 HTTPException, so for those
+    the class of the original exception is reported.
+    """
+    if isinstance(exc, HTTPException):
+        if exc.status_code >= 500 and exc.__context__ is not None \
+                and not isinstance(exc.__context__, HTTPException):
+            return type(exc.__context__).__name__
+        return f"http_{exc.status_code}"
+    return type(exc).__name__
+
+
+def _request_finished(endpoint: str, start_time: float):
+    IN_FLIGHT.labels(endpoint).dec()
+    REQUEST_LATENCY.labels(endpoint).observe(time.perf_counter() - start_time)
+    PROCESS_RSS.set(current_rss_bytes())
+
+
+async def _observed_body(body, endpoint: str, start_time: float):
+    """A streamed response body that ends its request's observation when done"""
+    try:
+        async for chunk in body:
+            yield chunk
+    except Exception as e:
+        ERRORS.labels(endpoint, error_type(e)).inc()
+        raise
+    finally:
+        # Also when the client goes away mid-stream: let the body clean up
+        if hasattr(body, 'aclose'):
+            await body.aclose()
+        _request_finished(endpoint, start_time)
+
+
+def observe_endpoint(endpoint: str):
+    """Decorator counting an async handler's requests, latency and errors.
+
+    For streaming responses (bulk, sequences) the request lasts until the
+    body has been sent, not until the handler returns.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            IN_FLIGHT.labels(endpoint).inc()
+            streaming = False
+            try:
+                response = await handler(*args, **kwargs)
+                if isinstance(response, StreamingResponse):
+                    response.body_iterator = _observed_body(response.body_iterator, endpoint, start_time)
+                    streaming = True
+                return response
+            except Exception as e:
+                ERRORS.labels(endpoint, error_type(e)).inc()
+                raise
+            finally:
+                if not streaming:
+                    _request_finished(endpoint, start_time)
+        return wrapper
+    return decorator
+
+
+def observe_cache_lookup(hit: bool):
+    CACHE_LOOKUPS.labels('hit' if hit else 'miss').inc()
+
+
+def observe_pipeline(timings: dict, queue_wait: float, pixels: int, output_size: int,
+                     output_format: str):
+    """Record one processed image: its stage timings and its size in and out"""
+    STAGE_LATENCY.labels('queue_wait').observe(queue_wait)
+    for stage, seconds in timings.items():
+        STAGE_LATENCY.labels(stage).observe(seconds)
+    if pixels:
+        INPUT_MEGAPIXELS.observe(pixels / 1_000_000)
+    OUTPUT_BYTES.labels(output_format).observe(output_size)
+
+
+def render_metrics():
+    """The text exposition of all metrics, returned as (body, content_type)"""
+    PROCESS_RSS.set(current_rss_bytes())
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,261 @@
+"""
+Process-wide registry of rembg model sessions.
+
+Creating a rembg session builds an ONNX Runtime InferenceSession, which reads
+the model file and initializes the graph. That takes seconds, so sessions are
+created once and shared by every request handled by this process.
+
+Model names may carry a variant suffix, "<model>:<variant>", selecting one of
+the quantized or optimized files built by optimize_models.py instead of the
+downloaded FP32 model.
+
+With several server processes, sessions can be created once in the parent
+before it forks (preload_before_fork). The workers inherit them copy-on-write
+and inference never writes to the weights, so those pages stay shared by all
+workers instead of being loaded N times.
+"""
+
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import onnxruntime as ort
+from rembg import new_session
+from rembg.sessions import sessions_class
+from rembg.sessions.base import BaseSession
+
+import config
+
+logger = logging.getLogger(__name__)
+
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disabled': ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+EXECUTION_MODES = {
+    'sequential': ort.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': ort.ExecutionMode.ORT_PARALLEL,
+}
+
+# Variant suffix -> file name in MODEL_VARIANTS_DIR
+MODEL_VARIANTS = {
+    'int8': '{model}.int8.onnx',  # dynamic INT8 quantization of the weights
+    'int8-static': '{model}.int8-static.onnx',  # calibrated static INT8 (QDQ)
+    'ort': '{model}.ort',  # FP32, graph optimized, ONNX Runtime format
+}
+
+
+def split_model_name(model_name: str) -> Tuple[str, Optional[str]]:
+    """Split "u2net:int8" into ("u2net", "int8"); plain names have no variant"""
+    base, _, variant = model_name.partition(':')
+    return base, variant or None
+
+
+def base_model(model_name: str) -> str:
+    """The rembg model a (possibly variant) model name runs"""
+    return split_model_name(model_name)[0]
+
+
+def variant_path(model_name: str, variant: str) -> str:
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model variant {variant}, expected one of: {', '.join(MODEL_VARIANTS)}")
+    return os.path.join(config.MODEL_VARIANTS_DIR, MODEL_VARIANTS[variant].format(model=model_name))
+
+
+def new_variant_session(model_name: str, variant: str, sess_opts: ort.SessionOptions,
+                        **kwargs) -> BaseSession:
+    """rembg session for a model that runs a variant file instead of the FP32 model"""
+    path = variant_path(model_name, variant)
+    if not os.path.exists(path):
+        raise ValueError(f"Model variant {model_name}:{variant} not found at {path}, run optimize_models.py")
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None:
+        raise ValueError(f"No session class found for model '{model_name}'")
+
+    # rembg sessions find their model file through download_models(); a
+    # subclass pointing it at the variant keeps the model's own pre- and
+    # post-processing
+    variant_class = type(
+        f"{session_class.__name__}Variant",
+        (session_class,),
+        {"download_models": classmethod(lambda cls, *args, **kw: path)},
+    )
+    return variant_class(model_name, sess_opts, **kwargs)
+
+
+def create_session(model_name: str, sess_opts: ort.SessionOptions, **kwargs) -> BaseSession:
+    """New rembg session for a model name, with or without a variant suffix"""
+    base, variant = split_model_name(model_name)
+    if variant is None:
+        return new_session(model_name, sess_opts=sess_opts, **kwargs)
+    return new_variant_session(base, variant, sess_opts, **kwargs)
+
+
+def fork_safe_sessions() -> bool:
+    """Whether sessions created now keep working in forked child processes.
+
+    A session with one intra-op thread (and no parallel inter-op execution)
+    on the CPU provider runs entirely on the calling thread. ONNX Runtime
+    thread pools and GPU contexts do not survive a fork.
+    """
+    cpu_only = all(
+        (provider[0] if isinstance(provider, (tuple, list)) else provider) == 'CPUExecutionProvider'
+        for provider in config.ONNX_PROVIDERS
+    )
+    single_threaded = config.ORT_INTRA_OP_THREADS == 1 and (
+        config.ORT_EXECUTION_MODE == 'sequential' or config.ORT_INTER_OP_THREADS == 1
+    )
+    return cpu_only and single_threaded
+
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process in bytes (0 when unavailable)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def session_options() -> ort.SessionOptions:
+    """ONNX Runtime session options from the ORT_* settings in config"""
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = config.ORT_INTRA_OP_THREADS
+    sess_opts.inter_op_num_threads = config.ORT_INTER_OP_THREADS
+    try:
+        sess_opts.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[config.ORT_GRAPH_OPTIMIZATION]
+        sess_opts.execution_mode = EXECUTION_MODES[config.ORT_EXECUTION_MODE]
+    except KeyError as e:
+        raise ValueError(f"Unsupported ONNX Runtime setting: {e}")
+    return sess_opts
+
+
+def _providers_key(providers) -> Tuple:
+    """Turn a providers list into a hashable registry key.
+
+    Entries are either provider names or (name, options) tuples, the two forms
+    accepted by onnxruntime.InferenceSession.
+    """
+    if not providers:
+        return ()
+    key = []
+    for provider in providers:
+        if isinstance(provider, (tuple, list)):
+            name, options = provider
+            key.append((name, tuple(sorted((options or {}).items()))))
+        else:
+            key.append((provider, ()))
+    return tuple(key)
+
+
+@dataclass
+class LoadedModel:
+    model_name: str
+    providers: Tuple
+    session: BaseSession
+    load_time: float
+    memory_bytes: int
+    loaded_at: float
+    # Process that created the session; another one means it was inherited
+    # through a fork and its weights are shared with the parent
+    loaded_pid: int
+
+    def describe(self) -> dict:
+        return {
+            "model": self.model_name,
+            "providers": [name for name, _ in self.providers] or None,
+            "active_providers": self.session.inner_session.get_providers(),
+            "shared_weights": self.loaded_pid != os.getpid(),
+            "load_time": self.load_time,
+            "memory_bytes": self.memory_bytes,
+            "loaded_at": self.loaded_at,
+        }
+
+
+class ModelRegistry:
+    """Loads each (model, provider options) combination once and caches it"""
+
+    def __init__(self, default_providers: Optional[List] = None):
+        self.default_providers = list(default_providers or [])
+        self._models: Dict[Tuple, LoadedModel] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, model_name: str, providers) -> Tuple:
+        if providers is None:
+            providers = self.default_providers
+        return (model_name, _providers_key(providers))
+
+    def get(self, model_name: str, providers=None) -> BaseSession:
+        """Return the session for a model, loading it on first use"""
+        key = self._key(model_name, providers)
+        loaded = self._models.get(key)
+        if loaded is None:
+            loaded = self.load(model_name, providers)
+        return loaded.session
+
+    def load(self, model_name: str, providers=None) -> LoadedModel:
+        """Load a model into the registry (no-op if it is already resident)"""
+        key = self._key(model_name, providers)
+        # One lock for all loads: concurrent first requests wait for a single
+        # session instead of each building their own copy.
+        with self._lock:
+            loaded = self._models.get(key)
+            if loaded is not None:
+                return loaded
+
+            kwargs = {}
+            if key[1]:
+                kwargs["providers"] = list(providers or self.default_providers)
+
+            rss_before = current_rss_bytes()
+            start_time = time.time()
+            session = create_session(model_name, session_options(), **kwargs)
+            load_time = time.time() - start_time
+            memory_bytes = max(current_rss_bytes() - rss_before, 0)
+
+            loaded = LoadedModel(
+                model_name=model_name,
+                providers=key[1],
+                session=session,
+                load_time=load_time,
+                memory_bytes=memory_bytes,
+                loaded_at=time.time(),
+                loaded_pid=os.getpid(),
+            )
+            self._models[key] = loaded
+            logger.info(
+                f"Loaded model {model_name} in {load_time:.2f}s "
+                f"({memory_bytes / (1024 * 1024):.1f} MB resident)"
+            )
+            return loaded
+
+    def describe(self) -> List[dict]:
+        return [loaded.describe() for loaded in self._models.values()]
+
+
+# Shared by every request handled by this process
+registry = ModelRegistry(config.ONNX_PROVIDERS)
+
+
+def preload_before_fork(model_names: List[str]) -> bool:
+    """Load models in the parent of a pre-forking server, if that is safe.
+
+    Meant for gunicorn --preload, which imports server.py in the master
+    process. Returns False, loading nothing, when sessions would not survive
+    the fork; each worker then loads its own copy on startup.
+    """
+    if not fork_safe_sessions():
+        logger.warning(
+            "Not sharing model weights between workers: needs ORT_INTRA_OP_THREADS=1 "
+            "and CPU execution, workers load their own sessions"
+        )
+        return False
+    for model_name in model_names:
+        registry.load(model_name)
+    return True
@@ -0,0 +1,162 @@
+"""
+Request-level orchestration of background removal.
+
+Ties the processing steps together: decoding and post-processing run on the
+inference executor per request, while the model itself runs through the
+micro-batcher so concurrent requests share ONNX runs. Results are looked up
+in the content-addressed cache first, so repeated uploads skip all of it.
+"""
+
+import asyncio
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Optional
+
+from animation import PreparedAnimation, finish_animation, prepare_upload
+from batching import BatchStats, MicroBatcher
+from cache import CachedResult, ResultCache, cache_key
+from encoding import EncodingStats
+from inference import ExecutionStats, InferenceExecutor
+from metrics import observe_cache_lookup, observe_pipeline
+from processing import ProcessingOptions, finish_cutout
+
+
+@dataclass
+class PipelineResult:
+    data: bytes
+    media_type: str
+    stats: ExecutionStats
+    batch: BatchStats
+    cache_hit: bool = False
+    # Set when the request ran under the profiler, see profiling.py
+    profile_id: Optional[str] = None
+    # Frames of an animated upload, and how many of them ran through the model
+    frame_count: int = 1
+    inferred_frames: int = 1
+    # Seconds per stage: decode, preprocess, inference, composite or
+    # postprocess, encode
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+class BackgroundRemovalPipeline:
+    def __init__(self, executor: InferenceExecutor, batcher: MicroBatcher,
+                 cache: Optional[ResultCache] = None):
+        self.executor = executor
+        self.batcher = batcher
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.encoding_stats = EncodingStats()
+
+    async def run(self, file_content: bytes, options: ProcessingOptions,
+                  progress=None, warmup: bool = False,
+                  background: Optional[bytes] = None) -> PipelineResult:
+        """Remove the background from an encoded image.
+
+        progress, if given, is an async callable receiving (stage, fraction)
+        as the request moves through the pipeline. Warm-up runs bypass the
+        cache and are left out of the statistics. background is the image
+        cutouts are composited over when options.background_image is set.
+
+        Raises inference.QueueFullError when the executor is saturated.
+        """
+        async def report(stage, fraction):
+            if progress is not None:
+                await progress(stage, fraction)
+
+        key = None
+        if self.cache is not None and not warmup:
+            # Hashing a large upload and reading the disk tier both block
+            key = await asyncio.to_thread(cache_key, file_content, asdict(options))
+            cached = await asyncio.to_thread(self.cache.get, key)
+            observe_cache_lookup(cached is not None)
+            if cached is not None:
+                return PipelineResult(
+                    data=cached.data,
+                    media_type=cached.media_type,
+                    stats=ExecutionStats(queue_depth=0, wait_time=0.0, run_time=0.0),
+                    batch=BatchStats(batch_size=0, batch_wait=0.0),
+                    cache_hit=True,
+                )
+
+        await report('decoding', 0.1)
+        prepared, prepare_stats = await self.executor.run(prepare_upload, file_content, options)
+        if isinstance(prepared, PreparedAnimation):
+            result = await self._run_animation(prepared, prepare_stats, options, report, background)
+        else:
+            result = await self._run_image(
+                file_content, prepared, prepare_stats, options, report, background
+            )
+
+        if not warmup:
+            output_kind = options.output_format if options.mode == 'cutout' else options.mode
+            self.encoding_stats.record(
+                output_kind, len(file_content), len(result.data), result.timings.get('encode', 0.0)
+            )
+            width, height = prepared.full_size
+            observe_pipeline(result.timings, result.stats.wait_time, width * height * result.frame_count,
+                             len(result.data), output_kind)
+        if key is not None:
+            await asyncio.to_thread(
+                self.cache.put, key, CachedResult(data=result.data, media_type=result.media_type)
+            )
+        return result
+
+    async def _run_image(self, file_content, prepared, prepare_stats, options, report, background):
+        await report('inference', 0.4)
+        mask, predict_stats, batch_stats = await self.batcher.predict(
+            options.model, prepared.model_input
+        )
+        await report('compositing', 0.8)
+        # The full-resolution decode, if any, happens here; drop the tensor
+        # first so it is not shipped to a process pool worker for nothing
+        prepared.model_input = None
+        (output_data, media_type, finish_timings), finish_stats = await self.executor.run(
+            finish_cutout, file_content, prepared, mask, options, background
+        )
+
+        timings = dict(prepared.timings)
+        timings['inference'] = predict_stats.run_time
+        for stage, seconds in finish_timings.items():
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+        return PipelineResult(
+            data=output_data,
+            media_type=media_type,
+            stats=prepare_stats + predict_stats + finish_stats,
+            batch=batch_stats,
+            timings=timings,
+        )
+
+    async def _run_animation(self, prepared, prepare_stats, options, report, background):
+        await report('inference', 0.4)
+        # Submitted together, the keyframes are run as batches. One batch per
+        # executor worker keeps every worker busy; submitting more at once
+        # would fill the executor's queue and fail with QueueFullError
+        keyframes = prepared.keyframes
+        in_flight = asyncio.Semaphore(self.batcher.max_batch_size * self.executor.max_workers)
+
+        async def predict(index):
+            async with in_flight:
+                return await self.batcher.predict(options.model, prepared.model_inputs[index])
+
+        start_time = time.time()
+        predictions = await asyncio.gather(*[predict(index) for index in keyframes])
+        inference_time = time.time() - start_time
+        await report('compositing', 0.8)
+        prepared.model_inputs = {}
+        preds = {index: mask for index, (mask, _, _) in zip(keyframes, predictions)}
+        (output_data, media_type, finish_timings), finish_stats = await self.executor.run(
+            finish_animation, prepared, preds, options, background
+        )
+
+        stats = prepare_stats
+        for _, predict_stats, _ in predictions:
+            stats = stats + predict_stats
+        return PipelineResult(
+            data=output_data,
+            media_type=media_type,
+            stats=stats + finish_stats,
+            batch=max((batch for _, _, batch in predictions), key=lambda batch: batch.batch_size),
+            timings={**prepared.timings, 'inference': inference_time, **finish_timings},
+            frame_count=len(prepared.frames),
+            inferred_frames=len(keyframes),
+        )
@@ -0,0 +1,331 @@
+"""
+In-place post-processing of predicted masks.
+
+Between the model and the encoder a cutout goes through the mask resize,
+optional thresholding and smoothing, and alpha application or compositing
+over a background. Done with PIL each step returns a new full-size image; at
+12 megapixels that is about 150MB allocated and first touched per request.
+Here every step writes into NumPy buffers borrowed from a BufferPool, a
+size-bucketed free list shared by all requests of the process, and works
+through the image in chunks of rows small enough to stay in cache.
+
+Alpha application rounds exactly like Pillow's Image.composite, so cutouts
+are unchanged; the mask is resized bilinearly.
+"""
+
+import math
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+import config
+
+# Working set of one chunk of rows, small enough to stay in L2
+CHUNK_BYTES = 256 * 1024
+
+# Buffers below this are cheap to allocate and not worth pooling
+MIN_POOLED_BYTES = 64 * 1024
+
+Background = Union[None, Tuple[int, int, int], np.ndarray]
+
+# Weights of R, G and B in luminance scaled to 0..1
+LUMA_WEIGHTS = tuple(np.float32(weight / 255) for weight in (0.299, 0.587, 0.114))
+
+
+def chunk_rows(width: int, bytes_per_pixel: int = 4) -> int:
+    return max(1, CHUNK_BYTES // (width * bytes_per_pixel))
+
+
+class BufferPool:
+    """Reusable NumPy buffers, bucketed by size.
+
+    Sizes are rounded up to one of four steps between consecutive powers of
+    two, so images of similar dimensions share buffers while at most a fifth
+    of each goes unused.
+    Released buffers are kept while the pool holds less than max_bytes.
+    Safe to share between executor threads.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._free: Dict[int, List[np.ndarray]] = defaultdict(list)
+        self._retained = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def bucket(nbytes: int) -> int:
+        if nbytes <= MIN_POOLED_BYTES:
+            return nbytes
+        step = 1 << max(0, math.ceil(math.log2(nbytes)) - 3)
+        return -(-nbytes // step) * step
+
+    @contextmanager
+    def borrow(self, shape, dtype=np.uint8):
+        """An uninitialized C-contiguous array of shape and dtype, for the with block"""
+        dtype = np.dtype(dtype)
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        size = self.bucket(nbytes)
+        raw = None
+        if size > MIN_POOLED_BYTES:
+            with self._lock:
+                free = self._free.get(size)
+                if free:
+                    raw = free.pop()
+                    self._retained -= size
+                    self.hits += 1
+                else:
+                    self.misses += 1
+        if raw is None:
+            raw = np.empty(size, dtype=np.uint8)
+        try:
+            yield raw[:nbytes].view(dtype).reshape(shape)
+        finally:
+            if size > MIN_POOLED_BYTES:
+                with self._lock:
+                    if self._retained + size <= self.max_bytes:
+                        self._free[size].append(raw)
+                        self._retained += size
+
+    def describe(self) -> dict:
+        with self._lock:
+            return {
+                "max_bytes": self.max_bytes,
+                "retained_bytes": self._retained,
+                "buffers": sum(len(free) for free in self._free.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+pool = BufferPool(config.POSTPROCESS_POOL_BYTES)
+
+
+def parse_color(value: str) -> Tuple[int, int, int]:
+    """'#rrggbb' or 'rrggbb' as an (r, g, b) tuple"""
+    value = value.lstrip('#')
+    if len(value) != 6:
+        raise ValueError(f"Invalid colour: {value}, expected rrggbb")
+    return int(value[0:2], 16), int(value[2:4], 16), int(value[4:6], 16)
+
+
+def _linear_taps(size_out: int, size_in: int):
+    """Source indices and weights of bilinear resampling with centred pixels"""
+    source = (np.arange(size_out, dtype=np.float32) + 0.5) * np.float32(size_in / size_out) - 0.5
+    np.clip(source, 0, size_in - 1, out=source)
+    lower = source.astype(np.intp)
+    upper = np.minimum(lower + 1, size_in - 1)
+    return lower, upper, source - lower
+
+
+def _resize_columns(source: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Resize the rows of a float array bilinearly to out's width"""
+    x_lower, x_upper, x_weight = _linear_taps(out.shape[1], source.shape[1])
+    with pool.borrow(out.shape, np.float32) as right:
+        np.take(source, x_lower, axis=1, out=out)
+        np.take(source, x_upper, axis=1, out=right)
+        np.subtract(right, out, out=right)
+        np.multiply(right, x_weight, out=right)
+        np.add(out, right, out=out)
+    return out
+
+
+def _interpolate_rows(horizontal: np.ndarray, taps, top: int, bottom: int,
+                      out: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    """Output rows top..bottom of a bilinear resize, from its column-resized source"""
+    y_lower, y_upper, y_weight = taps
+    np.take(horizontal, y_lower[top:bottom], axis=0, out=out)
+    np.take(horizontal, y_upper[top:bottom], axis=0, out=scratch)
+    np.subtract(scratch, out, out=scratch)
+    np.multiply(scratch, y_weight[top:bottom, np.newaxis], out=scratch)
+    np.add(out, scratch, out=out)
+    return out
+
+
+def resize_mask(pred: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Resize a 0..1 float mask bilinearly into out, a uint8 array of the target size"""
+    pred = np.asarray(pred, dtype=np.float32)
+    height, width = out.shape
+    source_height = pred.shape[0]
+    y_taps = _linear_taps(height, source_height)
+    rows = chunk_rows(width)
+
+    # Resize the rows of the (small) prediction first, then interpolate
+    # between them a chunk of output rows at a time
+    with pool.borrow((source_height, width), np.float32) as horizontal, \
+            pool.borrow((rows, width), np.float32) as upper_rows, \
+            pool.borrow((rows, width), np.float32) as lower_rows:
+        _resize_columns(pred, horizontal)
+        np.clip(horizontal, 0.0, 1.0, out=horizontal)
+        np.multiply(horizontal, 255, out=horizontal)
+
+        for top in range(0, height, rows):
+            bottom = min(height, top + rows)
+            upper = _interpolate_rows(horizontal, y_taps, top, bottom,
+                                      upper_rows[:bottom - top], lower_rows[:bottom - top])
+            np.add(upper, 0.5, out=upper)
+            np.copyto(out[top:bottom], upper, casting='unsafe')
+    return out
+
+
+def apply_guided(coefficient_a: np.ndarray, coefficient_b: np.ndarray, rgb: np.ndarray,
+                 out: np.ndarray, top: int = 0, full_height: Optional[int] = None) -> np.ndarray:
+    """Apply guided-filter coefficients fitted at a reduced size to a full-size image.
+
+    The coefficients are resized bilinearly to the image's size and combined
+    with its luminance, a * luminance + b, a chunk of rows at a time. out is
+    the resulting uint8 mask. rgb and out may be a band of rows starting at
+    top of an image full_height rows high, as in strip processing; a band
+    comes out exactly as the same rows of the whole image would.
+    """
+    rows_out, width = out.shape
+    if full_height is None:
+        full_height = rows_out
+    y_lower, y_upper, y_weight = _linear_taps(full_height, coefficient_a.shape[0])
+    # Only the coefficient rows this band interpolates between
+    first = int(y_lower[top])
+    last = int(y_upper[top + rows_out - 1]) + 1
+    y_taps = (y_lower - first, y_upper - first, y_weight)
+    rows = chunk_rows(width)
+
+    with pool.borrow((last - first, width), np.float32) as horizontal_a, \
+            pool.borrow((last - first, width), np.float32) as horizontal_b, \
+            pool.borrow((rows, width), np.float32) as alpha_rows, \
+            pool.borrow((rows, width), np.float32) as offset_rows, \
+            pool.borrow((rows, width), np.float32) as luminance_rows, \
+            pool.borrow((rows, width), np.float32) as scratch_rows:
+        _resize_columns(coefficient_a[first:last], horizontal_a)
+        _resize_columns(coefficient_b[first:last], horizontal_b)
+
+        for start in range(0, rows_out, rows):
+            stop = min(rows_out, start + rows)
+            count = stop - start
+            scratch = scratch_rows[:count]
+            alpha = _interpolate_rows(horizontal_a, y_taps, top + start, top + stop, alpha_rows[:count], scratch)
+            offset = _interpolate_rows(horizontal_b, y_taps, top + start, top + stop, offset_rows[:count], scratch)
+
+            # ITU-R 601-2 luma, as Image.convert('L'), scaled to 0..1
+            luminance = luminance_rows[:count]
+            np.multiply(rgb[start:stop, :, 0], LUMA_WEIGHTS[0], out=luminance, casting='unsafe')
+            for channel in (1, 2):
+                np.multiply(rgb[start:stop, :, channel], LUMA_WEIGHTS[channel], out=scratch, casting='unsafe')
+                np.add(luminance, scratch, out=luminance)
+
+            np.multiply(alpha, luminance, out=alpha)
+            np.add(alpha, offset, out=alpha)
+            np.clip(alpha, 0.0, 1.0, out=alpha)
+            np.multiply(alpha, 255, out=alpha)
+            np.add(alpha, 0.5, out=alpha)
+            np.copyto(out[start:stop], alpha, casting='unsafe')
+    return out
+
+
+def threshold_mask(mask: np.ndarray, level: int) -> np.ndarray:
+    """Set mask values from level up to 255 and the rest to 0, in place"""
+    table = np.where(np.arange(256) >= level, 255, 0).astype(np.uint8)
+    np.take(table, mask, out=mask, mode='clip')
+    return mask
+
+
+def _window_sum(running: np.ndarray, radius: int, out: np.ndarray) -> np.ndarray:
+    """Sums over windows of 2*radius+1 along the last axis, from running sums.
+
+    Windows are cut short at the edges rather than padded. With unsigned
+    integers this is exact even when the running sums wrap around, as only
+    their differences are used.
+    """
+    n = running.shape[-1]
+    r = radius
+    # Sum up to min(x + r, n - 1), minus the sum up to x - r - 1
+    out[..., :max(0, n - r)] = running[..., r:]
+    out[..., max(0, n - r):] = running[..., n - 1:]
+    np.subtract(out[..., r + 1:], running[..., :max(0, n - r - 1)], out=out[..., r + 1:])
+    return out
+
+
+def _window_counts(n: int, radius: int) -> np.ndarray:
+    """Number of pixels in each window of _window_sum"""
+    x = np.arange(n)
+    return (np.minimum(x + radius, n - 1) - np.maximum(x - radius, 0) + 1).astype(np.float32)
+
+
+def smooth_mask(mask: np.ndarray, radius: int) -> np.ndarray:
+    """Box-blur a uint8 mask in place, feathering its edges over radius pixels.
+
+    The window sums are exact integers, so a row comes out the same whether
+    it is blurred as part of the whole mask or of a strip with radius rows
+    of context on either side.
+    """
+    if radius < 1:
+        return mask
+    height, width = mask.shape
+    rows = chunk_rows(width)
+    column_counts = _window_counts(width, radius)
+    row_counts = _window_counts(height, radius)
+    with pool.borrow((height, width), np.uint32) as running, \
+            pool.borrow((height, width), np.uint32) as sums, \
+            pool.borrow((rows, width), np.float32) as mean_rows:
+        np.cumsum(mask, axis=1, dtype=np.uint32, out=running)
+        _window_sum(running, radius, sums)
+        np.cumsum(sums, axis=0, out=running)
+        _window_sum(running.T, radius, sums.T)
+
+        for top in range(0, height, rows):
+            bottom = min(height, top + rows)
+            means = mean_rows[:bottom - top]
+            np.multiply(row_counts[top:bottom, np.newaxis], column_counts, out=means)
+            np.divide(sums[top:bottom], means, out=means)
+            np.add(means, 0.5, out=means)
+            np.copyto(mask[top:bottom], means, casting='unsafe')
+    return mask
+
+
+def apply_alpha(rgb: np.ndarray, mask: np.ndarray, out: np.ndarray,
+                background: Background = None) -> np.ndarray:
+    """Cut rgb out with mask into out, in one pass.
+
+    Without a background out is RGBA, its colours weighted by the mask exactly
+    as Pillow's Image.composite onto transparent black does. With a
+    background, an (r, g, b) colour or an array shaped like rgb, out is RGB:
+    the image blended over the background.
+    """
+    height, width = mask.shape
+    rows = chunk_rows(width)
+    colour = isinstance(background, tuple)
+    with pool.borrow((rows, width), np.float32) as weights, \
+            pool.borrow((rows, width), np.float32) as values:
+        for top in range(0, height, rows):
+            bottom = min(height, top + rows)
+            weight = weights[:bottom - top]
+            value = values[:bottom - top]
+            np.multiply(mask[top:bottom], np.float32(1 / 255), out=weight)
+            # Channel by channel: NumPy is much slower on a last axis of 3
+            for channel in range(3):
+                source = rgb[top:bottom, :, channel]
+                if background is None:
+                    np.multiply(source, weight, out=value)
+                else:
+                    under = background[channel] if colour else background[top:bottom, :, channel]
+                    np.subtract(source, under, out=value, dtype=np.float32)
+                    np.multiply(value, weight, out=value)
+                    np.add(value, under, out=value)
+                np.rint(value, out=out[top:bottom, :, channel], casting='unsafe')
+            if background is None:
+                out[top:bottom, :, 3] = mask[top:bottom]
+    return out
+
+
+def cover_rows(background: Image.Image, size: Tuple[int, int], top: int, bottom: int) -> np.ndarray:
+    """Rows top to bottom of background scaled to cover size, centred and cropped"""
+    width, height = size
+    scale = max(width / background.width, height / background.height)
+    left = (background.width - width / scale) / 2
+    upper = (background.height - height / scale) / 2
+    box = (left, upper + top / scale, left + width / scale, upper + bottom / scale)
+    rows = background.resize((width, bottom - top), Image.Resampling.BILINEAR, box=box)
+    return np.asarray(rows)
@@ -0,0 +1,609 @@
+"""
+CPU-bound image processing steps.
+
+Functions here run on the inference executor's workers, never on the event
+loop. They are module level so the process pool can pickle them.
+
+A request goes through three steps so that model inference can be batched
+across requests:
+
+    prepare_image  -> decode once with Pillow (EXIF orientation applied,
+                      colour mode normalized to 8-bit RGB or RGBA) and
+                      build the model input tensor
+    predict_batch  -> one ONNX run for a batch of input tensors
+    finish_cutout  -> scale the mask to the image, cut out and encode in
+                      the requested output format (or return just the mask
+                      or its bounding box), in pooled buffers (see
+                      postprocess)
+
+The model sees a fixed, small input (320x320 for u2net), so with
+max_inference_side set the mask is predicted on a reduced decode of the
+upload (JPEG draft mode decodes at 1/2, 1/4 or 1/8 scale directly) and
+upsampled with a guided filter only when it is applied to the full image.
+
+Images whose estimated memory use exceeds MAX_REQUEST_MEMORY_BYTES always
+get a reduced view, and their cutout or mask is applied and PNG-encoded in
+strips of rows (see tiling).
+"""
+
+import io
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+try:
+    # Needs Pillow built with LittleCMS; without it CMYK is converted naively
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
+
+import config
+import tiling
+from encoding import encode_image, encode_mask
+from matting import MATTING_BYTES_PER_PIXEL, refine_edges
+from model_registry import base_model, registry
+from postprocess import (
+    apply_alpha, apply_guided, cover_rows, parse_color, pool, resize_mask, smooth_mask,
+    threshold_mask,
+)
+
+# Input normalization (mean, std, size) per model, mirroring rembg's session
+# classes. Models listed here are run batched; anything else goes through the
+# rembg session's own predict(), one image at a time.
+U2NET_INPUT_SPEC = ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320))
+ISNET_INPUT_SPEC = ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024))
+MODEL_INPUT_SPECS = {
+    'u2net': U2NET_INPUT_SPEC,
+    'u2netp': U2NET_INPUT_SPEC,
+    'u2net_human_seg': U2NET_INPUT_SPEC,
+    'silueta': U2NET_INPUT_SPEC,
+    'isnet-general-use': ISNET_INPUT_SPEC,
+    'isnet-anime': ((0.485, 0.456, 0.406), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+# Mask value from which a pixel counts as foreground in 1-bit masks and boxes
+MASK_THRESHOLD = 128
+
+# EXIF orientations that swap width and height
+TRANSPOSING_ORIENTATIONS = (5, 6, 7, 8)
+
+# Keep Pillow's own decompression bomb guard in line with our limit
+Image.MAX_IMAGE_PIXELS = config.MAX_IMAGE_PIXELS
+
+
+class ImageTooLargeError(ValueError):
+    """The image has more pixels than MAX_IMAGE_PIXELS allows"""
+
+
+def check_pixel_count(img: Image.Image):
+    """Reject images over the pixel limit; only needs the parsed header"""
+    pixels = img.width * img.height
+    if pixels > config.MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(
+            f"Image is {pixels / 1e6:.0f} megapixels, the limit is "
+            f"{config.MAX_IMAGE_PIXELS / 1e6:.0f} megapixels"
+        )
+
+
+class MemoryLimitError(ImageTooLargeError):
+    """Processing the image would need more than MAX_REQUEST_MEMORY_BYTES"""
+
+
+@dataclass(frozen=True)
+class ProcessingOptions:
+    """Everything about a request that changes its output.
+
+    Also used as part of the result cache key, so any new field that affects
+    the output must be added here.
+    """
+    model: str
+    # cutout: RGBA image, mask: grayscale or 1-bit mask, bbox: JSON box only
+    mode: str = 'cutout'
+    # Bit depth of mode=mask output, 8 or 1
+    mask_bits: int = 8
+    # Longest side of the image the mask is predicted on; None decodes and
+    # predicts at full resolution
+    max_inference_side: Optional[int] = None
+    # Encoding of the result, see encoding.OUTPUT_FORMATS
+    output_format: str = 'png'
+    # WebP/AVIF quality; None uses the format's default
+    quality: Optional[int] = None
+    # zlib level for PNG output; None uses config.PNG_COMPRESS_LEVEL
+    png_compression: Optional[int] = None
+    # Mask refinement before it is applied: mask values from mask_threshold
+    # up become opaque and the rest transparent, then edges are feathered by
+    # a box blur of mask_smooth pixels
+    mask_threshold: Optional[int] = None
+    mask_smooth: int = 0
+    # Edge refinement of the mask's soft band (see matting): off, guided or
+    # matting; runs before thresholding and smoothing
+    edge_refine: str = 'off'
+    # Cutouts are composited over a colour ('rrggbb') or an uploaded image,
+    # identified by the SHA-256 of its bytes; the bytes travel separately
+    background_color: Optional[str] = None
+    background_image: Optional[str] = None
+
+
+@dataclass
+class PreparedImage:
+    view: Image.Image  # image the mask is predicted on
+    model_input: object  # tensor for predict_batch (or the view itself)
+    reduced: bool  # view is smaller than the full-resolution image
+    full_size: Tuple[int, int]  # size of the full image after EXIF rotation
+    timings: Dict[str, float] = field(default_factory=dict)
+    # Apply the mask and encode in strips to stay under the memory ceiling
+    strips: bool = False
+
+
+def oriented_size(img: Image.Image) -> Tuple[int, int]:
+    """Size of an opened image once its EXIF orientation is applied"""
+    if img.getexif().get(0x0112) in TRANSPOSING_ORIENTATIONS:
+        return img.height, img.width
+    return img.size
+
+
+def _to_8bit(img: Image.Image) -> Image.Image:
+    """Scale a 16-bit, 32-bit integer or float single-channel image to 'L'"""
+    ary = np.asarray(img)
+    if img.mode == 'F':
+        # Float images are usually 0..1, otherwise already on a 0..255 scale
+        scale = 255.0 if float(ary.max(initial=0.0)) <= 1.0 else 1.0
+        ary = ary * scale
+    else:
+        # 16-bit samples (which Pillow may also open as 32-bit 'I')
+        ary = ary.astype(np.float32) / 257.0
+    return Image.fromarray(np.clip(ary + 0.5, 0, 255).astype(np.uint8), 'L')
+
+
+def normalize_mode(img: Image.Image) -> Image.Image:
+    """Convert a decoded image to 8-bit RGB, or RGBA when it has transparency.
+
+    Palette images keep their transparency, CMYK is converted through its
+    embedded ICC profile when it has one, and high bit depth grayscale is
+    scaled rather than clipped.
+    """
+    mode = img.mode
+    if mode in ('RGB', 'RGBA'):
+        return img
+    if mode in ('P', 'PA'):
+        has_alpha = mode == 'PA' or 'transparency' in img.info
+        return img.convert('RGBA' if has_alpha else 'RGB')
+    if mode in ('LA', 'La', 'RGBa', 'RGBX'):
+        return img.convert('RGBA' if mode != 'RGBX' else 'RGB')
+    if mode == 'CMYK':
+        icc_profile = img.info.get('icc_profile')
+        if icc_profile and ImageCms is not None:
+            try:
+                return ImageCms.profileToProfile(
+                    img, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                    ImageCms.createProfile('sRGB'), outputMode='RGB',
+                )
+            except (ImageCms.PyCMSError, OSError):
+                pass
+        return img.convert('RGB')
+    if mode.startswith('I') or mode == 'F':
+        return _to_8bit(img).convert('RGB')
+    # 1, L, YCbCr, LAB, HSV
+    return img.convert('RGB')
+
+
+def decode_image(file_content: bytes, max_side: Optional[int] = None) -> Image.Image:
+    """Decode an uploaded image once, ready for the model and the cutout.
+
+    Applies the EXIF orientation and normalizes the colour mode to 8-bit RGB
+    or RGBA (see normalize_mode). With max_side the result is no larger than
+    max_side on its longest edge; formats that support it (JPEG) are decoded
+    at reduced scale directly.
+    """
+    img = Image.open(io.BytesIO(file_content))
+    check_pixel_count(img)
+    if max_side and max(img.size) > max_side:
+        scale = max_side / max(img.size)
+        img.draft('RGB', (int(img.width * scale), int(img.height * scale)))
+    img = normalize_mode(ImageOps.exif_transpose(img))
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return img
+
+
+def model_input(img: Image.Image, model_name: str) -> Optional[np.ndarray]:
+    """Normalized CHW float32 tensor for the model, or None if it has no spec"""
+    spec = MODEL_INPUT_SPECS.get(base_model(model_name))
+    if spec is None:
+        return None
+    mean, std, size = spec
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    im = img.resize(size, Image.Resampling.LANCZOS)
+    im_ary = np.asarray(im, dtype=np.float32)
+    im_ary /= max(float(im_ary.max()), 1e-6)
+    im_ary -= np.asarray(mean, dtype=np.float32)
+    im_ary /= np.asarray(std, dtype=np.float32)
+    return np.ascontiguousarray(im_ary.transpose((2, 0, 1)))
+
+
+def use_strips(img: Image.Image, full_size: Tuple[int, int], options: ProcessingOptions) -> bool:
+    """Whether an image must be processed in strips to fit MAX_REQUEST_MEMORY_BYTES.
+
+    Only needs the parsed header. Raises MemoryLimitError when the image does
+    not fit the ceiling either way.
+    """
+    limit = config.MAX_REQUEST_MEMORY_BYTES
+    needed = tiling.whole_image_bytes(*full_size)
+    if options.edge_refine == 'matting':
+        needed += config.MATTING_MAX_PIXELS * MATTING_BYTES_PER_PIXEL
+    if not limit or options.mode == 'bbox' or needed <= limit:
+        return False
+    message = (
+        f"Processing this {full_size[0] * full_size[1] / 1e6:.0f} megapixel image needs more "
+        f"than the {limit / 1024 ** 2:.0f}MB allowed per request"
+    )
+    if options.mode == 'cutout' and options.output_format != 'png':
+        raise MemoryLimitError(f"{message}; only png output can be produced in strips")
+    if options.edge_refine != 'off':
+        raise MemoryLimitError(f"{message}; edge refinement needs the whole image")
+    channels = 4 if 'A' in img.mode or 'transparency' in img.info else 3
+    if tiling.strip_bytes(*full_size, channels) > limit:
+        raise MemoryLimitError(message)
+    return True
+
+
+def prepare_image(file_content: bytes, options: ProcessingOptions) -> PreparedImage:
+    """Decode an upload and build what predict_batch needs for it.
+
+    The model input is a tensor for models with a known input spec,
+    otherwise the decoded image itself.
+    """
+    start_time = time.time()
+    header = Image.open(io.BytesIO(file_content))
+    full_size = oriented_size(header)
+    strips = use_strips(header, full_size, options)
+    max_side = options.max_inference_side
+    if strips:
+        max_side = min(max_side or tiling.STRIP_INFERENCE_SIDE, tiling.STRIP_INFERENCE_SIDE)
+    if max_side:
+        view = decode_image(file_content, max_side)
+        reduced = max(view.size) < max(full_size)
+    else:
+        view = decode_image(file_content)
+        full_size = view.size
+        reduced = False
+    view.load()
+    decode_time = time.time() - start_time
+
+    tensor = model_input(view, options.model)
+    return PreparedImage(
+        view=view,
+        model_input=tensor if tensor is not None else view,
+        reduced=reduced,
+        full_size=full_size,
+        timings={'decode': decode_time, 'preprocess': time.time() - start_time - decode_time},
+        strips=strips,
+    )
+
+
+def _normalize_prediction(pred: np.ndarray) -> np.ndarray:
+    """Min-max scale a raw model output to 0..1, as rembg does"""
+    mi = float(pred.min())
+    ma = float(pred.max())
+    if ma - mi <= 0:
+        return np.zeros_like(pred, dtype=np.float32)
+    return ((pred - mi) / (ma - mi)).astype(np.float32)
+
+
+def _supports_batching(session) -> bool:
+    """Whether the ONNX graph has a dynamic (or >1) batch dimension"""
+    batch_dim = session.inner_session.get_inputs()[0].shape[0]
+    return not (isinstance(batch_dim, int) and batch_dim == 1)
+
+
+def predict_batch(model_name: str, inputs: List[object], session=None) -> List[np.ndarray]:
+    """Predict a float 0..1 mask for every input with as few ONNX runs as possible.
+
+    Uses the registry's session for the model unless one is given.
+    """
+    if session is None:
+        session = registry.get(model_name)
+
+    if base_model(model_name) not in MODEL_INPUT_SPECS:
+        # Models with their own pre/post-processing go through rembg
+        return [
+            np.asarray(session.predict(img)[0], dtype=np.float32) / 255.0
+            for img in inputs
+        ]
+
+    input_name = session.inner_session.get_inputs()[0].name
+    if len(inputs) > 1 and _supports_batching(session):
+        outputs = session.inner_session.run(None, {input_name: np.stack(inputs)})
+        preds = outputs[0][:, 0, :, :]
+    else:
+        # Graphs exported with a fixed batch of 1 still share this worker hop
+        preds = [
+            session.inner_session.run(None, {input_name: tensor[np.newaxis]})[0][0, 0]
+            for tensor in inputs
+        ]
+    return [_normalize_prediction(pred) for pred in preds]
+
+
+def _box_filter(x: np.ndarray, r: int) -> np.ndarray:
+    """Mean over a (2r+1)x(2r+1) window, with edge padding, via summed areas"""
+    padded = np.pad(x, r, mode='edge').astype(np.float64)
+    window = 2 * r + 1
+    c = np.cumsum(padded, axis=0)
+    c = np.vstack([np.zeros((1, c.shape[1])), c])
+    rows = c[window:] - c[:-window]
+    c = np.cumsum(rows, axis=1)
+    c = np.hstack([np.zeros((c.shape[0], 1)), c])
+    return ((c[:, window:] - c[:, :-window]) / (window * window)).astype(np.float32)
+
+
+def _grayscale(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert('L'), dtype=np.float32) / 255.0
+
+
+def guided_coefficients(mask: np.ndarray, guide: Image.Image, radius: int,
+                        eps: float = 1e-3) -> Tuple[Image.Image, Image.Image]:
+    """Fit the guided filter's linear coefficients (a, b) at guide's resolution"""
+    guide_gray = _grayscale(guide)
+    mean_i = _box_filter(guide_gray, radius)
+    mean_p = _box_filter(mask, radius)
+    cov_ip = _box_filter(guide_gray * mask, radius) - mean_i * mean_p
+    var_i = _box_filter(guide_gray * guide_gray, radius) - mean_i * mean_i
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+    return Image.fromarray(_box_filter(a, radius)), Image.fromarray(_box_filter(b, radius))
+
+
+def guided_upsample(mask: np.ndarray, guide: Image.Image, rgb: np.ndarray,
+                    radius: int, out: np.ndarray, eps: float = 1e-3) -> np.ndarray:
+    """Upsample a 0..1 mask into out, snapping its edges to those of rgb.
+
+    Fast guided filter: the linear coefficients relating mask to guide are
+    fitted at the guide's (reduced) resolution, then bilinearly upsampled and
+    applied to the full-resolution luminance of rgb a chunk of rows at a time
+    (apply_guided). out is the full-size uint8 mask; no full-size float array
+    is allocated.
+    """
+    coefficient_a, coefficient_b = guided_coefficients(mask, guide, radius, eps)
+    return apply_guided(np.asarray(coefficient_a), np.asarray(coefficient_b), rgb, out)
+
+
+def bounding_box(mask: np.ndarray, full_size: Tuple[int, int]) -> dict:
+    """Bounding box of the foreground in a mask, in full_size coordinates.
+
+    crop is the (left, top, right, bottom) box to pass to an image crop;
+    bbox is null when nothing in the image counts as foreground.
+    """
+    foreground = np.asarray(mask) >= MASK_THRESHOLD
+    result = {
+        "width": full_size[0],
+        "height": full_size[1],
+        "coverage": float(foreground.mean()) if foreground.size else 0.0,
+        "bbox": None,
+        "crop": None,
+    }
+    rows = np.flatnonzero(foreground.any(axis=1))
+    cols = np.flatnonzero(foreground.any(axis=0))
+    if rows.size == 0:
+        return result
+
+    # The mask may be a reduced view of the image
+    mask_height, mask_width = foreground.shape
+    scale_x = full_size[0] / mask_width
+    scale_y = full_size[1] / mask_height
+    left = int(math.floor(cols[0] * scale_x))
+    top = int(math.floor(rows[0] * scale_y))
+    right = min(full_size[0], int(math.ceil((cols[-1] + 1) * scale_x)))
+    bottom = min(full_size[1], int(math.ceil((rows[-1] + 1) * scale_y)))
+    result["bbox"] = {"x": left, "y": top, "width": right - left, "height": bottom - top}
+    result["crop"] = [left, top, right, bottom]
+    return result
+
+
+def refine_mask(mask: np.ndarray, options: ProcessingOptions) -> np.ndarray:
+    """Threshold, then smooth, a full-resolution mask in place as requested"""
+    if options.mask_threshold is not None:
+        threshold_mask(mask, options.mask_threshold)
+    if options.mask_smooth:
+        smooth_mask(mask, options.mask_smooth)
+    return mask
+
+
+def _limit_to_source_alpha(mask: np.ndarray, source: np.ndarray) -> np.ndarray:
+    """Keep pixels that were transparent in the upload transparent in the output"""
+    if source.ndim == 3 and source.shape[2] == 4:
+        np.minimum(mask, source[..., 3], out=mask)
+    return mask
+
+
+def load_background(background: Optional[bytes], options: ProcessingOptions):
+    """What cutouts are composited over: an (r, g, b) colour, an RGB image or None.
+
+    background is the uploaded background image, required when
+    options.background_image is set.
+    """
+    if options.background_color:
+        return parse_color(options.background_color)
+    if options.background_image:
+        if background is None:
+            raise ValueError("The background image was not passed along with its options")
+        return decode_image(background).convert('RGB')
+    return None
+
+
+def _as_image(pixels: np.ndarray, mode: str) -> Image.Image:
+    """A read-only image over a pooled buffer, without copying it"""
+    return Image.frombuffer(mode, (pixels.shape[1], pixels.shape[0]), pixels, 'raw', mode, 0, 1)
+
+
+def finish_cutout(file_content: bytes, prepared: PreparedImage, pred: np.ndarray,
+                  options: ProcessingOptions, background: Optional[bytes] = None):
+    """Turn a predicted mask into the requested output.
+
+    cutout  scale the mask to the image, cut out the foreground and encode it,
+            transparent or over the requested background
+    mask    the scaled mask alone, as a grayscale or 1-bit PNG
+    bbox    JSON bounding box of the foreground, without decoding the full image
+
+    Apart from the decoded image itself, every full-size array is borrowed
+    from the post-processing buffer pool.
+    Returns (data, media_type, timings).
+    """
+    timings = {}
+    start_time = time.time()
+    view = prepared.view
+
+    if options.mode == 'bbox':
+        with pool.borrow((view.height, view.width)) as mask:
+            resize_mask(pred, mask)
+            if view.mode == 'RGBA':
+                np.minimum(mask, np.asarray(view.getchannel('A')), out=mask)
+            data = json.dumps(bounding_box(mask, prepared.full_size)).encode()
+        timings['postprocess'] = time.time() - start_time
+        return data, 'application/json', timings
+
+    if prepared.strips:
+        return finish_in_strips(file_content, prepared, pred, options, background, timings)
+
+    under = load_background(background, options)
+    if prepared.reduced:
+        # Only now pay for the full-resolution decode
+        full = decode_image(file_content)
+        full.load()
+        timings['decode'] = time.time() - start_time
+        start_time = time.time()
+    else:
+        full = view
+
+    png_compression = options.png_compression
+    if png_compression is None:
+        png_compression = config.PNG_COMPRESS_LEVEL
+
+    width, height = full.size
+    source = np.asarray(full)
+    with pool.borrow((height, width)) as mask:
+        if prepared.reduced:
+            with pool.borrow((view.height, view.width)) as view_mask:
+                resize_mask(pred, view_mask)
+                radius = max(1, max(view.size) // 128)
+                guided_upsample(view_mask / np.float32(255), view, source, radius, mask)
+        else:
+            resize_mask(pred, mask)
+        if options.edge_refine != 'off':
+            refine_start = time.time()
+            source = refine_edges(mask, source, options.edge_refine)
+            timings['refine'] = time.time() - refine_start
+            start_time += timings['refine']
+        refine_mask(mask, options)
+        _limit_to_source_alpha(mask, source)
+
+        if options.mode == 'mask':
+            timings['postprocess'] = time.time() - start_time
+            start_time = time.time()
+            data, media_type = encode_mask(
+                _as_image(mask, 'L'), options.mask_bits, MASK_THRESHOLD, png_compression
+            )
+            timings['encode'] = time.time() - start_time
+            return data, media_type, timings
+
+        # Over a background the result is opaque
+        mode = 'RGBA' if under is None else 'RGB'
+        with pool.borrow((height, width, len(mode))) as cutout:
+            if isinstance(under, Image.Image):
+                under = cover_rows(under, full.size, 0, height)
+            apply_alpha(source, mask, cutout, under)
+            timings['composite'] = time.time() - start_time
+
+            start_time = time.time()
+            data, media_type = encode_image(
+                _as_image(cutout, mode), options.output_format, options.quality, png_compression
+            )
+            timings['encode'] = time.time() - start_time
+    return data, media_type, timings
+
+
+def finish_in_strips(file_content: bytes, prepared: PreparedImage, pred: np.ndarray,
+                     options: ProcessingOptions, background: Optional[bytes],
+                     timings: Dict[str, float]):
+    """finish_cutout for images over the memory ceiling, a strip of rows at a time.
+
+    The guided filter's coefficients are upsampled per strip with the same
+    code as the whole image's, so the output does not depend on whether the
+    image was processed in strips, and each strip
+    is cut out into the same buffer and handed to the streaming PNG encoder,
+    so only the decoded image and the encoded output are ever full size.
+    Smoothing reads mask_smooth rows past either end of each strip, so
+    strips join seamlessly.
+    """
+    start_time = time.time()
+    full = decode_image(file_content)
+    full.load()
+    timings['decode'] = time.time() - start_time
+
+    start_time = time.time()
+    view = prepared.view
+    under = load_background(background, options)
+    with pool.borrow((view.height, view.width)) as view_mask:
+        resize_mask(pred, view_mask)
+        radius = max(1, max(view.size) // 128)
+        coefficient_a, coefficient_b = (
+            np.asarray(coefficient) for coefficient in guided_coefficients(
+                view_mask / np.float32(255), view, radius
+            )
+        )
+
+    png_compression = options.png_compression
+    if png_compression is None:
+        png_compression = config.PNG_COMPRESS_LEVEL
+    if options.mode == 'mask':
+        mode = '1' if options.mask_bits == 1 else 'L'
+    else:
+        mode = 'RGBA' if under is None else 'RGB'
+    writer = tiling.PNGStripWriter(full.size, mode, png_compression)
+
+    width, height = full.size
+    rows = tiling.strip_height(width)
+    overlap = options.mask_smooth
+    encode_time = 0.0
+    with pool.borrow((rows, width, len(mode))) as buffer, \
+            pool.borrow((rows + 2 * overlap, width)) as mask_rows:
+        for top in range(0, height, rows):
+            bottom = min(height, top + rows)
+            context_top = max(0, top - overlap)
+            context_bottom = min(height, bottom + overlap)
+            block = np.asarray(full.crop((0, context_top, width, context_bottom)))
+            # The same interpolation as finish_cutout's, so the rows come out
+            # as they would from the whole image
+            block_mask = apply_guided(
+                coefficient_a, coefficient_b, block, mask_rows[:context_bottom - context_top],
+                context_top, height,
+            )
+            refine_mask(block_mask, options)
+            strip_mask = block_mask[top - context_top:bottom - context_top]
+            source = block[top - context_top:bottom - context_top]
+            _limit_to_source_alpha(strip_mask, source)
+
+            if options.mode == 'mask':
+                rows_out = strip_mask >= MASK_THRESHOLD if options.mask_bits == 1 else strip_mask
+            else:
+                strip_under = under
+                if isinstance(under, Image.Image):
+                    strip_under = cover_rows(under, full.size, top, bottom)
+                rows_out = apply_alpha(source, strip_mask, buffer[:bottom - top], strip_under)
+            encode_start = time.time()
+            writer.write(rows_out)
+            encode_time += time.time() - encode_start
+
+    encode_start = time.time()
+    data = writer.finish()
+    encode_time += time.time() - encode_start
+    timings['composite' if options.mode == 'cutout' else 'postprocess'] = (
+        time.time() - start_time - encode_time
+    )
+    timings['encode'] = encode_time
+    return data, 'image/png', timings
@@ -0,0 +1,204 @@
+"""
+Profiling of single requests.
+
+A profiled request runs its stages one after another on a single worker,
+under cProfile, with a dedicated ONNX Runtime session that has the runtime's
+profiler enabled. Each profile is a directory in PROFILE_DIR holding:
+
+    summary.json      stage timings, image size and the top functions
+    cprofile.prof     the raw cProfile data, for pstats or snakeviz
+    cprofile.txt      the cProfile report sorted by cumulative time
+    onnxruntime.json  the ONNX Runtime trace, for chrome://tracing or Perfetto
+
+Admins request one per call; slow requests can be re-run under the profiler
+in the background (SlowRequestSampler), so a pathological image is caught
+without anyone having to reproduce it.
+"""
+
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import shutil
+import time
+import uuid
+from dataclasses import asdict
+from typing import List, Optional
+
+from animation import PreparedAnimation, finish_animation, prepare_upload
+from model_registry import create_session, registry, session_options
+from processing import ProcessingOptions, finish_cutout, predict_batch
+
+logger = logging.getLogger(__name__)
+
+# Functions listed in summary.json
+TOP_FUNCTIONS = 25
+
+
+def new_profile_id() -> str:
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def profile_image(file_content: bytes, options: ProcessingOptions, profile_dir: str,
+                  profile_id: str, trigger: str = 'request', background: Optional[bytes] = None):
+    """Process an image under cProfile and the ONNX Runtime profiler.
+
+    Runs on an executor worker and takes the same path as the pipeline:
+    prepare_upload picks animation or still image (the still path also
+    decides on strips and enforces the per-request memory ceiling), and the
+    matching finish step produces the output. Returns (data, media_type,
+    timings, frame_count, inferred_frames), after writing the profile to
+    profile_dir/profile_id.
+    """
+    directory = os.path.join(profile_dir, profile_id)
+    os.makedirs(directory, exist_ok=True)
+
+    # The profiling session is built outside the profile; its creation is not
+    # what is being diagnosed
+    sess_opts = session_options()
+    sess_opts.enable_profiling = True
+    sess_opts.profile_file_prefix = os.path.join(directory, 'onnxruntime')
+    kwargs = {"providers": registry.default_providers} if registry.default_providers else {}
+    session = create_session(options.model, sess_opts, **kwargs)
+
+    profiler = cProfile.Profile()
+    start_time = time.time()
+    profiler.enable()
+    try:
+        prepared = prepare_upload(file_content, options)
+        if isinstance(prepared, PreparedAnimation):
+            keyframes = prepared.keyframes
+            inference_start = time.time()
+            masks = predict_batch(
+                options.model, [prepared.model_inputs[index] for index in keyframes], session=session
+            )
+            inference_time = time.time() - inference_start
+            prepared.model_inputs = {}
+            data, media_type, finish_timings = finish_animation(
+                prepared, dict(zip(keyframes, masks)), options, background
+            )
+            frame_count, inferred_frames = len(prepared.frames), len(keyframes)
+        else:
+            inference_start = time.time()
+            mask = predict_batch(options.model, [prepared.model_input], session=session)[0]
+            inference_time = time.time() - inference_start
+            prepared.model_input = None
+            data, media_type, finish_timings = finish_cutout(
+                file_content, prepared, mask, options, background
+            )
+            frame_count, inferred_frames = 1, 1
+    finally:
+        profiler.disable()
+        trace_path = session.inner_session.end_profiling()
+    total_time = time.time() - start_time
+
+    if trace_path and os.path.exists(trace_path):
+        os.replace(trace_path, os.path.join(directory, 'onnxruntime.json'))
+    profiler.dump_stats(os.path.join(directory, 'cprofile.prof'))
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats()
+    with open(os.path.join(directory, 'cprofile.txt'), 'w') as f:
+        f.write(report.getvalue())
+
+    timings = {**prepared.timings, 'inference': inference_time, **finish_timings}
+    stats = pstats.Stats(profiler)
+    top_functions = [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "total_time": total,
+            "cumulative_time": cumulative,
+        }
+        for (filename, line, name), (_, calls, total, cumulative, _) in sorted(
+            stats.stats.items(), key=lambda item: item[1][3], reverse=True
+        )[:TOP_FUNCTIONS]
+    ]
+    summary = {
+        "id": profile_id,
+        "trigger": trigger,
+        "created_at": time.time(),
+        "options": asdict(options),
+        "input_size": len(file_content),
+        "image_size": list(prepared.full_size),
+        "frame_count": frame_count,
+        "inferred_frames": inferred_frames,
+        "output_size": len(data),
+        "total_time": total_time,
+        "timings": timings,
+        "top_functions": top_functions,
+        "files": sorted(os.listdir(directory)) + ['summary.json'],
+    }
+    with open(os.path.join(directory, 'summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return data, media_type, timings, frame_count, inferred_frames
+
+
+def list_profiles(profile_dir: str) -> List[dict]:
+    """Summaries of the stored profiles, newest first, without their function lists"""
+    profiles = []
+    if not os.path.isdir(profile_dir):
+        return profiles
+    for profile_id in os.listdir(profile_dir):
+        summary = read_summary(profile_dir, profile_id)
+        if summary is not None:
+            summary.pop('top_functions', None)
+            profiles.append(summary)
+    return sorted(profiles, key=lambda summary: summary['created_at'], reverse=True)
+
+
+def read_summary(profile_dir: str, profile_id: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(profile_dir, profile_id, 'summary.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def profile_file(profile_dir: str, profile_id: str, name: str) -> Optional[str]:
+    """Path of a file of a stored profile, None for anything outside it"""
+    if os.sep in profile_id or os.sep in name or name.startswith('.') or profile_id.startswith('.'):
+        return None
+    path = os.path.join(profile_dir, profile_id, name)
+    return path if os.path.isfile(path) else None
+
+
+def prune_profiles(profile_dir: str, max_count: int):
+    """Delete the oldest profiles beyond max_count"""
+    if not os.path.isdir(profile_dir):
+        return
+    directories = sorted(
+        (entry for entry in os.scandir(profile_dir) if entry.is_dir()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    for entry in directories[:max(len(directories) - max_count, 0)]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+class SlowRequestSampler:
+    """Decides which slow requests get re-run under the profiler.
+
+    At most one profile runs at a time and at most one is started per
+    interval, so a burst of slow requests (usually an overloaded server) does
+    not add profiling work on top.
+    """
+
+    def __init__(self, threshold: float, interval: float):
+        self.threshold = threshold
+        self.interval = interval
+        self.running = False
+        self._last_started = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    def should_sample(self, elapsed: float) -> bool:
+        if not self.enabled or self.running or elapsed < self.threshold:
+            return False
+        now = time.time()
+        if now - self._last_started < self.interval:
+            return False
+        self._last_started = now
+        return True
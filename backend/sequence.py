@@ -0,0 +1,456 @@
+"""
+Background removal for video frame sequences.
+
+A sequence is a zip or tar archive of frames, processed in the natural order
+of their names (frame2 before frame10). Frames go through the shared
+pipeline's executor and micro-batcher SEQUENCE_CONCURRENCY at a time, so the
+keyframes in flight are run as batches. Masks are handed on from frame to
+frame in order:
+
+    reuse      a frame that barely differs from the last keyframe uses its
+               mask, as frames of animations do (FRAME_REUSE_THRESHOLD)
+    smoothing  a keyframe's predicted mask is blended with the previous
+               keyframe's, which cuts the flicker of masks predicted frame
+               by frame; a scene cut or a change of size starts afresh
+
+Results come back as a tar of the processed frames, streamed as each frame
+is done with manifest.json last, or as an animated WebP whose frames are
+encoded as they come and spooled until the container's header, which holds
+the total size, can be written. Either way only the frames in flight are
+held in memory, however long the sequence.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import struct
+import tarfile
+import tempfile
+import time
+import zipfile
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import UnidentifiedImageError
+
+import config
+from animation import frame_thumbnail
+from bulk import QUEUE_FULL_RETRIES, output_name
+from encoding import file_extension
+from inference import QueueFullError
+from pipeline import BackgroundRemovalPipeline
+from processing import ProcessingOptions, finish_cutout, prepare_image
+from uploads import InvalidImageError, check_image_content
+
+logger = logging.getLogger(__name__)
+
+# Output formats the frames of an animated WebP can be encoded in
+WEBP_FORMATS = ('webp', 'webp-lossless')
+
+# Encoded WebP frames are kept in memory up to this size, then on disk
+WEBP_SPOOL_BYTES = 16 * 1024 * 1024
+
+# Read size when streaming the spooled WebP out
+CHUNK_SIZE = 1024 * 1024
+
+TAR_BLOCK_SIZE = 512
+
+
+class SequenceInputError(ValueError):
+    """The sequence or one of its frames is unusable (bad archive, too many frames...)"""
+
+
+def natural_key(name: str):
+    """Sort key putting frame2 before frame10"""
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+class FrameArchive:
+    """The frames of an uploaded zip or tar archive, in natural name order.
+
+    Only the listing is read up front; each frame is read when its turn
+    comes. Directories, macOS resource forks and hidden files are skipped.
+    The archive owns fileobj and closes it.
+    """
+
+    def __init__(self, fileobj, max_frames: int, max_frame_size: int):
+        self.max_frame_size = max_frame_size
+        self._fileobj = fileobj
+        fileobj.seek(0)
+        try:
+            if zipfile.is_zipfile(fileobj):
+                fileobj.seek(0)
+                self._archive = zipfile.ZipFile(fileobj)
+                members = [
+                    (info.filename, info.file_size, info)
+                    for info in self._archive.infolist() if not info.is_dir()
+                ]
+            else:
+                fileobj.seek(0)
+                # r:* also takes gzip, bzip2 and xz compressed tars
+                self._archive = tarfile.open(fileobj=fileobj, mode='r:*')
+                members = [
+                    (member.name, member.size, member)
+                    for member in self._archive.getmembers() if member.isfile()
+                ]
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, zlib.error):
+            raise SequenceInputError("Uploaded archive is not a valid zip or tar file")
+
+        members = [
+            member for member in members
+            if not member[0].startswith('__MACOSX/')
+            and not os.path.basename(member[0]).startswith('.')
+        ]
+        if len(members) > max_frames:
+            raise SequenceInputError(f"Archive contains {len(members)} frames, the limit is {max_frames}")
+        if not members:
+            raise SequenceInputError("No frames found in the archive")
+        self._members = sorted(members, key=lambda member: natural_key(member[0]))
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _, _ in self._members]
+
+    def read(self, index: int) -> bytes:
+        """Contents of a frame; declared sizes are checked before anything is decompressed"""
+        name, size, member = self._members[index]
+        if size > self.max_frame_size:
+            raise SequenceInputError(f"{name} exceeds the {self.max_frame_size // (1024 * 1024)}MB limit")
+        try:
+            if isinstance(self._archive, zipfile.ZipFile):
+                return self._archive.read(member)
+            return self._archive.extractfile(member).read()
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError, OSError, zlib.error) as e:
+            raise SequenceInputError(f"Could not read {name} from the archive: {e}")
+
+    def close(self):
+        self._archive.close()
+        self._fileobj.close()
+
+
+def prepare_frame(file_content: bytes, options: ProcessingOptions):
+    """prepare_image, plus the thumbnail the frame is compared to its neighbours on"""
+    prepared = prepare_image(file_content, options)
+    return prepared, frame_thumbnail(prepared.view)
+
+
+@dataclass
+class _Keyframe:
+    """The last frame that went through the model, as the frames after it see it"""
+    index: int
+    size: Tuple[int, int]
+    thumbnail: np.ndarray
+    mask: asyncio.Future  # its smoothed 0..1 prediction
+
+
+@dataclass
+class FrameResult:
+    index: int
+    name: str
+    data: Optional[bytes] = None
+    media_type: Optional[str] = None
+    size: Optional[Tuple[int, int]] = None
+    # Index of the frame whose mask this frame used
+    mask_source: Optional[int] = None
+    timings: Dict[str, float] = field(default_factory=dict)
+    error: Optional[Exception] = None
+
+    def describe(self) -> dict:
+        """The frame's manifest entry"""
+        entry = {"file": self.name, "success": self.error is None}
+        if self.error is not None:
+            entry["error"] = "Not a valid image" if isinstance(self.error, UnidentifiedImageError) else str(self.error)
+            return entry
+        entry.update({
+            "processed_size": len(self.data),
+            "mask_source": self.mask_source,
+            "timings": self.timings,
+        })
+        return entry
+
+
+async def _retrying(call):
+    """Await call(), retrying while the inference queue is full"""
+    for attempt in range(QUEUE_FULL_RETRIES + 1):
+        try:
+            return await call()
+        except QueueFullError as e:
+            if attempt == QUEUE_FULL_RETRIES:
+                raise
+            await asyncio.sleep(e.retry_after)
+
+
+class SequenceProcessor:
+    """Runs the frames of one sequence through the pipeline, in order"""
+
+    def __init__(self, pipeline: BackgroundRemovalPipeline, options: ProcessingOptions,
+                 smoothing: float, concurrency: int):
+        self.executor = pipeline.executor
+        self.batcher = pipeline.batcher
+        self.options = options
+        self.smoothing = smoothing
+        self.concurrency = max(1, concurrency)
+        self.inferred_frames = 0
+        self._predictions = set()
+
+    async def _run(self, fn, *args):
+        result, _ = await _retrying(lambda: self.executor.run(fn, *args))
+        return result
+
+    async def _predict(self, model_input, previous: Optional[asyncio.Future]) -> np.ndarray:
+        """A keyframe's predicted mask, blended with the previous keyframe's"""
+        mask, _, _ = await _retrying(lambda: self.batcher.predict(self.options.model, model_input))
+        if previous is None or not self.smoothing:
+            return mask
+        try:
+            earlier = await previous
+        except Exception:
+            # The previous keyframe failed; start afresh
+            return mask
+        if earlier.shape != mask.shape:
+            return mask
+        return (earlier * self.smoothing + mask * (1 - self.smoothing)).astype(np.float32)
+
+    async def _frame(self, index: int, name: str, content, incoming: asyncio.Future,
+                     outgoing: asyncio.Future) -> FrameResult:
+        """Process one frame. incoming resolves to the last keyframe before it,
+        outgoing to the last keyframe up to and including it."""
+        result = FrameResult(index=index, name=name)
+        try:
+            if isinstance(content, Exception):
+                raise content
+            # The same magic-byte and header checks single uploads get
+            try:
+                check_image_content(content)
+            except InvalidImageError as e:
+                raise SequenceInputError(f"{name}: {e}")
+            prepared, thumbnail = await self._run(prepare_frame, content, self.options)
+            result.size = prepared.full_size
+
+            keyframe = await incoming
+            difference = None
+            if keyframe is not None and keyframe.size == prepared.full_size:
+                difference = float(np.abs(thumbnail - keyframe.thumbnail).mean())
+            if difference is not None and difference < config.FRAME_REUSE_THRESHOLD:
+                mask = keyframe.mask
+                result.mask_source = keyframe.index
+                outgoing.set_result(keyframe)
+            else:
+                same_scene = difference is not None and difference < config.SEQUENCE_SCENE_CUT_THRESHOLD
+                mask = asyncio.ensure_future(
+                    self._predict(prepared.model_input, keyframe.mask if same_scene else None)
+                )
+                self._predictions.add(mask)
+                mask.add_done_callback(self._predictions.discard)
+                self.inferred_frames += 1
+                result.mask_source = index
+                outgoing.set_result(_Keyframe(index, prepared.full_size, thumbnail, mask))
+
+            inference_start = time.time()
+            pred = await mask
+            result.timings = {**prepared.timings, 'inference': time.time() - inference_start}
+            prepared.model_input = None
+            result.data, result.media_type, finish_timings = await self._run(
+                finish_cutout, content, prepared, pred, self.options
+            )
+            result.timings.update(finish_timings)
+        except Exception as e:
+            logger.warning(f"Sequence frame {name} failed: {e}")
+            result.error = e
+            if not outgoing.done():
+                # Later frames carry on from the last good keyframe
+                outgoing.set_result(await incoming)
+        finally:
+            if not outgoing.done():
+                outgoing.cancel()
+        return result
+
+    async def results(self, archive: FrameArchive) -> AsyncIterator[FrameResult]:
+        """Process the archive's frames, yielding their results in order"""
+        incoming = asyncio.get_running_loop().create_future()
+        incoming.set_result(None)
+        pending = deque()
+        try:
+            for index, name in enumerate(archive.names):
+                try:
+                    # One reader at a time, in order, on the shared archive
+                    content = await asyncio.to_thread(archive.read, index)
+                except SequenceInputError as e:
+                    content = e
+                outgoing = asyncio.get_running_loop().create_future()
+                pending.append(asyncio.ensure_future(self._frame(index, name, content, incoming, outgoing)))
+                incoming = outgoing
+                if len(pending) >= self.concurrency:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            # Client went away or the caller gave up: stop the remaining work
+            for task in list(pending) + list(self._predictions):
+                task.cancel()
+
+    def summary(self, frames: List[dict], elapsed: float) -> dict:
+        succeeded = sum(1 for entry in frames if entry["success"])
+        return {
+            "total": len(frames),
+            "succeeded": succeeded,
+            "failed": len(frames) - succeeded,
+            "inferred_frames": self.inferred_frames,
+            "elapsed": elapsed,
+            "frames": frames,
+        }
+
+
+def tar_entry(name: str, data: bytes) -> bytes:
+    """A tar member: its header, its data and the padding to a whole block"""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT) + data + b'\0' * (-len(data) % TAR_BLOCK_SIZE)
+
+
+async def stream_tar(processor: SequenceProcessor, archive: FrameArchive) -> AsyncIterator[bytes]:
+    """Process a sequence and yield a tar of its frames as they are done.
+
+    Frames that fail are left out and reported in manifest.json, the last
+    member, so one bad frame never fails the whole sequence.
+    """
+    start_time = time.time()
+    frames = []
+    used_names = {'manifest.json'}
+    results = processor.results(archive)
+    try:
+        async for result in results:
+            entry = result.describe()
+            if result.error is None:
+                entry["output"] = output_name(result.name, used_names, file_extension(result.media_type))
+                yield tar_entry(entry["output"], result.data)
+            frames.append(entry)
+
+        summary = processor.summary(frames, time.time() - start_time)
+        # The end of the archive is two empty blocks
+        yield tar_entry('manifest.json', json.dumps(summary, indent=2).encode()) + b'\0' * (2 * TAR_BLOCK_SIZE)
+    finally:
+        await results.aclose()
+        archive.close()
+
+
+def _riff_chunk(kind: bytes, payload: bytes) -> bytes:
+    return kind + struct.pack('<I', len(payload)) + payload + b'\0' * (len(payload) & 1)
+
+
+def _webp_chunks(data: bytes):
+    """(kind, payload) of each chunk of a still WebP file"""
+    if data[:4] != b'RIFF' or data[8:12] != b'WEBP':
+        raise ValueError("Frame was not encoded as WebP")
+    position = 12
+    while position + 8 <= len(data):
+        kind = data[position:position + 4]
+        (size,) = struct.unpack('<I', data[position + 4:position + 8])
+        yield kind, data[position + 8:position + 8 + size]
+        position += 8 + size + (size & 1)
+
+
+class WebPAnimationWriter:
+    """Assemble an animated WebP from still WebP frames as they come.
+
+    Each frame's bitstream (its ALPH and VP8 or VP8L chunks) is wrapped in
+    an ANMF chunk that replaces the whole canvas and is spooled, to disk once
+    it outgrows WEBP_SPOOL_BYTES; the RIFF header needs the total size, so
+    the file can only be read back once the last frame is in.
+    """
+
+    def __init__(self, duration: int, loop: int = 0, alpha: bool = True):
+        self.duration = duration
+        self.loop = loop
+        self.alpha = alpha
+        self.size = None
+        self.frame_count = 0
+        self._frames_length = 0
+        self._spool = tempfile.SpooledTemporaryFile(WEBP_SPOOL_BYTES)
+
+    def add(self, data: bytes, size: Tuple[int, int]):
+        if self.size is None:
+            self.size = size
+        elif size != self.size:
+            raise SequenceInputError(
+                f"Frames of an animated WebP must all be {self.size[0]}x{self.size[1]}, "
+                f"not {size[0]}x{size[1]}"
+            )
+        width, height = size
+        # Placed at the origin, not blended with the frame before, not disposed
+        payload = [
+            (0).to_bytes(3, 'little'), (0).to_bytes(3, 'little'),
+            (width - 1).to_bytes(3, 'little'), (height - 1).to_bytes(3, 'little'),
+            self.duration.to_bytes(3, 'little'), bytes([0b10]),
+        ]
+        for kind, chunk in _webp_chunks(data):
+            if kind in (b'ALPH', b'VP8 ', b'VP8L'):
+                payload.append(_riff_chunk(kind, chunk))
+        frame = _riff_chunk(b'ANMF', b''.join(payload))
+        self._spool.write(frame)
+        self._frames_length += len(frame)
+        self.frame_count += 1
+
+    def header(self) -> bytes:
+        width, height = self.size
+        flags = 0b10 | (0b10000 if self.alpha else 0)  # animation, alpha
+        vp8x = _riff_chunk(
+            b'VP8X',
+            bytes([flags, 0, 0, 0]) + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little'),
+        )
+        # Transparent background colour, then the loop count
+        anim = _riff_chunk(b'ANIM', struct.pack('<IH', 0, self.loop))
+        body = b'WEBP' + vp8x + anim
+        return b'RIFF' + struct.pack('<I', len(body) + self._frames_length) + body
+
+    @property
+    def length(self) -> int:
+        """Size of the whole file"""
+        return len(self.header()) + self._frames_length
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """Yield the file, then release the spool"""
+        try:
+            yield self.header()
+            self._spool.seek(0)
+            while True:
+                chunk = await asyncio.to_thread(self._spool.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.close()
+
+    def close(self):
+        self._spool.close()
+
+
+async def write_webp(processor: SequenceProcessor, archive: FrameArchive,
+                     duration: int) -> WebPAnimationWriter:
+    """Process a sequence into an animated WebP, failing on the first bad frame"""
+    writer = WebPAnimationWriter(duration, alpha=processor.options.background_color is None)
+    results = processor.results(archive)
+    try:
+        async for result in results:
+            if isinstance(result.error, UnidentifiedImageError):
+                raise SequenceInputError(f"{result.name} is not a valid image")
+            if result.error is not None:
+                raise result.error
+            writer.add(result.data, result.size)
+    except BaseException:
+        writer.close()
+        raise
+    finally:
+        await results.aclose()
+        archive.close()
+    return writer
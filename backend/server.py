@@ -1,22 +1,52 @@
-from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Response
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, APIRouter, File, UploadFile, HTTPException, Response, Query, Request
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import uri_parser
+import asyncio
+import hmac
 import os
+import shutil
+import tempfile
+import time
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List
+from typing import List, Optional
 import uuid
 from datetime import datetime
-import io
-from rembg import remove
-from PIL import Image
+import base64
+import hashlib
+import json
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Project modules read their settings from the environment, so import them
+# after .env has been loaded
+import config
+from model_registry import preload_before_fork, registry
+from inference import InferenceExecutor, QueueFullError
+from batching import BatchStats, MicroBatcher
+from pipeline import BackgroundRemovalPipeline, PipelineResult
+from cache import ResultCache
+from encoding import OUTPUT_FORMATS, available_formats, file_extension, negotiate_output_format
+from processing import ImageTooLargeError, ProcessingOptions
+from bulk import BulkInputError, UploadedFiles, ZipEntries, is_zip, stream_bulk_zip
+from storage import ObjectStore, StorageAccessError, StorageInputError, plan_objects, process_objects
+from sequence import (
+    WEBP_FORMATS, FrameArchive, SequenceInputError, SequenceProcessor, stream_tar, write_webp,
+)
+from jobs import Job, JobManager, JobQueueFullError, MemoryJobStore, MongoJobStore
+from uploads import CHUNK_SIZE, MEDIA_TYPES, MULTIPART_OVERHEAD, UploadLimitMiddleware, read_image_upload
+from warmup import Readiness, parse_sizes, warm_up
+from metrics import observe_endpoint, render_metrics
+from profiling import (
+    SlowRequestSampler, list_profiles, new_profile_id, profile_file, profile_image,
+    prune_profiles, read_summary,
+)
+
 # Configure logging first
 logging.basicConfig(
     level=logging.INFO,
@@ -24,20 +54,90 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# MongoDB connection (optional - only for status endpoints)
+# MongoDB connection (optional - only for status endpoints and the mongo job
+# store). The client itself is created in each worker's startup hook
+# (connect_mongodb): under gunicorn --preload this module runs in the master,
+# and pymongo's sockets and monitor threads do not survive the fork. Only the
+# URL is checked here, so the job store can be chosen.
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
 db_name = os.environ.get('DB_NAME', 'background_removal_db')
+client = None
+db = None
 
 try:
-    client = AsyncIOMotorClient(mongo_url)
-    db = client[db_name]
+    uri_parser.parse_uri(mongo_url)
     MONGODB_AVAILABLE = True
-    logger.info(f"Connected to MongoDB at {mongo_url}")
 except Exception as e:
     logger.warning(f"MongoDB connection failed: {e}. Status endpoints will be disabled.")
     MONGODB_AVAILABLE = False
-    client = None
-    db = None
+
+# Under gunicorn --preload this runs in the master before it forks, so the
+# workers share one copy of the model weights. Process pool workers are
+# spawned and load their own.
+if config.SHARE_MODEL_WEIGHTS and config.INFERENCE_EXECUTOR == 'thread':
+    preload_before_fork(config.PRELOAD_MODELS)
+
+# Inference runs on a bounded pool so the event loop stays responsive
+inference_executor = InferenceExecutor(
+    kind=config.INFERENCE_EXECUTOR,
+    max_workers=config.INFERENCE_WORKERS,
+    max_queue=config.INFERENCE_QUEUE_SIZE,
+    preload_models=config.PRELOAD_MODELS,
+)
+
+# Concurrent requests share batched model runs
+batcher = MicroBatcher(
+    inference_executor,
+    max_batch_size=config.BATCH_MAX_SIZE,
+    max_wait_ms=config.BATCH_MAX_WAIT_MS,
+)
+
+# Repeated uploads are served from the result cache without decoding
+result_cache = ResultCache(
+    memory_bytes=config.RESULT_CACHE_MEMORY_BYTES,
+    disk_dir=config.RESULT_CACHE_DIR,
+    disk_bytes=config.RESULT_CACHE_DISK_BYTES,
+)
+pipeline = BackgroundRemovalPipeline(inference_executor, batcher, result_cache)
+
+# Asynchronous jobs, shared through MongoDB when configured
+if config.JOB_BACKEND == 'mongo' and MONGODB_AVAILABLE:
+    # Attached to this worker's database in connect_mongodb
+    job_store = MongoJobStore()
+else:
+    # Polls reaching a worker other than the job's would get 404
+    if int(os.environ.get('WEB_CONCURRENCY', '1')) > 1:
+        raise RuntimeError(
+            "The in-memory job store only works with one worker: set JOB_BACKEND=mongo "
+            "(with MONGO_URL) or WEB_CONCURRENCY=1"
+        )
+    job_store = MemoryJobStore()
+job_manager = JobManager(
+    job_store,
+    pipeline,
+    workers=config.JOB_WORKERS,
+    max_queue=config.JOB_QUEUE_SIZE,
+    ttl_seconds=config.JOB_RESULT_TTL,
+)
+
+# Images fetched from and written back to object storage, through one pooled
+# client per worker
+object_store = ObjectStore(
+    config.S3_BUCKETS,
+    endpoint_url=config.S3_ENDPOINT_URL,
+    region=config.S3_REGION,
+    access_key_id=config.S3_ACCESS_KEY_ID,
+    secret_access_key=config.S3_SECRET_ACCESS_KEY,
+    max_connections=config.S3_MAX_POOL_CONNECTIONS,
+)
+
+# Slow requests re-run under the profiler in the background
+profile_sampler = SlowRequestSampler(config.PROFILE_SLOW_REQUEST_SECONDS, config.PROFILE_SLOW_INTERVAL)
+background_tasks = set()
+
+# Reported by /api/ready once the preloaded models are warmed up
+readiness = Readiness()
+warmup_task = None
 
 # Create the main app without a prefix
 app = FastAPI(title="Background Removal API")
@@ -60,11 +160,41 @@ class ImageProcessingResult(BaseModel):
     original_size: int
     processed_size: int
 
+class JobStatus(Job):
+    result_url: Optional[str] = None
+
+class StorageRequest(BaseModel):
+    objects: List[str]  # s3://bucket/key URIs of the images
+    target_prefix: str  # s3://bucket/prefix/ the results are written under
+
+class ModelInfo(BaseModel):
+    model: str
+    providers: Optional[List[str]] = None
+    active_providers: List[str]
+    shared_weights: bool = False
+    load_time: float
+    memory_bytes: int
+    loaded_at: float
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "Background Removal API Ready"}
 
+@api_router.get("/live")
+async def live():
+    """
+    Liveness: the process is up and serving requests, models may still be loading
+    """
+    return {"status": "alive"}
+
+@api_router.get("/ready")
+async def ready():
+    """
+    Readiness: 200 once the preloaded models are loaded and warmed up, 503 before
+    """
+    return JSONResponse(readiness.describe(), status_code=200 if readiness.ready else 503)
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     if not MONGODB_AVAILABLE:
@@ -81,85 +211,367 @@ async def get_status_checks():
     status_checks = await db.status_checks.find().to_list(1000)
     return [StatusCheck(**status_check) for status_check in status_checks]
 
+@api_router.get("/models", response_model=List[ModelInfo])
+async def list_models():
+    """
+    List the model sessions resident in this worker with their load cost
+    """
+    return registry.describe()
+
+@api_router.get("/batching")
+async def batching_stats():
+    """
+    Micro-batching configuration and the histogram of dispatched batch sizes
+    """
+    return batcher.describe()
+
+@api_router.get("/cache")
+async def cache_stats():
+    """
+    Result cache hit ratio and the size of each tier
+    """
+    return result_cache.describe()
+
+@api_router.get("/formats")
+async def format_stats():
+    """
+    Output formats this server can encode, with size and encode time per format
+    """
+    return {
+        "available": available_formats(),
+        "default": config.DEFAULT_OUTPUT_FORMAT,
+        "formats": pipeline.encoding_stats.describe(),
+    }
+
+def processing_options(max_inference_side=None, output_format=None, quality=None,
+                       png_compression=None, accept=None, mode='cutout', mask_bits=8,
+                       model=None, mask_threshold=None, mask_smooth=0, background_color=None,
+                       background_image=None, edge_refine='off'):
+    """Build the ProcessingOptions for a request from its parameters"""
+    model = model or config.DEFAULT_MODEL
+    if model not in config.ALLOWED_MODELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Model {model} is not available, choose one of: {', '.join(config.ALLOWED_MODELS)}"
+        )
+    if mode != 'cutout':
+        # Masks are always PNG and bounding boxes JSON
+        if output_format not in (None, 'png'):
+            raise HTTPException(status_code=400, detail=f"output_format does not apply to mode={mode}")
+        output_format = 'png'
+    if mask_bits not in (1, 8):
+        raise HTTPException(status_code=400, detail="mask_bits must be 1 or 8")
+    if mode != 'cutout' and (background_color or background_image):
+        raise HTTPException(status_code=400, detail=f"A background does not apply to mode={mode}")
+    if background_color and background_image:
+        raise HTTPException(status_code=400, detail="Give either background_color or a background image, not both")
+    if mode == 'bbox':
+        # Bounding boxes come from the raw mask
+        mask_threshold, mask_smooth, edge_refine = None, 0, 'off'
+    if output_format is None:
+        output_format = negotiate_output_format(accept, config.DEFAULT_OUTPUT_FORMAT)
+    if output_format not in available_formats():
+        raise HTTPException(status_code=400, detail=f"Output format {output_format} is not available on this server")
+    return ProcessingOptions(
+        model=model,
+        mode=mode,
+        mask_bits=mask_bits if mode == 'mask' else 8,
+        max_inference_side=max_inference_side or config.MAX_INFERENCE_SIDE or None,
+        output_format=output_format,
+        quality=quality,
+        png_compression=png_compression,
+        mask_threshold=mask_threshold,
+        mask_smooth=mask_smooth or 0,
+        edge_refine=edge_refine or 'off',
+        background_color=background_color.lstrip('#').lower() if background_color else None,
+        background_image=background_image,
+    )
+
+async def read_background(background):
+    """
+    Read an uploaded background image; returns (content, SHA-256 digest) or (None, None)
+    """
+    if background is None:
+        return None, None
+    content, _ = await read_image_upload(background, config.MAX_BACKGROUND_SIZE)
+    digest = await asyncio.to_thread(lambda: hashlib.sha256(content).hexdigest())
+    return content, digest
+
+def require_admin(request: Request):
+    """
+    Reject requests without the configured admin token with 403
+    """
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled on this server")
+    token = request.headers.get('x-admin-token', '')
+    if not hmac.compare_digest(token.encode(), config.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="A valid X-Admin-Token header is required")
+
+def profiling_requested(request: Optional[Request]) -> bool:
+    """
+    Whether a request asks to be profiled, via X-Debug-Profile or ?profile=;
+    only admins may ask
+    """
+    if request is None:
+        return False
+    flag = request.headers.get('x-debug-profile') or request.query_params.get('profile')
+    if not flag or flag.lower() in ('0', 'false', 'no'):
+        return False
+    require_admin(request)
+    return True
+
+async def run_profiled(file_content, options, trigger='request', background=None):
+    """
+    Process an image under the profilers, storing the profile in PROFILE_DIR
+    """
+    profile_id = new_profile_id()
+    (data, media_type, timings, frame_count, inferred_frames), stats = await inference_executor.run(
+        profile_image, file_content, options, config.PROFILE_DIR, profile_id, trigger, background
+    )
+    await asyncio.to_thread(prune_profiles, config.PROFILE_DIR, config.PROFILE_MAX_COUNT)
+    logger.info(f"Stored profile {profile_id} ({trigger}) in {config.PROFILE_DIR}")
+    return PipelineResult(
+        data=data,
+        media_type=media_type,
+        stats=stats,
+        batch=BatchStats(batch_size=1, batch_wait=0.0),
+        timings=timings,
+        profile_id=profile_id,
+        frame_count=frame_count,
+        inferred_frames=inferred_frames,
+    )
+
+async def profile_slow_request(file_content, options, background=None):
+    profile_sampler.running = True
+    try:
+        await run_profiled(file_content, options, trigger='slow', background=background)
+    except Exception as e:
+        logger.warning(f"Profiling a slow request failed: {e}")
+    finally:
+        profile_sampler.running = False
+
+async def run_pipeline(file_content, options, request=None, background=None):
+    """
+    Run background removal off the event loop, mapping a full queue to 503
+    Admins can have the request profiled; slow requests are sampled for
+    profiling in the background
+    """
+    try:
+        if profiling_requested(request):
+            return await run_profiled(file_content, options, background=background)
+        start_time = time.time()
+        result = await pipeline.run(file_content, options, background=background)
+        if not result.cache_hit and profile_sampler.should_sample(time.time() - start_time):
+            task = asyncio.create_task(profile_slow_request(file_content, options, background))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        return result
+    except ImageTooLargeError as e:
+        # Frame counts of animations are only known once they are decoded
+        raise HTTPException(status_code=413, detail=str(e))
+    except QueueFullError as e:
+        logger.warning(f"Rejecting request: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+
+@api_router.get("/profiles")
+async def get_profiles(request: Request):
+    """
+    Stored request profiles, newest first (admin only)
+    """
+    require_admin(request)
+    return await asyncio.to_thread(list_profiles, config.PROFILE_DIR)
+
+@api_router.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, request: Request):
+    """
+    Summary of a stored profile with its stage timings and top functions (admin only)
+    """
+    require_admin(request)
+    summary = await asyncio.to_thread(read_summary, config.PROFILE_DIR, profile_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return summary
+
+@api_router.get("/profiles/{profile_id}/{name}")
+async def get_profile_file(profile_id: str, name: str, request: Request):
+    """
+    Download a file of a stored profile, e.g. cprofile.prof or onnxruntime.json (admin only)
+    """
+    require_admin(request)
+    path = profile_file(config.PROFILE_DIR, profile_id, name)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Profile file not found")
+    return FileResponse(path, filename=f"{profile_id}-{name}")
+
+def execution_headers(result):
+    """Response headers describing how the request went through the executor"""
+    headers = {
+        "X-Processing-Time": str(result.stats.run_time),
+        "X-Queue-Depth": str(result.stats.queue_depth),
+        "X-Queue-Wait-Time": str(result.stats.wait_time),
+        "X-Batch-Size": str(result.batch.batch_size),
+        "X-Cache": "HIT" if result.cache_hit else "MISS",
+        **{
+            f"X-{stage.capitalize()}-Time": str(seconds)
+            for stage, seconds in result.timings.items()
+        },
+    }
+    if result.profile_id:
+        headers["X-Profile-Id"] = result.profile_id
+    if result.frame_count > 1:
+        headers["X-Frame-Count"] = str(result.frame_count)
+        headers["X-Inferred-Frames"] = str(result.inferred_frames)
+    return headers
+
+def output_headers(result, original_size, options, disposition="attachment"):
+    """Response headers describing the encoded result"""
+    headers = {
+        "X-Original-Size": str(original_size),
+        "X-Processed-Size": str(len(result.data)),
+        "X-Output-Mode": options.mode,
+        "X-Model": options.model,
+    }
+    if options.mode == 'cutout':
+        headers["X-Output-Format"] = options.output_format
+    if options.mode != 'bbox':
+        headers["Content-Disposition"] = f"{disposition}; filename=background_removed.{file_extension(result.media_type)}"
+    return headers
+
+# Segmentation model, one of config.ALLOWED_MODELS; the default when omitted
+ModelName = Query(None)
+
+# Longest side of the reduced image the mask is predicted on
+MaxInferenceSide = Query(None, ge=64, le=8192)
+
+# cutout returns the RGBA image, mask only the mask, bbox only its bounding box
+OutputMode = Query('cutout', pattern="^(cutout|mask|bbox)$")
+MaskBits = Query(8)
+
+# Output encoding; without it the Accept header or DEFAULT_OUTPUT_FORMAT decides
+OutputFormat = Query(None, pattern=f"^({'|'.join(OUTPUT_FORMATS)})$")
+Quality = Query(None, ge=1, le=100)
+PngCompression = Query(None, ge=0, le=9)
+
+# Mask refinement: values from mask_threshold up become opaque and the rest
+# transparent; mask_smooth feathers edges over that many pixels
+MaskThreshold = Query(None, ge=1, le=255)
+MaskSmooth = Query(0, ge=0, le=64)
+
+# Edge refinement of the soft band around the subject: a fast guided filter
+# or closed-form matting for hair and fur (slow, see matting)
+EdgeRefine = Query('off', pattern="^(off|guided|matting)$")
+
+# Solid colour (#rrggbb) cutouts are composited over instead of transparency
+BackgroundColor = Query(None, pattern="^#?[0-9a-fA-F]{6}$")
+
 @api_router.post("/remove-background")
-async def remove_background(file: UploadFile = File(...)):
+@observe_endpoint("remove_background")
+async def remove_background(
+    request: Request,
+    file: UploadFile = File(...),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor,
+    background: Optional[UploadFile] = File(None)
+):
     """
     Remove background from uploaded image using AI model
-    Returns PNG image with transparent background
+    Returns the image with a transparent background, PNG unless output_format
+    or the Accept header asks for WebP or AVIF
+    mode=mask returns only the mask as a grayscale (or mask_bits=1) PNG and
+    mode=bbox only the foreground bounding box as JSON, skipping compositing
+    background_color or a background image upload replace the transparency
+    with a solid colour or the image, scaled to cover the cutout
+    edge_refine=guided or matting recomputes the soft band around the subject
+    for finer hair and fur edges
     """
     try:
-        # Validate file type
-        if not file.content_type or not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
-        
-        # Check file size (limit to 20MB)
-        MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
-        file_content = await file.read()
-        
-        if len(file_content) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="File size exceeds 20MB limit")
+        # Read in chunks, sniff the format and check dimensions before decoding
+        file_content, _ = await read_image_upload(file, config.MAX_FILE_SIZE)
+        background_content, background_digest = await read_background(background)
         
         # Store original size for metrics
         original_size = len(file_content)
         
-        # Process image with rembg
-        import time
-        start_time = time.time()
-        
-        # Remove background using rembg
-        output_data = remove(file_content)
+        # Remove background on the inference executor, off the event loop
+        options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                     accept=request.headers.get('accept'), mode=mode, mask_bits=mask_bits,
+                                     model=model, mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                     edge_refine=edge_refine,
+                                     background_color=background_color, background_image=background_digest)
+        result = await run_pipeline(file_content, options, request, background_content)
         
-        processing_time = time.time() - start_time
+        output_data = result.data
+        processing_time = result.stats.run_time
         processed_size = len(output_data)
         
         # Log processing metrics
-        logger.info(f"Image processed: {original_size} -> {processed_size} bytes in {processing_time:.2f}s")
+        logger.info(f"Image processed: {original_size} -> {processed_size} bytes ({options.output_format}) in {processing_time:.2f}s (cache {'hit' if result.cache_hit else 'miss'}, waited {result.stats.wait_time:.2f}s, batch of {result.batch.batch_size})")
         
-        # Return processed image as PNG
         return Response(
             content=output_data,
-            media_type="image/png",
+            media_type=result.media_type,
             headers={
-                "Content-Disposition": "attachment; filename=background_removed.png",
-                "X-Processing-Time": str(processing_time),
-                "X-Original-Size": str(original_size),
-                "X-Processed-Size": str(processed_size)
+                **output_headers(result, original_size, options),
+                **execution_headers(result),
+                "Vary": "Accept"
             }
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Background removal failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
 @api_router.post("/remove-background-base64")
-async def remove_background_base64(file: UploadFile = File(...)):
+@observe_endpoint("remove_background_base64")
+async def remove_background_base64(
+    request: Request,
+    file: UploadFile = File(...),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor,
+    background: Optional[UploadFile] = File(None)
+):
     """
     Remove background and return base64 encoded result for frontend display
     """
     try:
-        # Validate file type
-        if not file.content_type or not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
-        
-        # Check file size (limit to 20MB)
-        MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
-        file_content = await file.read()
-        
-        if len(file_content) > MAX_FILE_SIZE:
-            raise HTTPException(status_code=413, detail="File size exceeds 20MB limit")
+        # Read in chunks, sniff the format and check dimensions before decoding
+        file_content, image_format = await read_image_upload(file, config.MAX_FILE_SIZE)
+        background_content, background_digest = await read_background(background)
         
         # Store original size for metrics
         original_size = len(file_content)
         
-        # Process image with rembg
-        import time
-        import base64
-        start_time = time.time()
-        
-        # Remove background using rembg
-        output_data = remove(file_content)
+        # Remove background on the inference executor, off the event loop
+        options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                     model=model, mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                     edge_refine=edge_refine,
+                                     background_color=background_color, background_image=background_digest)
+        result = await run_pipeline(file_content, options, request, background_content)
         
-        processing_time = time.time() - start_time
+        output_data = result.data
+        processing_time = result.stats.run_time
         processed_size = len(output_data)
         
         # Convert to base64 for frontend display
@@ -169,36 +581,501 @@ async def remove_background_base64(file: UploadFile = File(...)):
         base64_original = base64.b64encode(file_content).decode('utf-8')
         
         # Log processing metrics
-        logger.info(f"Image processed: {original_size} -> {processed_size} bytes in {processing_time:.2f}s")
-        
-        return {
-            "success": True,
-            "original_image": f"data:{file.content_type};base64,{base64_original}",
-            "processed_image": f"data:image/png;base64,{base64_result}",
-            "processing_time": processing_time,
-            "original_size": original_size,
-            "processed_size": processed_size,
-            "message": "Background removed successfully"
-        }
+        logger.info(f"Image processed: {original_size} -> {processed_size} bytes in {processing_time:.2f}s (cache {'hit' if result.cache_hit else 'miss'}, waited {result.stats.wait_time:.2f}s, batch of {result.batch.batch_size})")
+        
+        return JSONResponse(
+            content={
+                "success": True,
+                "original_image": f"data:{MEDIA_TYPES[image_format]};base64,{base64_original}",
+                "processed_image": f"data:{result.media_type};base64,{base64_result}",
+                "output_format": options.output_format,
+                "processing_time": processing_time,
+                "queue_wait_time": result.stats.wait_time,
+                "cache_hit": result.cache_hit,
+                "timings": result.timings,
+                "original_size": original_size,
+                "processed_size": processed_size,
+                "message": "Background removed successfully"
+            },
+            headers=execution_headers(result)
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Background removal failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+
+def multipart_mixed(metadata, data, media_type):
+    """
+    multipart/mixed body with a JSON metadata part followed by the image
+    """
+    filename = f"background_removed.{file_extension(media_type)}"
+    boundary = uuid.uuid4().hex
+    body = b"".join([
+        f"--{boundary}\r\nContent-Type: application/json\r\n\r\n".encode(),
+        json.dumps(metadata).encode(),
+        f"\r\n--{boundary}\r\nContent-Type: {media_type}\r\n"
+        f"Content-Disposition: inline; filename={filename}\r\n\r\n".encode(),
+        data,
+        f"\r\n--{boundary}--\r\n".encode(),
+    ])
+    return Response(content=body, media_type=f"multipart/mixed; boundary={boundary}")
+
+@api_router.post("/remove-background-binary")
+@observe_endpoint("remove_background_binary")
+async def remove_background_binary(
+    request: Request,
+    file: UploadFile = File(...),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor,
+    background: Optional[UploadFile] = File(None),
+    response_format: Optional[str] = Query(None, pattern="^(raw|multipart)$")
+):
+    """
+    Remove background and return only the result, without re-sending the original
+    Raw image bytes with metadata in X- headers by default; a multipart/mixed
+    body with a JSON metadata part when requested via Accept or response_format
+    The image format follows output_format or the Accept header; mode selects
+    cutout, mask or bbox output as for /remove-background, as do the mask
+    refinement and background parameters
+    """
+    try:
+        # Read in chunks, sniff the format and check dimensions before decoding
+        file_content, _ = await read_image_upload(file, config.MAX_FILE_SIZE)
+        background_content, background_digest = await read_background(background)
+        
+        original_size = len(file_content)
+        options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                     accept=request.headers.get('accept'), mode=mode, mask_bits=mask_bits,
+                                     model=model, mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                     edge_refine=edge_refine,
+                                     background_color=background_color, background_image=background_digest)
+        result = await run_pipeline(file_content, options, request, background_content)
+        processed_size = len(result.data)
+        
+        logger.info(f"Image processed: {original_size} -> {processed_size} bytes ({options.output_format}) in {result.stats.run_time:.2f}s (cache {'hit' if result.cache_hit else 'miss'}, waited {result.stats.wait_time:.2f}s, batch of {result.batch.batch_size})")
         
+        if response_format is None:
+            accepts_multipart = 'multipart/mixed' in request.headers.get('accept', '')
+            response_format = 'multipart' if accepts_multipart else 'raw'
+        
+        if response_format == 'multipart':
+            metadata = {
+                "processing_time": result.stats.run_time,
+                "queue_wait_time": result.stats.wait_time,
+                "original_size": original_size,
+                "processed_size": processed_size,
+                "cache_hit": result.cache_hit,
+                "output_format": options.output_format,
+                "mode": options.mode,
+                "timings": result.timings,
+            }
+            return multipart_mixed(metadata, result.data, result.media_type)
+        
+        return Response(
+            content=result.data,
+            media_type=result.media_type,
+            headers={
+                **output_headers(result, original_size, options, disposition="inline"),
+                **execution_headers(result),
+                "Vary": "Accept"
+            }
+        )
+        
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Background removal failed: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
 
+@api_router.post("/remove-background/batch")
+@observe_endpoint("remove_background_batch")
+async def remove_background_batch(
+    files: List[UploadFile] = File(...),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor
+):
+    """
+    Remove background from many images in one request
+    Accepts several image files or a single zip archive of images and streams
+    back a zip of transparent images, plus manifest.json with per-file results
+    """
+    if len(files) > config.BULK_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"Too many files, the limit is {config.BULK_MAX_FILES}")
+
+    uploaded = []
+    for upload in files:
+        file_content = await upload.read()
+        if len(files) == 1 and is_zip(file_content):
+            try:
+                source = ZipEntries(file_content, config.BULK_MAX_FILES, config.MAX_FILE_SIZE,
+                                    config.BULK_MAX_UNCOMPRESSED_SIZE)
+            except BulkInputError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            break
+        uploaded.append((upload.filename or f"image_{len(uploaded)}", file_content))
+    else:
+        source = UploadedFiles(uploaded)
+
+    if not len(source):
+        source.close()
+        raise HTTPException(status_code=400, detail="No images found in the upload")
+
+    logger.info(f"Bulk request: {len(source)} images")
+    options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                 mode=mode, mask_bits=mask_bits, model=model,
+                                 mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                 edge_refine=edge_refine,
+                                 background_color=background_color)
+    return StreamingResponse(
+        stream_bulk_zip(pipeline, source, options, config.BULK_CONCURRENCY, config.MAX_FILE_SIZE),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=background_removed.zip"}
+    )
+
+@api_router.post("/remove-background/sequence")
+@observe_endpoint("remove_background_sequence")
+async def remove_background_sequence(
+    file: UploadFile = File(...),
+    output: str = Query('tar', pattern="^(tar|webp)$"),
+    fps: float = Query(25, gt=0, le=1000),
+    temporal_smoothing: Optional[float] = Query(None, ge=0, lt=1),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor
+):
+    """
+    Remove background from every frame of a video frame sequence
+    Accepts a zip or tar archive of frames, taken in the natural order of their
+    names, and streams back a tar of the processed frames with manifest.json
+    last, or with output=webp an animated WebP of the cutouts at fps
+    Consecutive masks are smoothed over time (temporal_smoothing is the weight
+    of the previous mask) and frames that barely change reuse the last mask
+    """
+    if output == 'webp':
+        if mode != 'cutout':
+            raise HTTPException(status_code=400, detail="output=webp needs mode=cutout")
+        if output_format is None:
+            output_format = 'webp'
+        elif output_format not in WEBP_FORMATS:
+            raise HTTPException(status_code=400, detail=f"output=webp needs output_format {' or '.join(WEBP_FORMATS)}")
+    options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                 mode=mode, mask_bits=mask_bits, model=model,
+                                 mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                 edge_refine=edge_refine,
+                                 background_color=background_color)
+
+    # Frames are read while the response streams, after the upload itself may
+    # have been closed, so they come from a copy of our own
+    spool = tempfile.TemporaryFile()
+    try:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, spool, CHUNK_SIZE)
+        archive = await asyncio.to_thread(FrameArchive, spool, config.SEQUENCE_MAX_FRAMES, config.MAX_FILE_SIZE)
+    except SequenceInputError as e:
+        spool.close()
+        raise HTTPException(status_code=400, detail=str(e))
+    except BaseException:
+        spool.close()
+        raise
+
+    logger.info(f"Sequence request: {len(archive)} frames, {output} output")
+    smoothing = config.SEQUENCE_TEMPORAL_SMOOTHING if temporal_smoothing is None else temporal_smoothing
+    processor = SequenceProcessor(pipeline, options, smoothing, config.SEQUENCE_CONCURRENCY)
+    if output == 'tar':
+        return StreamingResponse(
+            stream_tar(processor, archive),
+            media_type="application/x-tar",
+            headers={
+                "Content-Disposition": "attachment; filename=background_removed.tar",
+                "X-Frame-Count": str(len(archive)),
+            }
+        )
+
+    # The WebP header holds the file's size, so the response starts once the
+    # last frame is encoded; a bad frame fails the request
+    try:
+        writer = await write_webp(processor, archive, max(1, round(1000 / fps)))
+    except SequenceInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except QueueFullError as e:
+        logger.warning(f"Rejecting sequence: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Server is busy, please retry shortly",
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        logger.error(f"Sequence processing failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Processing failed: {str(e)}")
+    return StreamingResponse(
+        writer.stream(),
+        media_type="image/webp",
+        headers={
+            "Content-Disposition": "attachment; filename=background_removed.webp",
+            "Content-Length": str(writer.length),
+            "X-Frame-Count": str(writer.frame_count),
+            "X-Inferred-Frames": str(processor.inferred_frames),
+            "X-Output-Format": options.output_format,
+        }
+    )
+
+@api_router.post("/storage/remove-background")
+@observe_endpoint("storage_remove_background")
+async def remove_background_storage(
+    body: StorageRequest,
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor
+):
+    """
+    Remove background from images in object storage
+    Fetches every s3://bucket/key in objects, processes it and writes the
+    result under target_prefix, named after the source; returns each object's
+    outcome with its fetch, queue wait, processing and upload times
+    """
+    if not object_store.enabled:
+        raise HTTPException(status_code=403, detail="Object storage is disabled on this server")
+    if not body.objects:
+        raise HTTPException(status_code=400, detail="No objects given")
+    if len(body.objects) > config.STORAGE_MAX_OBJECTS:
+        raise HTTPException(status_code=400, detail=f"Too many objects, the limit is {config.STORAGE_MAX_OBJECTS}")
+
+    options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                 mode=mode, mask_bits=mask_bits, model=model,
+                                 mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                 edge_refine=edge_refine,
+                                 background_color=background_color)
+    try:
+        plan = plan_objects(object_store, body.objects, body.target_prefix, options)
+    except StorageAccessError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except StorageInputError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info(f"Storage request: {len(plan)} objects to {body.target_prefix}")
+    return await process_objects(pipeline, object_store, plan, options,
+                                 config.STORAGE_CONCURRENCY, config.MAX_FILE_SIZE)
+
+@api_router.post("/jobs", response_model=JobStatus, status_code=202)
+@observe_endpoint("create_job")
+async def create_job(
+    file: UploadFile = File(...),
+    model: Optional[str] = ModelName,
+    max_inference_side: Optional[int] = MaxInferenceSide,
+    output_format: Optional[str] = OutputFormat,
+    quality: Optional[int] = Quality,
+    png_compression: Optional[int] = PngCompression,
+    mode: str = OutputMode,
+    mask_bits: int = MaskBits,
+    mask_threshold: Optional[int] = MaskThreshold,
+    mask_smooth: int = MaskSmooth,
+    edge_refine: str = EdgeRefine,
+    background_color: Optional[str] = BackgroundColor
+):
+    """
+    Queue a background removal job and return its id immediately
+    Poll GET /api/jobs/{id} for progress, then fetch GET /api/jobs/{id}/result
+    """
+    # Read in chunks, sniff the format and check dimensions before decoding
+    file_content, _ = await read_image_upload(file, config.MAX_FILE_SIZE)
+    options = processing_options(max_inference_side, output_format, quality, png_compression,
+                                 mode=mode, mask_bits=mask_bits, model=model,
+                                 mask_threshold=mask_threshold, mask_smooth=mask_smooth,
+                                 edge_refine=edge_refine,
+                                 background_color=background_color)
+    
+    try:
+        job = await job_manager.submit(file_content, file.filename, options)
+    except JobQueueFullError:
+        raise HTTPException(
+            status_code=503,
+            detail="Too many queued jobs, please retry shortly",
+            headers={"Retry-After": str(inference_executor.retry_after())}
+        )
+    
+    logger.info(f"Job {job.id} queued ({job.original_size} bytes)")
+    return JobStatus(**job.model_dump())
+
+@api_router.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job(job_id: str):
+    """
+    Status and progress of a job; includes result_url once it has completed
+    """
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    status = JobStatus(**job.model_dump())
+    if job.status == 'completed':
+        status.result_url = f"/api/jobs/{job_id}/result"
+    return status
+
+@api_router.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    """
+    Processed image of a completed job
+    """
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    if job.status != 'completed':
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    
+    output_data = await job_store.get_result(job_id)
+    if output_data is None:
+        raise HTTPException(status_code=404, detail="Job result has expired")
+    
+    media_type = job.media_type or "image/png"
+    return Response(
+        content=output_data,
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f"attachment; filename=background_removed.{file_extension(media_type)}",
+            "X-Processing-Time": str(job.processing_time),
+            "X-Original-Size": str(job.original_size),
+            "X-Processed-Size": str(job.processed_size)
+        }
+    )
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Prometheus metrics of every worker: request and stage latency histograms,
+    image sizes, cache lookups, in-flight requests, errors and memory
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 # Include the router in the main app
 app.include_router(api_router)
 
+# Refuse oversized uploads before their bodies are buffered
+single_upload_limit = config.MAX_FILE_SIZE + MULTIPART_OVERHEAD
+# The image plus an optional background image; each part is checked against
+# its own limit as it is read
+background_upload_limit = config.MAX_FILE_SIZE + config.MAX_BACKGROUND_SIZE + MULTIPART_OVERHEAD
+app.add_middleware(
+    UploadLimitMiddleware,
+    limits={
+        "/api/remove-background": background_upload_limit,
+        "/api/remove-background-base64": background_upload_limit,
+        "/api/remove-background-binary": background_upload_limit,
+        "/api/jobs": single_upload_limit,
+        "/api/remove-background/batch": config.BULK_MAX_UPLOAD_SIZE,
+        "/api/remove-background/sequence": config.SEQUENCE_MAX_UPLOAD_SIZE,
+    },
+)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let cross-origin clients read the processing metadata headers
+    expose_headers=[
+        "X-Processing-Time", "X-Original-Size", "X-Processed-Size",
+        "X-Queue-Depth", "X-Queue-Wait-Time", "X-Batch-Size", "X-Cache",
+        "X-Decode-Time", "X-Preprocess-Time", "X-Inference-Time",
+        "X-Composite-Time", "X-Postprocess-Time", "X-Encode-Time",
+        "X-Output-Format", "X-Output-Mode", "X-Model", "X-Profile-Id",
+        "X-Frame-Count", "X-Inferred-Frames", "Retry-After",
+    ],
 )
 
 # Logging already configured above
 
+async def load_and_warm_up():
+    # Build the ONNX sessions once per process instead of once per request.
+    # Process pool workers load their own copies when they start.
+    if inference_executor.kind == 'thread':
+        try:
+            for model_name in config.PRELOAD_MODELS:
+                await asyncio.to_thread(registry.load, model_name)
+        except Exception as e:
+            readiness.status = 'failed'
+            readiness.error = str(e)
+            logger.error(f"Failed to load models: {e}")
+            return
+    # Warm up with the options a request without parameters gets, so the
+    # inference side and encoder real traffic uses are the ones warmed up.
+    await warm_up(pipeline, readiness, config.PRELOAD_MODELS, parse_sizes(config.WARMUP_IMAGE_SIZES),
+                  options_for=lambda model_name: processing_options(model=model_name))
+
+@app.on_event("startup")
+async def connect_mongodb():
+    global client, db, MONGODB_AVAILABLE
+    if not MONGODB_AVAILABLE:
+        return
+    try:
+        client = AsyncIOMotorClient(mongo_url)
+        db = client[db_name]
+    except Exception as e:
+        # Jobs cannot be served without their store
+        if isinstance(job_store, MongoJobStore):
+            raise
+        logger.warning(f"MongoDB connection failed: {e}. Status endpoints will be disabled.")
+        MONGODB_AVAILABLE = False
+        return
+    if isinstance(job_store, MongoJobStore):
+        job_store.attach(db)
+    logger.info(f"Connected to MongoDB at {mongo_url}")
+
+@app.on_event("startup")
+async def load_models():
+    global warmup_task
+    inference_executor.start()
+    job_manager.start()
+    # Loading and warm-up run in the background so /api/live answers at once;
+    # /api/ready turns 200 when they are done
+    warmup_task = asyncio.create_task(load_and_warm_up())
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     if client:
-        client.close()
\ No newline at end of file
+        client.close()
+
+@app.on_event("shutdown")
+async def shutdown_inference_executor():
+    readiness.status = 'stopping'
+    if warmup_task is not None:
+        warmup_task.cancel()
+    await job_manager.stop()
+    object_store.shutdown()
+    inference_executor.shutdown()
\ No newline at end of file
@@ -0,0 +1,246 @@
+"""
+Background removal of images in object storage.
+
+Clients whose images already sit in S3, or a compatible store such as MinIO,
+send object URIs instead of uploading the bytes. Each object is fetched, run
+through the shared pipeline and written back under a target prefix,
+STORAGE_CONCURRENCY objects of a request at a time. The response lists every
+object's outcome and where its time went: fetch, queue wait, processing and
+upload.
+
+All requests of a worker share one boto3 client, whose connection pool
+(S3_MAX_POOL_CONNECTIONS) keeps connections to the store open from one
+request to the next. boto3 blocks, so its calls run on a thread pool of the
+same size rather than on the event loop or the inference executor. Only the
+buckets listed in S3_BUCKETS can be read or written.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from PIL import UnidentifiedImageError
+
+from bulk import QUEUE_FULL_RETRIES, output_name
+from encoding import OUTPUT_FORMATS, file_extension
+from inference import QueueFullError
+from pipeline import BackgroundRemovalPipeline
+from processing import ProcessingOptions
+from uploads import InvalidImageError, check_image_content
+
+logger = logging.getLogger(__name__)
+
+# Attempts per S3 call, with boto3's adaptive backoff between them
+S3_MAX_ATTEMPTS = 5
+
+
+class StorageInputError(ValueError):
+    """The request names something that is not an s3://bucket/key URI"""
+
+
+class StorageAccessError(StorageInputError):
+    """The request names a bucket this server does not work with"""
+
+
+def parse_uri(uri: str) -> Tuple[str, str]:
+    """(bucket, key) of an s3://bucket/key URI; the key may be empty for prefixes"""
+    if not uri.startswith('s3://'):
+        raise StorageInputError(f"Not an s3://bucket/key URI: {uri}")
+    bucket, _, key = uri[len('s3://'):].partition('/')
+    if not bucket:
+        raise StorageInputError(f"No bucket in {uri}")
+    return bucket, key
+
+
+class ObjectStore:
+    """The worker's pooled S3 client and the threads its blocking calls run on"""
+
+    def __init__(self, buckets: List[str], endpoint_url: Optional[str] = None,
+                 region: Optional[str] = None, access_key_id: Optional[str] = None,
+                 secret_access_key: Optional[str] = None, max_connections: int = 32):
+        self.buckets = set(buckets)
+        self.max_connections = max(1, max_connections)
+        # Unset values fall back to boto3's own configuration chain
+        self._client_kwargs = {
+            name: value for name, value in (
+                ('endpoint_url', endpoint_url),
+                ('region_name', region),
+                ('aws_access_key_id', access_key_id),
+                ('aws_secret_access_key', secret_access_key),
+            ) if value
+        }
+        self._client = None
+        self._threads = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.buckets)
+
+    def check_bucket(self, bucket: str):
+        if bucket not in self.buckets:
+            raise StorageAccessError(f"Bucket {bucket} is not enabled on this server")
+
+    def _get_client(self):
+        # Built on first use rather than at import, so that it is not shared
+        # across gunicorn's fork
+        if self._client is None:
+            self._client = boto3.session.Session().client(
+                's3',
+                config=Config(
+                    max_pool_connections=self.max_connections,
+                    retries={'max_attempts': S3_MAX_ATTEMPTS, 'mode': 'adaptive'},
+                ),
+                **self._client_kwargs,
+            )
+        return self._client
+
+    async def _call(self, fn, *args):
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(self.max_connections, thread_name_prefix='s3')
+        return await asyncio.get_running_loop().run_in_executor(self._threads, fn, *args)
+
+    def _get(self, client, bucket: str, key: str, max_size: int) -> bytes:
+        response = client.get_object(Bucket=bucket, Key=key)
+        body = response['Body']
+        try:
+            # The declared size is checked before the body is read
+            if response.get('ContentLength', 0) > max_size:
+                raise StorageInputError(f"Object exceeds the {max_size // (1024 * 1024)}MB limit")
+            return body.read()
+        finally:
+            body.close()
+
+    async def get(self, bucket: str, key: str, max_size: int) -> bytes:
+        return await self._call(self._get, self._get_client(), bucket, key, max_size)
+
+    async def put(self, bucket: str, key: str, data: bytes, media_type: str, source: str):
+        client = self._get_client()
+        await self._call(lambda: client.put_object(
+            Bucket=bucket, Key=key, Body=data, ContentType=media_type, Metadata={'source': source},
+        ))
+
+    def shutdown(self):
+        if self._threads is not None:
+            self._threads.shutdown(wait=False)
+
+
+def output_extension(options: ProcessingOptions) -> str:
+    if options.mode == 'bbox':
+        return 'json'
+    if options.mode == 'mask':
+        return 'png'
+    return OUTPUT_FORMATS[options.output_format][1]
+
+
+def plan_objects(store: ObjectStore, objects: List[str], target_prefix: str,
+                 options: ProcessingOptions) -> List[Tuple[str, str, str, str]]:
+    """Check every URI and pick each result's key.
+
+    Returns (source bucket, source key, target bucket, target key) per object.
+    Results are named after their source's file name under target_prefix,
+    with a counter when two sources share a name.
+    """
+    target_bucket, prefix = parse_uri(target_prefix)
+    store.check_bucket(target_bucket)
+    if prefix and not prefix.endswith('/'):
+        prefix += '/'
+    plan = []
+    used_names = set()
+    extension = output_extension(options)
+    for uri in objects:
+        bucket, key = parse_uri(uri)
+        if not key:
+            raise StorageInputError(f"No object key in {uri}")
+        store.check_bucket(bucket)
+        plan.append((bucket, key, target_bucket, prefix + output_name(key, used_names, extension)))
+    return plan
+
+
+async def _process_object(pipeline: BackgroundRemovalPipeline, store: ObjectStore,
+                          semaphore: asyncio.Semaphore, source: Tuple[str, str],
+                          target: Tuple[str, str], options: ProcessingOptions,
+                          max_file_size: int) -> dict:
+    bucket, key = source
+    target_bucket, target_key = target
+    uri = f"s3://{bucket}/{key}"
+    entry = {"source": uri, "success": False}
+    timings = {}
+    start_time = time.time()
+    async with semaphore:
+        try:
+            stage_start = time.time()
+            file_content = await store.get(bucket, key, max_file_size)
+            timings['fetch'] = time.time() - stage_start
+            entry["original_size"] = len(file_content)
+            # The same magic-byte and header checks uploads get
+            check_image_content(file_content)
+
+            for attempt in range(QUEUE_FULL_RETRIES + 1):
+                try:
+                    result = await pipeline.run(file_content, options)
+                    break
+                except QueueFullError as e:
+                    if attempt == QUEUE_FULL_RETRIES:
+                        raise
+                    await asyncio.sleep(e.retry_after)
+            timings['queue_wait'] = result.stats.wait_time
+            timings['processing'] = result.stats.run_time
+
+            extension = file_extension(result.media_type)
+            if not target_key.endswith(f".{extension}"):
+                # Animated AVIF requests come back as WebP
+                target_key = f"{os.path.splitext(target_key)[0]}.{extension}"
+            stage_start = time.time()
+            await store.put(target_bucket, target_key, result.data, result.media_type, uri)
+            timings['upload'] = time.time() - stage_start
+
+            entry.update({
+                "success": True,
+                "target": f"s3://{target_bucket}/{target_key}",
+                "processed_size": len(result.data),
+                "cache_hit": result.cache_hit,
+                "stages": result.timings,
+            })
+        except UnidentifiedImageError:
+            entry["error"] = "Not a valid image"
+        except (StorageInputError, InvalidImageError) as e:
+            entry["error"] = str(e)
+        except ClientError as e:
+            error = e.response.get('Error', {})
+            entry["error"] = f"{error.get('Code', 'Error')}: {error.get('Message') or e}"
+        except Exception as e:
+            logger.warning(f"Storage object {uri} failed: {e}")
+            entry["error"] = str(e)
+    entry["timings"] = timings
+    entry["elapsed"] = time.time() - start_time
+    return entry
+
+
+async def process_objects(pipeline: BackgroundRemovalPipeline, store: ObjectStore,
+                          plan: List[Tuple[str, str, str, str]], options: ProcessingOptions,
+                          concurrency: int, max_file_size: int) -> dict:
+    """Fetch, process and write back every planned object, concurrency at a time.
+
+    One failing object never fails the others; the summary reports each.
+    """
+    start_time = time.time()
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    entries = await asyncio.gather(*[
+        _process_object(pipeline, store, semaphore, (bucket, key), (target_bucket, target_key),
+                        options, max_file_size)
+        for bucket, key, target_bucket, target_key in plan
+    ])
+    succeeded = sum(1 for entry in entries if entry["success"])
+    return {
+        "total": len(entries),
+        "succeeded": succeeded,
+        "failed": len(entries) - succeeded,
+        "elapsed": time.time() - start_time,
+        "objects": entries,
+    }
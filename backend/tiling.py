@@ -0,0 +1,145 @@
+"""
+Bounded-memory processing of very large images.
+
+Cutting out a large image in one go holds the decoded image, float copies of
+the upsampled mask, the RGBA cutout and Pillow's encoder buffers at the same
+time: around 30 bytes per pixel, so a 100 megapixel upload peaks above 3GB.
+For images whose estimate exceeds the per-request ceiling, the mask is
+upsampled, applied and PNG-encoded a strip of rows at a time instead. Only
+the decoded image and the encoded output scale with the image; everything
+else lives in a strip-sized buffer that is reused from one strip to the next.
+
+PNG is the only output that can be written that way; WebP and AVIF encoders
+need the whole image.
+"""
+
+import struct
+import zlib
+from typing import Tuple
+
+import numpy as np
+
+# Measured peak of the whole-image path per pixel (decode, guided upsample,
+# composite and PNG encode), with some headroom
+WHOLE_IMAGE_BYTES_PER_PIXEL = 32
+
+# Encoded PNG output per pixel in the worst case (incompressible RGBA)
+OUTPUT_BYTES_PER_PIXEL = 4
+
+# Fixed cost of a request on top of the image: the upload, the model input
+# and the reduced view the mask is predicted on
+BASE_REQUEST_BYTES = 64 * 1024 * 1024
+
+# Size of one RGBA strip. Filtering a strip for PNG takes a few dozen
+# temporaries of about this size.
+STRIP_BUFFER_BYTES = 1024 * 1024
+
+# Longest side of the view the mask is predicted on when working in strips
+STRIP_INFERENCE_SIDE = 2048
+
+# PNG bit depth, colour type and bytes per pixel by output mode
+PNG_COLOR_TYPES = {'RGBA': (8, 6, 4), 'RGB': (8, 2, 3), 'L': (8, 0, 1), '1': (1, 0, 1)}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def whole_image_bytes(width: int, height: int) -> int:
+    """Estimated peak memory of processing an image in one piece"""
+    return BASE_REQUEST_BYTES + width * height * WHOLE_IMAGE_BYTES_PER_PIXEL
+
+
+def strip_bytes(width: int, height: int, channels: int) -> int:
+    """Estimated peak memory of processing an image in strips.
+
+    The decoded image (channels bytes per pixel) and the encoded output are
+    the only parts that grow with the image.
+    """
+    return (BASE_REQUEST_BYTES + STRIP_BUFFER_BYTES * 32
+            + width * height * (channels + OUTPUT_BYTES_PER_PIXEL))
+
+
+def strip_height(width: int) -> int:
+    """Rows per strip so one RGBA strip fits STRIP_BUFFER_BYTES"""
+    return max(1, STRIP_BUFFER_BYTES // (width * 4))
+
+
+def _chunk(kind: bytes, data: bytes) -> bytes:
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+
+class PNGStripWriter:
+    """Encode a PNG from consecutive strips of rows.
+
+    Rows are filtered with the heuristic libpng uses (per row, the filter
+    with the smallest sum of absolute values) and compressed as they come,
+    so only the compressed output grows with the image.
+    """
+
+    def __init__(self, size: Tuple[int, int], mode: str = 'RGBA', compress_level: int = 6):
+        self.width, self.height = size
+        self.mode = mode
+        depth, color_type, self.bpp = PNG_COLOR_TYPES[mode]
+        self.rows_written = 0
+        self._compressor = zlib.compressobj(compress_level)
+        self._previous = None
+        self._parts = [PNG_SIGNATURE, _chunk(b'IHDR', struct.pack(
+            '>IIBBBBB', self.width, self.height, depth, color_type, 0, 0, 0
+        ))]
+
+    def write(self, rows: np.ndarray):
+        """Append rows: (n, width, 4) for RGBA, (n, width, 3) for RGB, (n, width) for L
+        and booleans for 1"""
+        if self.mode == '1':
+            # 1-bit rows are tiny and rarely gain from filtering
+            raw = np.packbits(np.asarray(rows, dtype=bool), axis=1)
+            filtered = np.zeros((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+            filtered[:, 1:] = raw
+        else:
+            raw = np.ascontiguousarray(rows).reshape(rows.shape[0], -1)
+            filtered = self._filter(raw)
+            self._previous = raw[-1].copy()
+        self.rows_written += rows.shape[0]
+        data = self._compressor.compress(filtered.tobytes())
+        if data:
+            self._parts.append(_chunk(b'IDAT', data))
+
+    def _filter(self, raw: np.ndarray) -> np.ndarray:
+        bpp = self.bpp
+        up = np.empty_like(raw)
+        up[0] = self._previous if self._previous is not None else 0
+        up[1:] = raw[:-1]
+        left = np.zeros_like(raw)
+        left[:, bpp:] = raw[:, :-bpp]
+        up_left = np.zeros_like(raw)
+        up_left[:, bpp:] = up[:, :-bpp]
+
+        a = left.astype(np.int16)
+        b = up.astype(np.int16)
+        c = up_left.astype(np.int16)
+        pa = np.abs(b - c)
+        pb = np.abs(a - c)
+        pc = np.abs(a + b - 2 * c)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+        del pa, pb, pc
+
+        candidates = np.stack([
+            raw,
+            raw - left,
+            raw - up,
+            raw - ((a + b) >> 1).astype(np.uint8),
+            raw - paeth,
+        ])
+        # Bytes as signed values: small differences in either direction are cheap
+        scores = np.abs(candidates.view(np.int8).astype(np.int16)).sum(axis=2)
+        choice = scores.argmin(axis=0)
+        filtered = np.empty((raw.shape[0], raw.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = choice
+        filtered[:, 1:] = candidates[choice, np.arange(raw.shape[0])]
+        return filtered
+
+    def finish(self) -> bytes:
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG has {self.height} rows, {self.rows_written} were written")
+        self._parts.append(_chunk(b'IDAT', self._compressor.flush()))
+        self._parts.append(_chunk(b'IEND', b''))
+        return b''.join(self._parts)
@@ -0,0 +1,175 @@
+"""
+Upload handling with early rejection.
+
+Oversized bodies are refused before they are buffered: UploadLimitMiddleware
+checks Content-Length up front and counts the bytes of bodies without one,
+failing with 413 as soon as the limit is crossed. Uploaded files are read in
+chunks, identified by their magic bytes rather than the client-supplied
+content type, and their pixel dimensions are checked from the header before
+anything is decoded.
+"""
+
+import io
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image, UnidentifiedImageError
+from starlette.responses import JSONResponse
+
+from processing import ImageTooLargeError, check_pixel_count
+
+# Read size for uploads
+CHUNK_SIZE = 1024 * 1024
+
+# Room for multipart boundaries and part headers on top of the file itself
+MULTIPART_OVERHEAD = 64 * 1024
+
+# Leading bytes of each accepted format, as (offset, signature) pairs
+IMAGE_SIGNATURES = {
+    'jpeg': [(0, b'\xff\xd8\xff')],
+    'png': [(0, b'\x89PNG\r\n\x1a\n')],
+    'gif': [(0, b'GIF87a'), (0, b'GIF89a')],
+    'webp': [(8, b'WEBP')],  # after a RIFF header, checked below
+    'bmp': [(0, b'BM')],
+    'tiff': [(0, b'II*\x00'), (0, b'MM\x00*')],
+}
+
+# ISO base media brands of AVIF/HEIF images (the 'ftyp' box at offset 4)
+FTYP_BRANDS = {
+    b'avif': 'avif', b'avis': 'avif',
+    b'heic': 'heic', b'heix': 'heic', b'mif1': 'heic', b'msf1': 'heic',
+}
+
+MEDIA_TYPES = {
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'bmp': 'image/bmp',
+    'tiff': 'image/tiff',
+    'avif': 'image/avif',
+    'heic': 'image/heic',
+}
+
+
+def sniff_image_format(head: bytes):
+    """Image format from the first bytes of a file, or None if unrecognized"""
+    if head[4:8] == b'ftyp':
+        return FTYP_BRANDS.get(head[8:12])
+    for image_format, signatures in IMAGE_SIGNATURES.items():
+        for offset, signature in signatures:
+            if head[offset:offset + len(signature)] == signature:
+                if image_format == 'webp' and head[:4] != b'RIFF':
+                    continue
+                return image_format
+    return None
+
+
+class InvalidImageError(ValueError):
+    """The bytes are not an image in a supported format"""
+
+
+def check_image_content(file_content: bytes) -> str:
+    """Validate an image the way uploads are, without decoding it.
+
+    Returns its format, identified by the magic bytes. Raises
+    InvalidImageError for anything else and ImageTooLargeError when the
+    header declares too many pixels.
+    """
+    image_format = sniff_image_format(file_content[:32])
+    if image_format is None:
+        raise InvalidImageError("Invalid file type. Please upload an image.")
+
+    # Image.open only parses the header, so this rejects decompression bombs
+    # before any pixel data is decoded
+    try:
+        check_pixel_count(Image.open(io.BytesIO(file_content)))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e))
+    except (UnidentifiedImageError, OSError):
+        raise InvalidImageError("Invalid or unsupported image file.")
+    return image_format
+
+
+async def read_image_upload(file: UploadFile, max_size: int):
+    """Read an uploaded image in chunks and validate it cheaply.
+
+    Returns (file_content, image_format). Raises HTTPException 413 as soon as
+    the size limit is crossed or when the header declares too many pixels,
+    and 400 when the bytes are not a supported image.
+    """
+    chunks = []
+    total = 0
+    while True:
+        chunk = await file.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        if not chunks:
+            # Validate file type from the magic bytes, not the content type
+            if sniff_image_format(chunk[:32]) is None:
+                raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+        total += len(chunk)
+        if total > max_size:
+            raise HTTPException(status_code=413, detail=f"File size exceeds {max_size // (1024 * 1024)}MB limit")
+        chunks.append(chunk)
+
+    if not chunks:
+        raise HTTPException(status_code=400, detail="Invalid file type. Please upload an image.")
+    file_content = b''.join(chunks)
+
+    try:
+        image_format = check_image_content(file_content)
+    except ImageTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except InvalidImageError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    return file_content, image_format
+
+
+class UploadLimitMiddleware:
+    """ASGI middleware refusing request bodies over a per-path size limit.
+
+    A declared Content-Length over the limit is answered with 413 without
+    reading the body. Otherwise received bytes are counted and the request
+    fails with 413 the moment the limit is crossed, so a chunked upload is
+    never buffered past it.
+    """
+
+    def __init__(self, app, limits):
+        self.app = app
+        self.limits = dict(limits)
+
+    async def __call__(self, scope, receive, send):
+        limit = None
+        if scope['type'] == 'http' and scope['method'] == 'POST':
+            limit = self.limits.get(scope['path'].rstrip('/'))
+        if limit is None:
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            response = JSONResponse(
+                {"detail": f"Request body exceeds {limit // (1024 * 1024)}MB limit"},
+                status_code=413,
+                headers={"Connection": "close"},
+            )
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if received > limit:
+                    # FastAPI re-raises HTTPExceptions from body parsing as-is
+                    raise HTTPException(
+                        status_code=413,
+                        detail=f"Request body exceeds {limit // (1024 * 1024)}MB limit",
+                    )
+            return message
+
+        await self.app(scope, limited_receive, send)
@@ -0,0 +1,114 @@
+"""
+Startup warm-up and readiness.
+
+Loading a model only builds its ONNX session: the first inference still
+allocates the runtime's memory arenas, and the first decode, resize and encode
+of each size pay their own one-time costs. The warm-up runs synthetic images
+of representative sizes through the full pipeline for every preloaded model,
+concurrently so the micro-batcher forms a batch too. The server reports ready
+only once that has finished, so health checks and load balancers keep traffic
+away from cold instances.
+"""
+
+import asyncio
+import io
+import logging
+import time
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from processing import ProcessingOptions
+
+logger = logging.getLogger(__name__)
+
+
+def parse_sizes(items: List[str]) -> List[Tuple[int, int]]:
+    """Parse ["512x512", "1920x1080"] into [(512, 512), (1920, 1080)]"""
+    sizes = []
+    for item in items:
+        width, _, height = item.lower().partition('x')
+        try:
+            sizes.append((int(width), int(height or width)))
+        except ValueError:
+            raise ValueError(f"Invalid warm-up image size: {item}, expected WIDTHxHEIGHT")
+    return sizes
+
+
+def warmup_image(width: int, height: int) -> bytes:
+    """A JPEG with a subject-like blob on a gradient, so no stage is trivially fast"""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    background = np.stack([
+        255 * x / max(1, width - 1),
+        255 * y / max(1, height - 1),
+        np.full_like(x, 128),
+    ], axis=-1)
+    radius = min(width, height) / 3
+    subject = ((x - width / 2) ** 2 + (y - height / 2) ** 2) < radius ** 2
+    background[subject] = (200, 60, 40)
+    bio = io.BytesIO()
+    Image.fromarray(background.astype(np.uint8)).save(bio, 'JPEG', quality=90)
+    return bio.getvalue()
+
+
+class Readiness:
+    """Warm-up progress of this worker, as reported by /api/ready"""
+
+    def __init__(self):
+        self.status = 'starting'  # starting, warming, ready, failed, stopping
+        self.error: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self.warmup_time: Optional[float] = None
+        self.warmed: List[dict] = []
+
+    @property
+    def ready(self) -> bool:
+        return self.status == 'ready'
+
+    def describe(self) -> dict:
+        return {
+            "status": self.status,
+            "error": self.error,
+            "warmup_time": self.warmup_time,
+            "warmed": self.warmed,
+        }
+
+
+async def warm_up(pipeline, readiness: Readiness, models: List[str], sizes: List[Tuple[int, int]],
+                  options_for: Optional[Callable[[str], ProcessingOptions]] = None):
+    """Run a warm-up image of every size through the pipeline for every model.
+
+    options_for(model) gives the options images are warmed up with; pass the
+    ones a request without parameters gets (MAX_INFERENCE_SIDE,
+    DEFAULT_OUTPUT_FORMAT...) so the paths real traffic takes are the warm
+    ones. Marks readiness as ready when done, or as failed if a model cannot
+    run; a server that cannot process images should not receive traffic.
+    """
+    if options_for is None:
+        options_for = lambda model_name: ProcessingOptions(model=model_name)
+    readiness.status = 'warming'
+    readiness.started_at = time.time()
+    images = [(size, warmup_image(*size)) for size in sizes]
+    try:
+        for model_name in models if images else []:
+            options = options_for(model_name)
+            start_time = time.time()
+            await asyncio.gather(*[
+                pipeline.run(content, options, warmup=True) for _, content in images
+            ])
+            elapsed = time.time() - start_time
+            readiness.warmed.append({
+                "model": model_name,
+                "sizes": [f"{width}x{height}" for (width, height), _ in images],
+                "time": elapsed,
+            })
+            logger.info(f"Warmed up {model_name} with {len(images)} images in {elapsed:.2f}s")
+    except Exception as e:
+        readiness.status = 'failed'
+        readiness.error = str(e)
+        logger.error(f"Warm-up failed: {e}")
+        return
+    readiness.warmup_time = time.time() - readiness.started_at
+    readiness.status = 'ready'
+    logger.info(f"Ready after {readiness.warmup_time:.2f}s warm-up")
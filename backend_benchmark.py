@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+"""
+Load and latency benchmark for the Background Removal API
+
+Runs a fixed image corpus, from thumbnails up to ~20MB photos, through the
+API at one or more concurrency levels. For each level it reports throughput,
+p50/p95/p99 latency, peak RSS and CPU utilization as JSON. The corpus is
+generated deterministically (or loaded from --corpus), so runs on different
+commits are comparable.
+
+Two modes:
+    http        POST every image to /remove-background-binary
+    inprocess   call the processing functions directly, without HTTP, to
+                separate model and image cost from server overhead
+
+    python backend_benchmark.py --mode http --concurrency 1,4,8 --requests 40
+    python backend_benchmark.py --mode inprocess --concurrency 1,2 \
+        --baseline baseline.json --max-regression 0.15
+
+With --baseline the p95 latency and throughput of every (mode, concurrency)
+run are compared with an earlier report, and the exit status is 1 when one
+got worse by more than --max-regression.
+"""
+
+import argparse
+import io
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+from PIL import Image
+
+BACKEND_URL = "http://127.0.0.1:8001/api"
+
+# name -> (width, height, JPEG quality), from thumbnail to a ~20MB photo
+CORPUS_SPECS = {
+    'thumbnail': (160, 120, 85),
+    'small': (640, 480, 90),
+    'medium': (1920, 1080, 90),
+    'large': (4032, 3024, 92),
+    'xlarge': (6000, 4000, 98),
+}
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def generate_image(width, height, quality, seed):
+    """A photo-like JPEG: a lit subject on a textured background, with sensor noise.
+
+    The noise keeps the JPEG from compressing to a fraction of a real photo's
+    size, so the largest spec lands near the 20MB upload limit.
+    """
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    pixels = np.stack([
+        120 + 80 * np.sin(x / max(1, width) * 6 + seed),
+        110 + 70 * np.cos(y / max(1, height) * 5),
+        np.full_like(x, 140),
+    ], axis=-1)
+    subject = ((x - width / 2) / (width / 4)) ** 2 + ((y - height / 2) / (height / 3)) ** 2 < 1
+    pixels[subject] = pixels[subject] * 0.4 + np.array([200, 150, 120], dtype=np.float32) * 0.6
+    pixels += rng.normal(0, 12, pixels.shape).astype(np.float32)
+    bio = io.BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(bio, 'JPEG', quality=quality)
+    return bio.getvalue()
+
+
+def load_corpus(directory, sizes):
+    """(name, bytes) pairs of the corpus, generating missing images into directory"""
+    os.makedirs(directory, exist_ok=True)
+    corpus = []
+    for seed, name in enumerate(sizes):
+        width, height, quality = CORPUS_SPECS[name]
+        path = os.path.join(directory, f"{name}_{width}x{height}.jpg")
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(generate_image(width, height, quality, seed))
+        with open(path, 'rb') as f:
+            corpus.append((name, f.read()))
+    return corpus
+
+
+def unique_jpeg(content, marker):
+    """The same JPEG with a comment segment added, so the server's result
+    cache sees a new image while decoding stays the same"""
+    comment = f"benchmark {marker}".encode()
+    return content[:2] + b'\xff\xfe' + struct.pack('>H', len(comment) + 2) + comment + content[2:]
+
+
+def process_tree(pid):
+    """pid and all its descendants, e.g. a gunicorn master and its workers"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    parents[int(entry)] = int(f.read().rsplit(')', 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, parent in parents.items():
+            if parent in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return tree
+
+
+def tree_usage(pid):
+    """(RSS bytes, CPU seconds) summed over a process tree"""
+    rss = 0
+    cpu_ticks = 0
+    for member in process_tree(pid):
+        try:
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            # utime and stime, then the resident page count
+            cpu_ticks += int(fields[11]) + int(fields[12])
+            rss += int(fields[21]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+    return rss, cpu_ticks / CLOCK_TICKS
+
+
+class ResourceMonitor:
+    """Samples the RSS of a process tree in the background and its CPU time"""
+
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.is_set():
+            rss, _ = tree_usage(self.pid)
+            self.peak_rss = max(self.peak_rss, rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_rss, self._cpu_start = tree_usage(self.pid)
+        self._wall_start = time.time()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        rss, cpu_end = tree_usage(self.pid)
+        self.peak_rss = max(self.peak_rss, rss)
+        self.cpu_seconds = cpu_end - self._cpu_start
+        wall = time.time() - self._wall_start
+        # Share of all the cores available to this machine
+        self.cpu_utilization = self.cpu_seconds / (wall * (os.cpu_count() or 1)) if wall else 0.0
+
+
+def http_worker(base_url, params):
+    # One connection pool per client thread
+    local = threading.local()
+
+    def send(item):
+        name, content = item
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        files = {'file': (f'{name}.jpg', content, 'image/jpeg')}
+        response = session.post(f"{base_url}/remove-background-binary", files=files,
+                                params=params, timeout=300)
+        if response.status_code != 200:
+            raise RuntimeError(f"HTTP {response.status_code}: {response.text[:200]}")
+        return {
+            stage[2:-5].lower(): float(value)
+            for stage, value in response.headers.items()
+            if stage.lower().startswith('x-') and stage.lower().endswith('-time')
+            and stage.lower() not in ('x-processing-time', 'x-queue-wait-time')
+        }
+
+    return send
+
+
+def inprocess_worker(options):
+    from processing import finish_cutout, predict_batch, prepare_image
+
+    def send(item):
+        _, content = item
+        prepared = prepare_image(content, options)
+        start_time = time.time()
+        mask = predict_batch(options.model, [prepared.model_input])[0]
+        inference_time = time.time() - start_time
+        _, _, finish_timings = finish_cutout(content, prepared, mask, options)
+        return {**prepared.timings, 'inference': inference_time, **finish_timings}
+
+    return send
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    return {
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(np.max(values)),
+    }
+
+
+def run_level(send, corpus, concurrency, total_requests, monitor_pid, allow_cache=False):
+    """Send total_requests images, cycling through the corpus, concurrency at a time"""
+    items = [(i, corpus[i % len(corpus)]) for i in range(total_requests)]
+    run_id = time.time()
+    latencies = []
+    by_size = {}
+    stages = {}
+    errors = {}
+    lock = threading.Lock()
+
+    def timed(numbered):
+        number, (name, content) = numbered
+        if not allow_cache:
+            content = unique_jpeg(content, f"{run_id} {number}")
+        item = (name, content)
+        start_time = time.perf_counter()
+        try:
+            timings = send(item)
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            return
+        latency = time.perf_counter() - start_time
+        with lock:
+            latencies.append(latency)
+            by_size.setdefault(item[0], []).append(latency)
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+
+    with ResourceMonitor(monitor_pid) as monitor:
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(timed, items))
+        elapsed = time.perf_counter() - start_time
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "completed": len(latencies),
+        "errors": errors,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency": percentiles(latencies),
+        "latency_by_size": {name: percentiles(values) for name, values in by_size.items()},
+        "stages": {stage: percentiles(values) for stage, values in stages.items()},
+        "peak_rss_bytes": monitor.peak_rss,
+        "cpu_seconds": monitor.cpu_seconds,
+        "cpu_utilization": monitor.cpu_utilization,
+    }
+
+
+def compare(report, baseline, max_regression):
+    """Runs whose p95 latency or throughput got worse than the baseline allows"""
+    previous = {(run["mode"], run["concurrency"]): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in report["runs"]:
+        before = previous.get((run["mode"], run["concurrency"]))
+        if before is None or not run["latency"] or not before["latency"]:
+            continue
+        p95_change = run["latency"]["p95"] / before["latency"]["p95"] - 1
+        throughput_change = 1 - run["throughput"] / before["throughput"] if before["throughput"] else 0.0
+        if p95_change > max_regression or throughput_change > max_regression:
+            regressions.append({
+                "mode": run["mode"],
+                "concurrency": run["concurrency"],
+                "p95_change": p95_change,
+                "throughput_change": -throughput_change,
+            })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mode', choices=['http', 'inprocess'], default='http')
+    parser.add_argument('--url', default=BACKEND_URL, help='API base URL for http mode')
+    parser.add_argument('--server-pid', type=int,
+                        help='backend process (e.g. the gunicorn master) to measure RSS and CPU of '
+                             'in http mode; without it the client process is measured')
+    parser.add_argument('--corpus', default='benchmark-corpus',
+                        help='directory of corpus images, generated if missing')
+    parser.add_argument('--sizes', default=','.join(CORPUS_SPECS),
+                        help=f"comma separated corpus sizes, of: {', '.join(CORPUS_SPECS)}")
+    parser.add_argument('--concurrency', default='1,4', help='comma separated concurrency levels')
+    parser.add_argument('--requests', type=int, default=20, help='requests per concurrency level')
+    parser.add_argument('--model', help='model to use (default: the server default)')
+    parser.add_argument('--output-format', help='output_format to request')
+    parser.add_argument('--allow-cache', action='store_true',
+                        help='send identical bytes for repeated images, letting the server answer from its cache')
+    parser.add_argument('--output', default='backend_benchmark_results.json')
+    parser.add_argument('--baseline', help='earlier report to check for regressions')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='largest allowed relative p95 or throughput regression')
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(',') if size.strip()]
+    unknown = [size for size in sizes if size not in CORPUS_SPECS]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+    corpus = load_corpus(args.corpus, sizes)
+
+    if args.mode == 'http':
+        params = {key: value for key, value in
+                  (('model', args.model), ('output_format', args.output_format)) if value}
+        send = http_worker(args.url, params)
+        monitor_pid = args.server_pid or os.getpid()
+    else:
+        # The backend modules read their settings when imported
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+        import config
+        from processing import ProcessingOptions
+        options = ProcessingOptions(
+            model=args.model or config.DEFAULT_MODEL,
+            output_format=args.output_format or config.DEFAULT_OUTPUT_FORMAT,
+        )
+        send = inprocess_worker(options)
+        monitor_pid = os.getpid()
+
+    # One untimed pass so session creation and first-run costs are excluded
+    for item in corpus:
+        send(item)
+
+    report = {
+        "mode": args.mode,
+        "url": args.url if args.mode == 'http' else None,
+        "corpus": {name: len(content) for name, content in corpus},
+        "cpu_count": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "runs": [],
+    }
+    for level in args.concurrency.split(','):
+        concurrency = int(level)
+        result = run_level(send, corpus, concurrency, args.requests, monitor_pid, args.allow_cache)
+        result["mode"] = args.mode
+        report["runs"].append(result)
+        latency = result["latency"]
+        print(
+            f"{args.mode} x{concurrency}: {result['throughput']:.2f} img/s, "
+            f"p50 {latency.get('p50', 0) * 1000:.0f} ms, p95 {latency.get('p95', 0) * 1000:.0f} ms, "
+            f"p99 {latency.get('p99', 0) * 1000:.0f} ms, peak RSS {result['peak_rss_bytes'] / 1e6:.0f} MB, "
+            f"CPU {result['cpu_utilization'] * 100:.0f}%"
+            + (f", errors {result['errors']}" if result['errors'] else "")
+        )
+
+    failed = False
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.max_regression)
+        report["regressions"] = regressions
+        for regression in regressions:
+            print(
+                f"Regression at {regression['mode']} x{regression['concurrency']}: "
+                f"p95 {regression['p95_change'] * 100:+.0f}%, "
+                f"throughput {regression['throughput_change'] * 100:+.0f}%"
+            )
+        failed = bool(regressions)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nDetailed results saved to: {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,9 +9,19 @@ import json
 import time
 import base64
 import os
+import sys
 from pathlib import Path
-from PIL import Image
+from PIL import Image, ImageDraw
 import io
+import tarfile
+import zipfile
+
+try:
+    # Only the object storage test needs it
+    import boto3
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
 
 # Get backend URL from environment
 BACKEND_URL = "http://127.0.0.1:8001/api"
@@ -431,6 +441,1067 @@ class BackgroundRemovalAPITester:
             )
             return False
 
+    def test_batch_endpoint(self):
+        """Test 7: Batch Endpoint - POST /api/remove-background/batch with one invalid file"""
+        try:
+            files = [
+                ('files', ('first.jpg', self.create_test_image(), 'image/jpeg')),
+                ('files', ('second.png', self.create_test_image(format='PNG'), 'image/png')),
+                ('files', ('broken.jpg', b"not an image", 'image/jpeg')),
+            ]
+            
+            response = requests.post(
+                f"{self.base_url}/remove-background/batch",
+                files=files,
+                timeout=60
+            )
+            
+            if response.status_code != 200:
+                self.log_test(
+                    "Batch Endpoint",
+                    False,
+                    f"API returned status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text}
+                )
+                return False
+            
+            archive = zipfile.ZipFile(io.BytesIO(response.content))
+            names = archive.namelist()
+            manifest = json.loads(archive.read('manifest.json'))
+            
+            # Both valid images come back and the broken one is reported, not fatal
+            expected = {'first.png', 'second.png', 'manifest.json'}
+            if set(names) == expected and manifest['succeeded'] == 2 and manifest['failed'] == 1:
+                self.log_test(
+                    "Batch Endpoint",
+                    True,
+                    "Batch processed with per-file manifest",
+                    {"entries": names, "elapsed": f"{manifest['elapsed']:.2f}s"}
+                )
+                return True
+            else:
+                self.log_test(
+                    "Batch Endpoint",
+                    False,
+                    "Unexpected archive contents",
+                    {"entries": names, "manifest": manifest}
+                )
+                return False
+                
+        except (requests.exceptions.RequestException, zipfile.BadZipFile) as e:
+            self.log_test(
+                "Batch Endpoint",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_async_job(self):
+        """Test 8: Async Job - POST /api/jobs, poll status, fetch result"""
+        try:
+            files = {'file': ('test_image.jpg', self.create_test_image(), 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/jobs", files=files, timeout=10)
+            
+            if response.status_code != 202:
+                self.log_test(
+                    "Async Job",
+                    False,
+                    f"Expected 202 but got {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text}
+                )
+                return False
+            
+            job_id = response.json()['id']
+            
+            # Poll until the job finishes
+            status = None
+            for _ in range(60):
+                status = requests.get(f"{self.base_url}/jobs/{job_id}", timeout=10).json()
+                if status['status'] in ('completed', 'failed'):
+                    break
+                time.sleep(0.5)
+            
+            if status['status'] != 'completed':
+                self.log_test(
+                    "Async Job",
+                    False,
+                    f"Job did not complete, last status: {status['status']}",
+                    {"job": status}
+                )
+                return False
+            
+            result = requests.get(f"{self.base_url}/jobs/{job_id}/result", timeout=10)
+            if result.status_code == 200 and result.headers.get('content-type') == 'image/png':
+                self.log_test(
+                    "Async Job",
+                    True,
+                    "Job completed and result downloaded",
+                    {
+                        "job_id": job_id,
+                        "processing_time": f"{status['processing_time']:.2f}s",
+                        "processed_size": f"{len(result.content)} bytes"
+                    }
+                )
+                return True
+            else:
+                self.log_test(
+                    "Async Job",
+                    False,
+                    f"Result download returned {result.status_code}",
+                    {"status_code": result.status_code, "content_type": result.headers.get('content-type')}
+                )
+                return False
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Async Job",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_output_formats(self):
+        """Test 9: Output Formats - POST /api/remove-background with output_format and Accept"""
+        try:
+            image = self.create_test_image()
+            checks = [
+                ({'output_format': 'webp'}, {}, 'image/webp'),
+                ({'output_format': 'png8'}, {}, 'image/png'),
+                ({}, {'Accept': 'image/webp,*/*'}, 'image/webp'),
+                ({}, {'Accept': '*/*'}, 'image/png'),
+            ]
+            sizes = {}
+            for params, headers, expected in checks:
+                files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+                response = requests.post(f"{self.base_url}/remove-background", files=files,
+                                         params=params, headers=headers, timeout=30)
+                content_type = response.headers.get('content-type')
+                if response.status_code != 200 or content_type != expected:
+                    self.log_test(
+                        "Output Formats",
+                        False,
+                        f"Expected {expected} for {params or headers} but got {response.status_code} {content_type}",
+                        {"status_code": response.status_code, "response": response.text[:200]}
+                    )
+                    return False
+                # Make sure the body decodes as an image with alpha
+                Image.open(io.BytesIO(response.content)).load()
+                sizes[response.headers.get('x-output-format')] = len(response.content)
+            
+            self.log_test(
+                "Output Formats",
+                True,
+                "Output format and Accept negotiation honoured",
+                {"sizes": sizes}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Output Formats",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_output_modes(self):
+        """Test 10: Output Modes - POST /api/remove-background with mode=mask and mode=bbox"""
+        try:
+            image = self.create_test_image()
+            files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files,
+                                     params={'mode': 'mask'}, timeout=30)
+            if response.status_code != 200 or Image.open(io.BytesIO(response.content)).mode != 'L':
+                self.log_test(
+                    "Output Modes",
+                    False,
+                    f"mode=mask did not return a grayscale PNG ({response.status_code})",
+                    {"status_code": response.status_code, "content_type": response.headers.get('content-type')}
+                )
+                return False
+            mask_size = len(response.content)
+            
+            files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files,
+                                     params={'mode': 'bbox'}, timeout=30)
+            if response.status_code != 200 or 'bbox' not in response.json():
+                self.log_test(
+                    "Output Modes",
+                    False,
+                    f"mode=bbox did not return a bounding box ({response.status_code})",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            
+            self.log_test(
+                "Output Modes",
+                True,
+                "Mask and bounding box modes returned",
+                {"mask_size": f"{mask_size} bytes", "bbox": response.json()['bbox']}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Output Modes",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_liveness_and_readiness(self):
+        """Test 11: Liveness and Readiness - GET /api/live and /api/ready"""
+        try:
+            response = requests.get(f"{self.base_url}/live", timeout=10)
+            if response.status_code != 200:
+                self.log_test(
+                    "Liveness and Readiness",
+                    False,
+                    f"/api/live returned status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text}
+                )
+                return False
+            
+            # Warm-up takes a few seconds after startup
+            for _ in range(30):
+                response = requests.get(f"{self.base_url}/ready", timeout=10)
+                if response.status_code != 503:
+                    break
+                time.sleep(2)
+            data = response.json()
+            if response.status_code != 200 or data.get("status") != "ready":
+                self.log_test(
+                    "Liveness and Readiness",
+                    False,
+                    f"/api/ready did not report ready ({response.status_code})",
+                    {"status_code": response.status_code, "response": data}
+                )
+                return False
+            
+            self.log_test(
+                "Liveness and Readiness",
+                True,
+                "Backend is live and warmed up",
+                {"warmup_time": data.get("warmup_time"), "warmed": data.get("warmed")}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Liveness and Readiness",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_metrics(self):
+        """Test 12: Metrics - GET /metrics after processing an image"""
+        try:
+            image = self.create_test_image()
+            files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+            requests.post(f"{self.base_url}/remove-background", files=files, timeout=30)
+            
+            # /metrics is served next to /api, not under it
+            metrics_url = self.base_url.rsplit('/api', 1)[0] + '/metrics'
+            response = requests.get(metrics_url, timeout=10)
+            expected = [
+                'bgremoval_request_duration_seconds_count{endpoint="remove_background"}',
+                'bgremoval_stage_duration_seconds_count{stage="inference"}',
+                'bgremoval_requests_in_flight',
+                'bgremoval_process_resident_memory_bytes',
+            ]
+            missing = [name for name in expected if name not in response.text]
+            if response.status_code != 200 or missing:
+                self.log_test(
+                    "Metrics",
+                    False,
+                    f"Metrics missing or unavailable ({response.status_code})",
+                    {"status_code": response.status_code, "missing": missing}
+                )
+                return False
+            
+            self.log_test(
+                "Metrics",
+                True,
+                "Request and stage metrics exposed",
+                {"metric_lines": len(response.text.splitlines())}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Metrics",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_request_profiling(self):
+        """Test 13: Request Profiling - POST /api/remove-background?profile=1 (admin only)"""
+        try:
+            image = self.create_test_image()
+            files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files,
+                                     params={'profile': '1'}, timeout=30)
+            if response.status_code != 403:
+                self.log_test(
+                    "Request Profiling",
+                    False,
+                    f"Profiling without an admin token returned {response.status_code}, expected 403",
+                    {"status_code": response.status_code}
+                )
+                return False
+            
+            # The rest needs the server's token
+            admin_token = os.environ.get('ADMIN_TOKEN')
+            if not admin_token:
+                self.log_test(
+                    "Request Profiling",
+                    True,
+                    "Profiling refused without an admin token (set ADMIN_TOKEN to test profiling itself)",
+                    {"status_code": response.status_code}
+                )
+                return True
+            
+            headers = {'X-Admin-Token': admin_token}
+            files = {'file': ('test_image.jpg', image, 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files,
+                                     params={'profile': '1'}, headers=headers, timeout=60)
+            profile_id = response.headers.get('X-Profile-Id')
+            if response.status_code != 200 or not profile_id:
+                self.log_test(
+                    "Request Profiling",
+                    False,
+                    f"Profiled request failed or returned no X-Profile-Id ({response.status_code})",
+                    {"status_code": response.status_code}
+                )
+                return False
+            
+            summary = requests.get(f"{self.base_url}/profiles/{profile_id}", headers=headers, timeout=10).json()
+            if 'onnxruntime.json' not in summary.get('files', []) or not summary.get('top_functions'):
+                self.log_test(
+                    "Request Profiling",
+                    False,
+                    "Profile is missing the ONNX Runtime trace or the cProfile report",
+                    {"files": summary.get('files')}
+                )
+                return False
+            
+            self.log_test(
+                "Request Profiling",
+                True,
+                "Request profiled with cProfile and the ONNX Runtime profiler",
+                {"profile_id": profile_id, "timings": summary.get('timings')}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Request Profiling",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_color_modes(self):
+        """Test 14: Color Modes - CMYK, 16-bit, palette and EXIF-rotated uploads"""
+        try:
+            base = Image.new('RGB', (120, 80), color='red')
+            uploads = {}
+            
+            buffer = io.BytesIO()
+            base.convert('CMYK').save(buffer, format='JPEG')
+            uploads['cmyk.jpg'] = (buffer.getvalue(), (120, 80))
+            
+            buffer = io.BytesIO()
+            Image.new('I;16', (120, 80), 40000).save(buffer, format='PNG')
+            uploads['gray16.png'] = (buffer.getvalue(), (120, 80))
+            
+            buffer = io.BytesIO()
+            base.convert('P').save(buffer, format='PNG', transparency=0)
+            uploads['palette.png'] = (buffer.getvalue(), (120, 80))
+            
+            # Orientation 6: stored landscape, displayed portrait
+            buffer = io.BytesIO()
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            base.save(buffer, format='JPEG', exif=exif.tobytes())
+            uploads['rotated.jpg'] = (buffer.getvalue(), (80, 120))
+            
+            sizes = {}
+            for name, (content, expected_size) in uploads.items():
+                files = {'file': (name, content, 'application/octet-stream')}
+                response = requests.post(f"{self.base_url}/remove-background", files=files, timeout=30)
+                if response.status_code != 200:
+                    self.log_test(
+                        "Color Modes",
+                        False,
+                        f"{name} returned status code {response.status_code}",
+                        {"status_code": response.status_code, "response": response.text[:200]}
+                    )
+                    return False
+                result = Image.open(io.BytesIO(response.content))
+                sizes[name] = result.size
+                if result.mode != 'RGBA' or result.size != expected_size:
+                    self.log_test(
+                        "Color Modes",
+                        False,
+                        f"{name} gave a {result.mode} {result.size} result, expected RGBA {expected_size}",
+                        {"mode": result.mode, "size": result.size}
+                    )
+                    return False
+            
+            self.log_test(
+                "Color Modes",
+                True,
+                "All color modes processed with EXIF orientation applied",
+                {"sizes": sizes}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Color Modes",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_animated_upload(self):
+        """Test 15: Animated Upload - GIF frames processed with mask reuse"""
+        try:
+            frames = []
+            for index in range(6):
+                frame = Image.new('RGB', (120, 80), color='white')
+                # Frames 0-2 are nearly identical, 3-5 move the subject
+                x = 20 if index < 3 else 70
+                frame.paste((200, 30, 30), (x, 20, x + 30, 60))
+                frame.putpixel((index, 0), (0, 0, 0))
+                frames.append(frame)
+            buffer = io.BytesIO()
+            frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:],
+                           duration=80, loop=0)
+            
+            files = {'file': ('animated.gif', buffer.getvalue(), 'image/gif')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files, timeout=60)
+            if response.status_code != 200:
+                self.log_test(
+                    "Animated Upload",
+                    False,
+                    f"Status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            
+            result = Image.open(io.BytesIO(response.content))
+            frame_count = int(response.headers.get('X-Frame-Count', '1'))
+            inferred_frames = int(response.headers.get('X-Inferred-Frames', '1'))
+            details = {
+                "format": result.format,
+                "frames": getattr(result, 'n_frames', 1),
+                "frame_count": frame_count,
+                "inferred_frames": inferred_frames,
+            }
+            if getattr(result, 'n_frames', 1) != 6 or frame_count != 6 or result.mode != 'RGBA':
+                self.log_test("Animated Upload", False, "Expected a 6-frame RGBA animation", details)
+                return False
+            if not 1 <= inferred_frames < frame_count:
+                self.log_test("Animated Upload", False, "Masks of similar frames were not reused", details)
+                return False
+            
+            self.log_test(
+                "Animated Upload",
+                True,
+                f"{frame_count} frames returned, {inferred_frames} ran through the model",
+                details
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Animated Upload",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_long_animation(self):
+        """Test 21: Long Animation - more distinct frames than the inference queue holds"""
+        try:
+            frames = []
+            for index in range(200):
+                # Alternating backgrounds: no frame can reuse its neighbour's mask
+                frame = Image.new('RGB', (64, 48), color='white' if index % 2 else 'black')
+                x = index % 40
+                frame.paste((200, 30, 30), (x, 12, x + 20, 36))
+                frames.append(frame)
+            buffer = io.BytesIO()
+            frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:],
+                           duration=40, loop=0)
+            
+            files = {'file': ('long.gif', buffer.getvalue(), 'image/gif')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files, timeout=300)
+            if response.status_code != 200:
+                self.log_test(
+                    "Long Animation",
+                    False,
+                    f"Status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            
+            frame_count = int(response.headers.get('X-Frame-Count', '1'))
+            inferred_frames = int(response.headers.get('X-Inferred-Frames', '1'))
+            details = {"frame_count": frame_count, "inferred_frames": inferred_frames}
+            if frame_count != 200 or inferred_frames != 200:
+                self.log_test("Long Animation", False, "Expected 200 frames, all run through the model", details)
+                return False
+            
+            self.log_test(
+                "Long Animation",
+                True,
+                f"{inferred_frames} keyframes processed without filling the inference queue",
+                details
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Long Animation",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_large_image_strips(self):
+        """Test 16: Large Image - cutout over the memory ceiling produced in strips"""
+        try:
+            # 48 megapixels: over the default 1GB ceiling in one piece, within it in strips
+            image = Image.new('RGB', (8000, 6000), color='white')
+            image.paste((30, 90, 200), (2000, 1500, 6000, 4500))
+            buffer = io.BytesIO()
+            image.save(buffer, format='JPEG', quality=80)
+            content = buffer.getvalue()
+            
+            files = {'file': ('large.jpg', content, 'image/jpeg')}
+            response = requests.post(f"{self.base_url}/remove-background", files=files, timeout=300)
+            if response.status_code == 413:
+                self.log_test(
+                    "Large Image",
+                    True,
+                    "Server memory ceiling is too low for this image even in strips (413)",
+                    {"detail": response.text[:200]}
+                )
+                return True
+            if response.status_code != 200:
+                self.log_test(
+                    "Large Image",
+                    False,
+                    f"Status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            output_bytes = len(response.content)
+            result = Image.open(io.BytesIO(response.content))
+            if result.size != (8000, 6000) or result.mode != 'RGBA':
+                self.log_test(
+                    "Large Image",
+                    False,
+                    f"Expected an 8000x6000 RGBA result, got {result.mode} {result.size}",
+                    {"mode": result.mode, "size": result.size}
+                )
+                return False
+            
+            # Formats that cannot be written in strips are refused, not run out of memory
+            response = requests.post(
+                f"{self.base_url}/remove-background",
+                files={'file': ('large.jpg', content, 'image/jpeg')},
+                params={'output_format': 'webp'},
+                timeout=300
+            )
+            self.log_test(
+                "Large Image",
+                True,
+                f"8000x6000 cutout returned; WebP output answered {response.status_code}",
+                {"output_bytes": output_bytes, "webp_status": response.status_code}
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Large Image",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_strip_consistency(self):
+        """Test 22: Strip Consistency - strips and the whole image give the same pixels (in-process)"""
+        try:
+            # Compares two code paths of one server, so it runs the backend's
+            # processing code directly rather than over HTTP
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import numpy as np
+            import processing
+            import tiling
+        except ImportError as e:
+            self.log_test(
+                "Strip Consistency",
+                True,
+                f"Skipped: backend modules not importable here ({e})",
+                {}
+            )
+            return True
+        
+        image = Image.new('RGB', (3000, 2000), color=(30, 120, 200))
+        draw = ImageDraw.Draw(image)
+        for index in range(40):
+            draw.ellipse((index * 60, 300 + index * 10, index * 60 + 500, 1000 + index * 15),
+                         fill=(200 + index, (index * 37) % 256, 40))
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=85)
+        content = buffer.getvalue()
+        # Any prediction will do: both paths get the same one
+        pred = np.random.default_rng(0).random((320, 320)).astype(np.float32)
+        
+        cases = {
+            "cutout": {"mode": "cutout"},
+            "mask": {"mode": "mask"},
+            "smoothed cutout": {"mode": "cutout", "mask_smooth": 8, "mask_threshold": 100},
+            "background": {"mode": "cutout", "background_color": "ff0000"},
+        }
+        differences = {}
+        for name, fields in cases.items():
+            options = processing.ProcessingOptions(
+                model='u2net', max_inference_side=tiling.STRIP_INFERENCE_SIDE, **fields
+            )
+            prepared = processing.prepare_image(content, options)
+            prepared.model_input = None
+            outputs = []
+            for strips in (False, True):
+                prepared.strips = strips
+                data, _, _ = processing.finish_cutout(content, prepared, pred, options)
+                outputs.append(np.asarray(Image.open(io.BytesIO(data)), dtype=np.int16))
+            differences[name] = int(np.abs(outputs[0] - outputs[1]).max())
+        
+        if any(differences.values()):
+            self.log_test(
+                "Strip Consistency",
+                False,
+                "Output depends on whether the image was processed in strips",
+                {"max_difference": differences}
+            )
+            return False
+        self.log_test(
+            "Strip Consistency",
+            True,
+            "Strip and whole-image processing give identical pixels",
+            {"cases": list(cases)}
+        )
+        return True
+
+    def test_shared_disk_cache(self):
+        """Test 23: Shared Disk Cache - workers sharing RESULT_CACHE_DIR keep it within the limit (in-process)"""
+        try:
+            # Several gunicorn workers are simulated by several tiers on one
+            # directory, which needs the backend's cache module itself
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import tempfile
+            import cache
+        except ImportError as e:
+            self.log_test(
+                "Shared Disk Cache",
+                True,
+                f"Skipped: backend modules not importable here ({e})",
+                {}
+            )
+            return True
+        
+        max_bytes = 100_000
+        with tempfile.TemporaryDirectory() as directory:
+            workers = [cache.DiskTier(directory, max_bytes) for _ in range(4)]
+            for index in range(200):
+                entry = cache.CachedResult(data=bytes([index % 256]) * 2000, media_type='image/png')
+                workers[index % len(workers)].put(cache.cache_key(str(index).encode(), {}), entry)
+            total = sum(
+                os.path.getsize(os.path.join(root, name))
+                for root, _, files in os.walk(directory) for name in files
+            )
+            # An entry written by one worker is a hit on another
+            last_key = cache.cache_key(b'199', {})
+            shared_hit = workers[0].get(last_key) is not None
+        
+        # Between rebuilds of their indexes each worker adds up to a tenth of the limit
+        allowed = max_bytes * (1 + len(workers) / cache.DiskTier.RESCAN_FRACTION)
+        if total > allowed or not shared_hit:
+            self.log_test(
+                "Shared Disk Cache",
+                False,
+                "Workers sharing the cache directory overran its limit or missed each other's entries",
+                {"directory_bytes": total, "allowed": allowed, "shared_hit": shared_hit}
+            )
+            return False
+        self.log_test(
+            "Shared Disk Cache",
+            True,
+            f"{len(workers)} workers kept the directory at {total} of {max_bytes} bytes",
+            {"directory_bytes": total, "shared_hit": shared_hit}
+        )
+        return True
+
+    def test_background_replacement(self):
+        """Test 17: Background Replacement - colour and image backgrounds, mask refinement"""
+        try:
+            image = Image.new('RGB', (200, 150), color='white')
+            image.paste((40, 160, 60), (60, 30, 140, 120))
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            content = buffer.getvalue()
+            
+            backdrop = Image.new('RGB', (64, 48), color=(10, 20, 200))
+            backdrop_buffer = io.BytesIO()
+            backdrop.save(backdrop_buffer, format='JPEG')
+            
+            requests_made = {
+                "colour": ({'background_color': '#ff00ff', 'mask_smooth': 2}, None),
+                "image": ({'mask_threshold': 128}, backdrop_buffer.getvalue()),
+            }
+            details = {}
+            for name, (params, background) in requests_made.items():
+                files = {'file': ('test_image.png', content, 'image/png')}
+                if background is not None:
+                    files['background'] = ('backdrop.jpg', background, 'image/jpeg')
+                response = requests.post(
+                    f"{self.base_url}/remove-background", files=files, params=params, timeout=30
+                )
+                if response.status_code != 200:
+                    self.log_test(
+                        "Background Replacement",
+                        False,
+                        f"{name} background: status code {response.status_code}",
+                        {"status_code": response.status_code, "response": response.text[:200]}
+                    )
+                    return False
+                result = Image.open(io.BytesIO(response.content))
+                details[name] = {"mode": result.mode, "size": result.size}
+                if result.mode != 'RGB' or result.size != image.size:
+                    self.log_test(
+                        "Background Replacement",
+                        False,
+                        f"{name} background: expected an opaque 200x150 image",
+                        details
+                    )
+                    return False
+            
+            # A background only makes sense for cutouts
+            response = requests.post(
+                f"{self.base_url}/remove-background",
+                files={'file': ('test_image.png', content, 'image/png')},
+                params={'mode': 'mask', 'background_color': '00ff00'},
+                timeout=30
+            )
+            details["mask_with_background_status"] = response.status_code
+            if response.status_code != 400:
+                self.log_test(
+                    "Background Replacement",
+                    False,
+                    f"Expected 400 for a background with mode=mask, got {response.status_code}",
+                    details
+                )
+                return False
+            
+            self.log_test(
+                "Background Replacement",
+                True,
+                "Colour and image backgrounds composited; mask mode rejects a background",
+                details
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Background Replacement",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_edge_refinement(self):
+        """Test 18: Edge Refinement - guided and matting modes refine the mask's soft band"""
+        try:
+            image = Image.new('RGB', (240, 180), color=(30, 110, 160))
+            draw = ImageDraw.Draw(image)
+            draw.ellipse((70, 40, 170, 170), fill=(200, 150, 110))
+            for x in range(80, 160, 6):
+                draw.line((x, 50, x + 8, 20), fill=(120, 80, 40), width=1)
+            buffer = io.BytesIO()
+            image.save(buffer, format='PNG')
+            content = buffer.getvalue()
+            
+            details = {}
+            for mode in ('off', 'guided', 'matting'):
+                response = requests.post(
+                    f"{self.base_url}/remove-background",
+                    files={'file': ('test_image.png', content, 'image/png')},
+                    params={'edge_refine': mode},
+                    timeout=120
+                )
+                if response.status_code != 200:
+                    self.log_test(
+                        "Edge Refinement",
+                        False,
+                        f"edge_refine={mode}: status code {response.status_code}",
+                        {"status_code": response.status_code, "response": response.text[:200]}
+                    )
+                    return False
+                result = Image.open(io.BytesIO(response.content))
+                details[mode] = {
+                    "mode": result.mode,
+                    "size": result.size,
+                    "refine_time": response.headers.get('X-Refine-Time'),
+                }
+                if result.mode != 'RGBA' or result.size != image.size:
+                    self.log_test("Edge Refinement", False, f"edge_refine={mode}: unexpected output", details)
+                    return False
+                if mode != 'off' and details[mode]["refine_time"] is None:
+                    self.log_test("Edge Refinement", False, f"edge_refine={mode}: no X-Refine-Time", details)
+                    return False
+            
+            self.log_test(
+                "Edge Refinement",
+                True,
+                f"guided refined in {float(details['guided']['refine_time']):.2f}s, "
+                f"matting in {float(details['matting']['refine_time']):.2f}s",
+                details
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Edge Refinement",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_frame_sequence(self):
+        """Test 19: Frame Sequence - zip of frames back as a tar and as an animated WebP"""
+        try:
+            archive = io.BytesIO()
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                for index in range(8):
+                    frame = Image.new('RGB', (120, 80), color=(30, 110, 160))
+                    # Pairs of frames share a position, so every other mask is reused
+                    x = 10 + (index // 2) * 20
+                    ImageDraw.Draw(frame).ellipse((x, 20, x + 40, 60), fill=(250, 230, 60))
+                    buffer = io.BytesIO()
+                    frame.save(buffer, format='PNG')
+                    # Natural order: frame2 comes before frame10
+                    zip_file.writestr(f"clip/frame{index * 4}.png", buffer.getvalue())
+            content = archive.getvalue()
+            
+            response = requests.post(
+                f"{self.base_url}/remove-background/sequence",
+                files={'file': ('frames.zip', content, 'application/zip')},
+                timeout=120
+            )
+            if response.status_code != 200:
+                self.log_test(
+                    "Frame Sequence",
+                    False,
+                    f"Status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            tar = tarfile.open(fileobj=io.BytesIO(response.content))
+            names = tar.getnames()
+            manifest = json.load(tar.extractfile('manifest.json'))
+            details = {
+                "members": names,
+                "succeeded": manifest.get("succeeded"),
+                "inferred_frames": manifest.get("inferred_frames"),
+            }
+            expected = [f"frame{index * 4}.png" for index in range(8)] + ['manifest.json']
+            if names != expected or manifest.get("succeeded") != 8:
+                self.log_test("Frame Sequence", False, "Expected the 8 frames in order, then the manifest", details)
+                return False
+            first = Image.open(tar.extractfile(names[0]))
+            if first.mode != 'RGBA' or first.size != (120, 80):
+                self.log_test("Frame Sequence", False, "Frames are not RGBA cutouts", details)
+                return False
+            if not 1 <= manifest["inferred_frames"] < 8:
+                self.log_test("Frame Sequence", False, "Masks of similar frames were not reused", details)
+                return False
+            
+            response = requests.post(
+                f"{self.base_url}/remove-background/sequence",
+                files={'file': ('frames.zip', content, 'application/zip')},
+                params={'output': 'webp', 'fps': 10},
+                timeout=120
+            )
+            if response.status_code != 200:
+                self.log_test(
+                    "Frame Sequence",
+                    False,
+                    f"output=webp: status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            animation = Image.open(io.BytesIO(response.content))
+            details["webp_frames"] = getattr(animation, 'n_frames', 1)
+            # Frame durations are only read once a frame is loaded
+            animation.seek(details["webp_frames"] - 1)
+            animation.load()
+            details["webp_duration"] = animation.info.get('duration')
+            if animation.format != 'WEBP' or details["webp_frames"] != 8 or details["webp_duration"] != 100:
+                self.log_test("Frame Sequence", False, "Expected an 8-frame animated WebP at 10 fps", details)
+                return False
+            
+            # A format Pillow opens but uploads do not accept fails only its frame
+            mixed = io.BytesIO()
+            with zipfile.ZipFile(mixed, 'w') as zip_file:
+                zip_file.writestr("frame1.png", self.create_test_image(120, 80, format='PNG'))
+                zip_file.writestr("frame2.ico", self.create_test_image(64, 64, format='ICO'))
+            response = requests.post(
+                f"{self.base_url}/remove-background/sequence",
+                files={'file': ('frames.zip', mixed.getvalue(), 'application/zip')},
+                timeout=120
+            )
+            manifest = json.load(tarfile.open(fileobj=io.BytesIO(response.content)).extractfile('manifest.json'))
+            details["unsupported_frame"] = manifest["frames"][1]
+            if manifest["succeeded"] != 1 or manifest["frames"][1]["success"]:
+                self.log_test("Frame Sequence", False, "An unsupported frame format was processed", details)
+                return False
+            
+            self.log_test(
+                "Frame Sequence",
+                True,
+                f"8 frames returned as tar and animated WebP, {manifest['inferred_frames']} ran through the model",
+                details
+            )
+            return True
+                
+        except requests.exceptions.RequestException as e:
+            self.log_test(
+                "Frame Sequence",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
+    def test_object_storage(self):
+        """Test 20: Object Storage - images fetched from S3 and results written back"""
+        # Needs a store the server is configured for (S3_BUCKETS), e.g. MinIO or moto_server
+        bucket = os.environ.get('S3_TEST_BUCKET')
+        if not bucket:
+            self.log_test(
+                "Object Storage",
+                True,
+                "Skipped (set S3_TEST_BUCKET to one of the server's S3_BUCKETS, and the S3_* settings, to test it)",
+                {}
+            )
+            return True
+        if boto3 is None:
+            self.log_test("Object Storage", False, "boto3 is needed to test object storage", {})
+            return False
+        try:
+            region = os.environ.get('S3_REGION') or 'us-east-1'
+            client = boto3.client(
+                's3',
+                endpoint_url=os.environ.get('S3_ENDPOINT_URL') or None,
+                region_name=region,
+                aws_access_key_id=os.environ.get('S3_ACCESS_KEY_ID') or None,
+                aws_secret_access_key=os.environ.get('S3_SECRET_ACCESS_KEY') or None,
+            )
+            try:
+                client.head_bucket(Bucket=bucket)
+            except ClientError:
+                if region == 'us-east-1':
+                    client.create_bucket(Bucket=bucket)
+                else:
+                    client.create_bucket(Bucket=bucket, CreateBucketConfiguration={'LocationConstraint': region})
+            
+            prefix = f"backend-test-{int(time.time() * 1000)}"
+            client.put_object(Bucket=bucket, Key=f"{prefix}/in/first.jpg", Body=self.create_test_image())
+            client.put_object(Bucket=bucket, Key=f"{prefix}/in/second.png",
+                              Body=self.create_test_image(format='PNG'))
+            # Pillow opens ICO, but uploads do not accept it
+            client.put_object(Bucket=bucket, Key=f"{prefix}/in/icon.ico",
+                              Body=self.create_test_image(64, 64, format='ICO'))
+            payload = {
+                "objects": [
+                    f"s3://{bucket}/{prefix}/in/first.jpg",
+                    f"s3://{bucket}/{prefix}/in/second.png",
+                    f"s3://{bucket}/{prefix}/in/missing.jpg",
+                    f"s3://{bucket}/{prefix}/in/icon.ico",
+                ],
+                "target_prefix": f"s3://{bucket}/{prefix}/out/",
+            }
+            response = requests.post(f"{self.base_url}/storage/remove-background", json=payload, timeout=120)
+            if response.status_code != 200:
+                self.log_test(
+                    "Object Storage",
+                    False,
+                    f"Status code {response.status_code}",
+                    {"status_code": response.status_code, "response": response.text[:200]}
+                )
+                return False
+            
+            summary = response.json()
+            entries = summary.get("objects", [])
+            details = {
+                "succeeded": summary.get("succeeded"),
+                "failed": summary.get("failed"),
+                "targets": [entry.get("target") for entry in entries],
+            }
+            if summary.get("succeeded") != 2 or summary.get("failed") != 2 or entries[2].get("success") \
+                    or entries[3].get("success"):
+                self.log_test("Object Storage", False,
+                              "Expected two results, one missing object and one rejected format", details)
+                return False
+            if not all({'fetch', 'processing', 'upload'} <= set(entry["timings"]) for entry in entries[:2]):
+                self.log_test("Object Storage", False, "Per-object timings are missing", details)
+                return False
+            
+            written = client.get_object(Bucket=bucket, Key=f"{prefix}/out/first.png")
+            result = Image.open(io.BytesIO(written['Body'].read()))
+            details["content_type"] = written.get('ContentType')
+            if result.mode != 'RGBA' or details["content_type"] != 'image/png':
+                self.log_test("Object Storage", False, "Written result is not an RGBA PNG", details)
+                return False
+            
+            fetch_time = sum(entry["timings"]["fetch"] for entry in entries[:2])
+            self.log_test(
+                "Object Storage",
+                True,
+                f"2 objects processed and written back, 1 missing and 1 unsupported reported (fetch {fetch_time:.3f}s total)",
+                details
+            )
+            return True
+                
+        except (requests.exceptions.RequestException, BotoCoreError, ClientError) as e:
+            self.log_test(
+                "Object Storage",
+                False,
+                f"Request failed: {str(e)}",
+                {"error": str(e)}
+            )
+            return False
+
     def run_all_tests(self):
         """Run all backend tests"""
         print("=" * 80)
@@ -442,11 +1513,28 @@ class BackgroundRemovalAPITester:
         # Run tests in order of priority
         tests = [
             self.test_api_health_check,
+            self.test_liveness_and_readiness,
             self.test_background_removal_base64,
             self.test_background_removal_direct,
             self.test_png_image_upload,
             self.test_file_size_validation,
             self.test_invalid_file_type,
+            self.test_batch_endpoint,
+            self.test_async_job,
+            self.test_output_formats,
+            self.test_output_modes,
+            self.test_metrics,
+            self.test_request_profiling,
+            self.test_color_modes,
+            self.test_animated_upload,
+            self.test_long_animation,
+            self.test_large_image_strips,
+            self.test_strip_consistency,
+            self.test_shared_disk_cache,
+            self.test_background_replacement,
+            self.test_edge_refinement,
+            self.test_frame_sequence,
+            self.test_object_storage,
         ]
         
         passed = 0
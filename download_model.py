@@ -1,28 +1,44 @@
 #!/usr/bin/env python3
 """
-Script to pre-download the rembg AI model during Docker build
+Script to pre-download the rembg AI models during Docker build
+
+Fetches every model the backend is configured to load (REMBG_DEFAULT_MODEL,
+REMBG_ALLOWED_MODELS and REMBG_PRELOAD_MODELS) so no request waits for a
+download.
 """
 
-import rembg
-from rembg import remove
-from PIL import Image
-import io
+import os
+import sys
+
+# In the image this script sits next to the backend modules, in the
+# repository one level above them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import config
+from model_registry import base_model
+from rembg import new_session
+
+
+def configured_models():
+    """rembg models behind every configured model name (variants share theirs)"""
+    models = [config.DEFAULT_MODEL] + config.ALLOWED_MODELS + config.PRELOAD_MODELS
+    return list(dict.fromkeys(base_model(model_name) for model_name in models))
+
 
 def download_model():
-    print('Pre-downloading AI model...')
-    
-    # Create a small dummy image to trigger model download
-    dummy_image = Image.new('RGB', (100, 100), color='red')
-    img_byte_arr = io.BytesIO()
-    dummy_image.save(img_byte_arr, format='PNG')
-    img_byte_arr = img_byte_arr.getvalue()
-    
-    # This will trigger the model download
-    try:
-        result = remove(img_byte_arr)
-        print(f'Model downloaded successfully! Result size: {len(result)} bytes')
-    except Exception as e:
-        print(f'Model download completed with: {e}')
+    failed = []
+    for model_name in configured_models():
+        print(f'Pre-downloading AI model {model_name}...')
+        # Creating a session downloads the model and checks that it loads
+        try:
+            new_session(model_name)
+            print(f'Model {model_name} downloaded successfully!')
+        except Exception as e:
+            print(f'Model {model_name} download failed: {e}')
+            failed.append(model_name)
+    return failed
+
 
 if __name__ == '__main__':
-    download_model() 
\ No newline at end of file
+    if download_model():
+        sys.exit(1)
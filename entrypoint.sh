@@ -4,38 +4,98 @@ set -e
 # Debug: Show environment
 echo "PATH: $PATH"
 echo "Python version: $(python3 --version)"
-echo "Checking uvicorn..."
+echo "Checking uvicorn and gunicorn..."
 python3 -c "import uvicorn; print(f'uvicorn version: {uvicorn.__version__}')" || echo "uvicorn import failed"
+python3 -c "import gunicorn; print(f'gunicorn version: {gunicorn.__version__}')" || echo "gunicorn import failed"
+
+# CPUs this container may use: the affinity mask, capped by a cgroup quota
+available_cores() {
+    local cores quota period
+    cores=$(nproc)
+    if [ -r /sys/fs/cgroup/cpu.max ]; then
+        read -r quota period < /sys/fs/cgroup/cpu.max
+        if [ "$quota" != "max" ]; then
+            quota=$(( (quota + period - 1) / period ))
+            [ "$quota" -lt "$cores" ] && cores=$quota
+        fi
+    fi
+    [ "$cores" -lt 1 ] && cores=1
+    echo "$cores"
+}
+
+# One worker process per core by default. ONNX Runtime threads are divided
+# between the workers so they do not oversubscribe the CPU. The in-memory job
+# store lives in a single process, so jobs polled on another worker would not
+# be found: several workers by default only with JOB_BACKEND=mongo.
+CORES=$(available_cores)
+if [ "${JOB_BACKEND:-memory}" = "mongo" ]; then
+    DEFAULT_WORKERS=$CORES
+else
+    DEFAULT_WORKERS=1
+fi
+export WEB_CONCURRENCY=${WEB_CONCURRENCY:-$DEFAULT_WORKERS}
+export ORT_INTRA_OP_THREADS=${ORT_INTRA_OP_THREADS:-$(( CORES / WEB_CONCURRENCY > 0 ? CORES / WEB_CONCURRENCY : 1 ))}
+echo "CPUs: $CORES, workers: $WEB_CONCURRENCY, ONNX Runtime threads per session: $ORT_INTRA_OP_THREADS"
+
+# Workers write their metrics here so /metrics can add them up; values of a
+# previous run must not be counted again
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
 
 # Start the FastAPI backend
 cd /backend || { echo "Backend directory not found"; exit 1; }
 
 echo "Starting FastAPI backend"
-# Use python -m uvicorn for reliability
-python3 -m uvicorn server:app --host 0.0.0.0 --port 8001 &
+# --preload imports the app once in the gunicorn master, which loads the
+# models before forking so every worker shares the same weights (with one
+# ONNX Runtime thread per session, see SHARE_MODEL_WEIGHTS). That only saves
+# memory with more than one worker, so not in the default single-worker
+# setup. Each worker opens its own MongoDB client at startup, after the fork.
+python3 -m gunicorn server:app \
+    --worker-class uvicorn.workers.UvicornWorker \
+    --workers "$WEB_CONCURRENCY" \
+    --bind 0.0.0.0:8001 \
+    --preload \
+    --timeout 300 \
+    --graceful-timeout 30 &
 BACKEND_PID=$!
 
+# Wait for the backend to come up, then for its models to be loaded and
+# warmed up, before nginx starts taking traffic
 echo "Waiting for backend to start..."
-sleep 10
-
-# Check if backend process is still running
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend process died during startup, exiting"
-    exit 1
-fi
+for i in {1..60}; do
+    if ! kill -0 $BACKEND_PID 2>/dev/null; then
+        echo "Backend process died during startup, exiting"
+        exit 1
+    fi
+    if curl -sf http://127.0.0.1:8001/api/live >/dev/null 2>&1; then
+        echo "Backend is live"
+        break
+    fi
+    if [ $i -eq 60 ]; then
+        echo "Backend failed to start after 60 attempts, exiting"
+        exit 1
+    fi
+    sleep 1
+done
 
-# Wait for backend to be ready by checking the health endpoint
-echo "Checking backend health..."
-for i in {1..30}; do
-    if curl -f http://127.0.0.1:8001/api/ >/dev/null 2>&1; then
+echo "Waiting for model warm-up..."
+for i in {1..60}; do
+    if ! kill -0 $BACKEND_PID 2>/dev/null; then
+        echo "Backend process died during warm-up, exiting"
+        exit 1
+    fi
+    if curl -sf http://127.0.0.1:8001/api/ready >/dev/null 2>&1; then
         echo "Backend is ready!"
         break
     fi
-    if [ $i -eq 30 ]; then
-        echo "Backend failed to become ready after 30 attempts, exiting"
+    if [ $i -eq 60 ]; then
+        echo "Backend failed to become ready after 60 attempts, exiting"
+        curl -s http://127.0.0.1:8001/api/ready || true
         exit 1
     fi
-    echo "Attempt $i/30: Backend not ready yet, waiting..."
+    echo "Attempt $i/60: Backend not ready yet, waiting..."
     sleep 2
 done
 
@@ -1,4 +1,4 @@
-import React, { useState, useCallback } from "react";
+import React, { useState, useCallback, useEffect } from "react";
 import "./App.css";
 import axios from "axios";
 
@@ -15,6 +15,19 @@ const BackgroundRemover = () => {
   const [dragActive, setDragActive] = useState(false);
   const [sliderPosition, setSliderPosition] = useState(50);
 
+  // Previews are object URLs; release them when they are replaced or unmounted
+  useEffect(() => {
+    return () => {
+      if (originalImage) URL.revokeObjectURL(originalImage);
+    };
+  }, [originalImage]);
+
+  useEffect(() => {
+    return () => {
+      if (processedImage) URL.revokeObjectURL(processedImage);
+    };
+  }, [processedImage]);
+
   const handleDrag = useCallback((e) => {
     e.preventDefault();
     e.stopPropagation();
@@ -63,23 +76,34 @@ const BackgroundRemover = () => {
       const formData = new FormData();
       formData.append('file', file);
 
-      const response = await axios.post(`${API}/remove-background-base64`, formData, {
+      // Only the result comes back; the original is previewed from the local file
+      const response = await axios.post(`${API}/remove-background-binary`, formData, {
         headers: {
           'Content-Type': 'multipart/form-data',
         },
+        responseType: 'blob',
       });
 
-      setOriginalImage(response.data.original_image);
-      setProcessedImage(response.data.processed_image);
+      setOriginalImage(URL.createObjectURL(file));
+      setProcessedImage(URL.createObjectURL(response.data));
       setProcessingStats({
-        processing_time: response.data.processing_time,
-        original_size: response.data.original_size,
-        processed_size: response.data.processed_size
+        processing_time: parseFloat(response.headers['x-processing-time']),
+        original_size: parseInt(response.headers['x-original-size'], 10),
+        processed_size: parseInt(response.headers['x-processed-size'], 10)
       });
 
     } catch (err) {
       console.error('Processing failed:', err);
-      setError(err.response?.data?.detail || 'Failed to process image');
+      // Error bodies arrive as a Blob because of responseType: 'blob'
+      let detail = null;
+      if (err.response?.data instanceof Blob) {
+        try {
+          detail = JSON.parse(await err.response.data.text()).detail;
+        } catch (parseError) {
+          detail = null;
+        }
+      }
+      setError(detail || 'Failed to process image');
     } finally {
       setLoading(false);
     }
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Script to measure the cost and quality of the edge refinement modes
+
+Builds scenes with a known alpha matte, either synthetic (a subject with
+hair-like strands of fractional alpha) or from RGBA cutouts in --images, and
+composites them over a textured background. The mask the model would give
+is simulated by scaling the true matte down to 320x320 and back up. Each
+mode then refines that mask against the composite: off, guided, matting,
+and for reference rembg's alpha_matting_cutout, which mattes the whole frame.
+Reports per mode the median time and the alpha error against the truth, over
+the whole image (SAD, in thousands, and MSE) and inside the unknown band.
+
+    python matting_benchmark.py --sizes 1024x768,2048x1536 --repeat 3 --json report.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# In the image this script sits next to the backend modules, in the
+# repository one level above them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+from matting import EDGE_REFINE_MODES, UNKNOWN, refine_edges, trimap
+from optimize_models import image_files
+
+# Side of the predicted mask, as produced by u2net
+PREDICTION_SIDE = 320
+
+# The whole-frame reference gets slow quickly; larger scenes skip it
+REFERENCE_MAX_PIXELS = 2_000_000
+
+
+def synthetic_matte(width, height, rng):
+    """A head-like blob with strands of hair, antialiased into fractional alpha"""
+    scale = 4
+    canvas = Image.new('L', (width * scale, height * scale), 0)
+    draw = ImageDraw.Draw(canvas)
+    cx, cy = width * scale // 2, height * scale * 11 // 20
+    rx, ry = width * scale // 5, height * scale // 3
+    draw.ellipse((cx - rx, cy - ry, cx + rx, cy + ry), fill=255)
+    for _ in range(400):
+        angle = rng.uniform(np.pi * 1.05, np.pi * 1.95)
+        x = cx + rx * 0.9 * np.cos(angle)
+        y = cy + ry * 0.9 * np.sin(angle)
+        points = [(x, y)]
+        for _ in range(12):
+            angle += rng.normal(0, 0.15)
+            x += np.cos(angle) * rx * 0.04
+            y += np.sin(angle) * ry * 0.04
+            points.append((x, y))
+        draw.line(points, fill=255, width=max(1, scale // 2))
+    return np.asarray(canvas.resize((width, height), Image.Resampling.BOX))
+
+
+def texture(width, height, rng, base):
+    noise = rng.integers(0, 256, (height // 8 + 1, width // 8 + 1, 3), dtype=np.uint8)
+    blurred = Image.fromarray(noise).resize((width, height), Image.Resampling.BICUBIC)
+    blurred = blurred.filter(ImageFilter.GaussianBlur(2))
+    return np.clip(np.asarray(blurred, dtype=np.float32) * 0.4 + np.float32(base), 0, 255)
+
+
+def build_scene(alpha, foreground, rng):
+    """Composite foreground over a textured background with the true alpha"""
+    height, width = alpha.shape
+    background = texture(width, height, rng, (30, 110, 160))
+    weight = alpha[..., np.newaxis] / np.float32(255)
+    image = foreground * weight + background * (1 - weight)
+    return np.clip(image + 0.5, 0, 255).astype(np.uint8)
+
+
+def scenes(sizes, images, rng):
+    if images:
+        for path in images:
+            cutout = Image.open(path).convert('RGBA')
+            pixels = np.asarray(cutout)
+            yield os.path.basename(path), pixels[..., 3], pixels[..., :3].astype(np.float32)
+        return
+    for width, height in sizes:
+        alpha = synthetic_matte(width, height, rng)
+        yield f"{width}x{height}", alpha, texture(width, height, rng, (120, 80, 40))
+
+
+def simulated_prediction(alpha):
+    small = Image.fromarray(alpha).resize((PREDICTION_SIDE, PREDICTION_SIDE), Image.Resampling.BILINEAR)
+    return np.array(small.resize((alpha.shape[1], alpha.shape[0]), Image.Resampling.BILINEAR))
+
+
+def reference_matting(image, mask):
+    """rembg's full-frame alpha matting, as the library itself runs it"""
+    from rembg.bg import alpha_matting_cutout
+    cutout = alpha_matting_cutout(Image.fromarray(image), Image.fromarray(mask), 240, 10, 10)
+    return np.asarray(cutout)[..., 3]
+
+
+def errors(alpha, truth, band):
+    difference = (alpha.astype(np.float32) - truth) / 255
+    return {
+        "sad": float(np.abs(difference).sum() / 1000),
+        "mse": float((difference ** 2).mean()),
+        "band_mae": float(np.abs(difference[band]).mean()) if band.any() else 0.0,
+    }
+
+
+def run_mode(mode, image, prediction, repeat):
+    times = []
+    for _ in range(repeat):
+        mask = prediction.copy()
+        start_time = time.perf_counter()
+        if mode == 'rembg':
+            mask = reference_matting(image, mask)
+        else:
+            refine_edges(mask, image, mode)
+        times.append(time.perf_counter() - start_time)
+    return mask, float(np.median(times))
+
+
+def benchmark(sizes, images, repeat, reference):
+    rng = np.random.default_rng(0)
+    report = {"repeat": repeat, "scenes": {}}
+    for name, truth, foreground in scenes(sizes, images, rng):
+        image = build_scene(truth, foreground, rng)
+        prediction = simulated_prediction(truth)
+        band = trimap(prediction) == UNKNOWN
+        modes = list(EDGE_REFINE_MODES)
+        if reference and truth.size <= REFERENCE_MAX_PIXELS:
+            modes.append('rembg')
+        truth = truth.astype(np.float32)
+        result = {"pixels": int(truth.size), "band_fraction": float(band.mean())}
+        for mode in modes:
+            mask, seconds = run_mode(mode, image, prediction, repeat)
+            result[mode] = {"time": seconds, **errors(mask, truth, band)}
+        report["scenes"][name] = result
+    return report
+
+
+def parse_sizes(value):
+    sizes = []
+    for item in value.split(','):
+        width, height = item.strip().lower().split('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1024x768,2048x1536',
+                        help='comma separated WIDTHxHEIGHT sizes of the synthetic scenes')
+    parser.add_argument('--images', help='directory of RGBA cutouts to use as ground truth instead')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scene and mode')
+    parser.add_argument('--no-reference', action='store_true',
+                        help="skip rembg's full-frame alpha matting")
+    parser.add_argument('--json', help='also write the full report to this file')
+    args = parser.parse_args()
+
+    images = image_files(args.images) if args.images else None
+    if args.images and not images:
+        parser.error(f"no images found in {args.images}")
+
+    # The first matting call compiles PyMatting's kernels; keep it out of the timings
+    warm = np.zeros((64, 64), dtype=np.uint8)
+    warm[16:48, 16:48] = 255
+    refine_edges(simulated_prediction(warm), np.zeros((64, 64, 3), dtype=np.uint8), 'matting')
+
+    report = benchmark(parse_sizes(args.sizes), images, args.repeat, not args.no_reference)
+
+    for name, result in report["scenes"].items():
+        band = result['band_fraction'] * 100
+        print(f"{name}: {result['pixels'] / 1e6:.1f} MP, band {band:.1f}% of the image")
+        for mode, stats in result.items():
+            if not isinstance(stats, dict):
+                continue
+            print(
+                f"  {mode:8s} {stats['time'] * 1000:9.1f} ms  SAD {stats['sad']:8.2f}  "
+                f"MSE {stats['mse'] * 1000:.3f}e-3  band MAE {stats['band_mae']:.4f}"
+            )
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
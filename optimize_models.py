@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Script to build quantized and graph-optimized rembg model variants during
+Docker build, after download_model.py has fetched the FP32 models
+
+For every configured model it writes into MODEL_VARIANTS_DIR:
+    <model>.int8.onnx         dynamic INT8 quantization of the weights
+    <model>.int8-static.onnx  static INT8 (QDQ), calibrated on --calibration-dir
+    <model>.ort               FP32 with graph optimizations applied, ORT format
+
+A variant is selected at runtime as "<model>:<variant>", e.g. ?model=u2net:int8
+or REMBG_DEFAULT_MODEL=u2net:int8, once it is listed in REMBG_ALLOWED_MODELS.
+Check what a variant costs in accuracy with validate_quantized.py.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+
+# In the image this script sits next to the backend modules, in the
+# repository one level above them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import numpy as np
+import onnxruntime as ort
+from onnxruntime.quantization import (
+    CalibrationDataReader, QuantFormat, QuantType, quantize_dynamic, quantize_static,
+)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+from rembg.sessions import sessions_class
+
+import config
+from download_model import configured_models
+from model_registry import MODEL_VARIANTS, variant_path
+from processing import MODEL_INPUT_SPECS, decode_image, model_input
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp', '.tif', '.tiff')
+
+
+def fp32_model_path(model_name):
+    """Path of the downloaded FP32 model, downloading it if needed"""
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None:
+        raise ValueError(f"No session class found for model '{model_name}'")
+    return str(session_class.download_models())
+
+
+def image_files(directory, limit=None):
+    paths = sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    return paths[:limit] if limit else paths
+
+
+def preprocessed(source):
+    """Shape-inferred and optimized copy of a model, as quantization expects.
+
+    ONNX shape inference is enough for the fixed-size rembg inputs, so the
+    symbolic pass (and its sympy dependency) is skipped. Returns the source
+    itself if pre-processing fails; quantization still works on those.
+    """
+    target = os.path.join(tempfile.mkdtemp(), os.path.basename(source))
+    try:
+        quant_pre_process(source, target, skip_symbolic_shape=True)
+        return target
+    except Exception as e:
+        print(f'  Pre-processing skipped: {e}')
+        return source
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    """Feeds model inputs built from local images to static quantization"""
+
+    def __init__(self, model_name, input_name, paths):
+        self.model_name = model_name
+        self.input_name = input_name
+        self.paths = iter(paths)
+
+    def get_next(self):
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                tensor = model_input(decode_image(f.read()), self.model_name)
+            return {self.input_name: tensor[np.newaxis]}
+        return None
+
+
+def quantize_dynamic_variant(source, target):
+    # ConvInteger on the CPU provider takes unsigned 8-bit weights
+    quantize_dynamic(preprocessed(source), target, weight_type=QuantType.QUInt8)
+
+
+def quantize_static_variant(model_name, source, target, calibration_paths):
+    input_name = ort.InferenceSession(source, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    reader = ImageCalibrationReader(model_name, input_name, calibration_paths)
+    quantize_static(
+        preprocessed(source),
+        target,
+        reader,
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+
+def ort_format_variant(source, target):
+    sess_opts = ort.SessionOptions()
+    # Extended rather than all: the layout transforms of the highest level
+    # are specific to the build machine's CPU features
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED
+    sess_opts.optimized_model_filepath = target
+    sess_opts.add_session_config_entry('session.save_model_format', 'ORT')
+    ort.InferenceSession(source, sess_opts, providers=['CPUExecutionProvider'])
+
+
+def optimize_model(model_name, variants, calibration_paths):
+    source = fp32_model_path(model_name)
+    failed = []
+    for variant in variants:
+        target = variant_path(model_name, variant)
+        print(f'Building {model_name}:{variant} -> {target}')
+        try:
+            if variant == 'int8':
+                quantize_dynamic_variant(source, target)
+            elif variant == 'int8-static':
+                if not calibration_paths:
+                    print('  Skipped: static quantization needs --calibration-dir images')
+                    continue
+                if model_name not in MODEL_INPUT_SPECS:
+                    print(f'  Skipped: no input spec for {model_name} to calibrate with')
+                    continue
+                quantize_static_variant(model_name, source, target, calibration_paths)
+            elif variant == 'ort':
+                ort_format_variant(source, target)
+            print(f'  {os.path.getsize(source) / 1e6:.1f} MB -> {os.path.getsize(target) / 1e6:.1f} MB')
+        except Exception as e:
+            print(f'  Failed: {e}')
+            failed.append(f'{model_name}:{variant}')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--models', default=','.join(configured_models()),
+                        help='comma separated rembg models (default: all configured models)')
+    parser.add_argument('--variants', default=os.environ.get('MODEL_VARIANTS', 'int8,ort'),
+                        help=f"comma separated variants to build, of: {', '.join(MODEL_VARIANTS)}")
+    parser.add_argument('--calibration-dir', default=os.environ.get('CALIBRATION_DIR'),
+                        help='images to calibrate static quantization with')
+    parser.add_argument('--calibration-size', type=int, default=64,
+                        help='most calibration images used')
+    args = parser.parse_args()
+
+    variants = [variant.strip() for variant in args.variants.split(',') if variant.strip()]
+    unknown = [variant for variant in variants if variant not in MODEL_VARIANTS]
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(unknown)}")
+
+    calibration_paths = []
+    if args.calibration_dir:
+        calibration_paths = image_files(args.calibration_dir, args.calibration_size)
+
+    os.makedirs(config.MODEL_VARIANTS_DIR, exist_ok=True)
+    failed = []
+    for model_name in args.models.split(','):
+        failed += optimize_model(model_name.strip(), variants, calibration_paths)
+    if failed:
+        print(f"Failed variants: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
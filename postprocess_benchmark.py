@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Script to compare the pooled post-processing path with the PIL one it replaced
+
+Times, per image size, the steps between the model and the encoder: scaling a
+320x320 prediction to the image, applying it as alpha, and compositing over a
+solid colour. The PIL path is LANCZOS resize plus Image.composite, allocating
+new images at every step; the pooled path is postprocess.resize_mask and
+apply_alpha writing into buffers borrowed from the shared pool. Reports the
+median time of each and the pool's hit count after the runs.
+
+    python postprocess_benchmark.py --sizes 1024x768,4000x3000 --repeat 7 --json report.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# In the image this script sits next to the backend modules, in the
+# repository one level above them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import numpy as np
+from PIL import Image
+
+from postprocess import apply_alpha, pool, resize_mask
+
+# Side of the predicted mask, as produced by u2net
+PREDICTION_SIDE = 320
+
+BACKGROUND_COLOR = (255, 255, 255)
+
+
+def median_time(function, repeat):
+    function()  # first run allocates the pooled buffers
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+def pil_cutout(rgb, pred, background=None):
+    image = Image.fromarray(rgb)
+    mask = Image.fromarray((pred.clip(0, 1) * 255).astype(np.uint8))
+    mask = mask.resize(image.size, Image.Resampling.LANCZOS)
+    if background is None:
+        return Image.composite(image.convert('RGBA'), Image.new('RGBA', image.size, 0), mask)
+    return Image.composite(image, Image.new('RGB', image.size, background), mask)
+
+
+def pooled_cutout(rgb, pred, background=None):
+    height, width = rgb.shape[:2]
+    channels = 4 if background is None else 3
+    with pool.borrow((height, width)) as mask, pool.borrow((height, width, channels)) as cutout:
+        resize_mask(pred, mask)
+        apply_alpha(rgb, mask, cutout, background)
+
+
+def benchmark(sizes, repeat):
+    rng = np.random.default_rng(0)
+    pred = rng.random((PREDICTION_SIDE, PREDICTION_SIDE), dtype=np.float32)
+    report = {"repeat": repeat, "sizes": {}}
+    for width, height in sizes:
+        rgb = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        result = {}
+        for name, background in (("transparent", None), ("colour", BACKGROUND_COLOR)):
+            pil_time = median_time(lambda: pil_cutout(rgb, pred, background), repeat)
+            pooled_time = median_time(lambda: pooled_cutout(rgb, pred, background), repeat)
+            result[name] = {
+                "pil_time": pil_time,
+                "pooled_time": pooled_time,
+                "speedup": pil_time / pooled_time if pooled_time else None,
+            }
+        report["sizes"][f"{width}x{height}"] = result
+    report["pool"] = pool.describe()
+    return report
+
+
+def parse_sizes(value):
+    sizes = []
+    for item in value.split(','):
+        width, height = item.strip().lower().split('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1024x768,2048x1536,4000x3000',
+                        help='comma separated WIDTHxHEIGHT image sizes')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per size and path')
+    parser.add_argument('--json', help='also write the full report to this file')
+    args = parser.parse_args()
+
+    report = benchmark(parse_sizes(args.sizes), args.repeat)
+
+    for size, result in report["sizes"].items():
+        for name, times in result.items():
+            print(
+                f"{size:>10s} {name:12s} PIL {times['pil_time'] * 1000:7.1f} ms  "
+                f"pooled {times['pooled_time'] * 1000:7.1f} ms  x{times['speedup']:.2f}"
+            )
+    pool_stats = report["pool"]
+    print(f"Pool: {pool_stats['hits']} hits, {pool_stats['misses']} misses, "
+          f"{pool_stats['retained_bytes'] / 1024 ** 2:.0f}MB retained")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Script to measure the accuracy of model variants against the FP32 model
+
+Runs a fixed image set through the FP32 model and through each variant
+built by optimize_models.py, thresholds both masks and reports the
+intersection over union per image, the mean and worst IoU, the mean absolute
+alpha difference and the inference time of each. Exits with status 1 when a
+variant's mean IoU is below --min-iou, so quantization can be adopted with a
+known accuracy loss.
+
+The set is a directory of images given with --images or, by default,
+synthetic scenes generated from a fixed seed: a subject with hair-like edges
+over a textured background, as in matting_benchmark.py. Those need nothing
+but the script, so the check also runs in a build or CI.
+
+    python validate_quantized.py --model u2net --variants int8,ort --min-iou 0.95
+    python validate_quantized.py --images ./validation-images --model u2net \
+        --variants int8,int8-static,ort --min-iou 0.95 --json report.json
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+# In the image this script sits next to the backend modules, in the
+# repository one level above them
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+
+import numpy as np
+from PIL import Image
+
+from matting_benchmark import build_scene, synthetic_matte, texture
+from model_registry import MODEL_VARIANTS
+from optimize_models import image_files
+from processing import decode_image, model_input, predict_batch
+
+# Mask value above which a pixel counts as foreground
+THRESHOLD = 0.5
+
+# Sizes the synthetic scenes cycle through, portrait and landscape
+SYNTHETIC_SIZES = [(640, 480), (480, 640), (800, 800), (1024, 576)]
+
+
+def mask_iou(reference: np.ndarray, candidate: np.ndarray) -> float:
+    ref = reference >= THRESHOLD
+    cand = candidate >= THRESHOLD
+    union = np.logical_or(ref, cand).sum()
+    if union == 0:
+        # Both masks are empty: they agree completely
+        return 1.0
+    return float(np.logical_and(ref, cand).sum() / union)
+
+
+def predict(model_name, inputs):
+    """Masks for inputs, one at a time, and the mean seconds per image"""
+    predict_batch(model_name, inputs[:1])  # load the session and warm up
+    masks = []
+    start_time = time.time()
+    for tensor in inputs:
+        masks.append(predict_batch(model_name, [tensor])[0])
+    return masks, (time.time() - start_time) / max(1, len(inputs))
+
+
+def synthetic_images(count, seed):
+    """(name, image) of count scenes, the same for the same seed"""
+    rng = np.random.default_rng(seed)
+    for index in range(count):
+        width, height = SYNTHETIC_SIZES[index % len(SYNTHETIC_SIZES)]
+        alpha = synthetic_matte(width, height, rng)
+        foreground = texture(width, height, rng, rng.integers(40, 220, 3))
+        yield f"synthetic-{index:02d}-{width}x{height}", Image.fromarray(build_scene(alpha, foreground, rng))
+
+
+def directory_images(paths):
+    for path in paths:
+        with open(path, 'rb') as f:
+            yield os.path.basename(path), decode_image(f.read())
+
+
+def validate(model_name, variants, images):
+    names = []
+    inputs = []
+    for name, img in images:
+        names.append(name)
+        inputs.append(model_input(img, model_name))
+    if any(tensor is None for tensor in inputs):
+        raise ValueError(f"No input spec for {model_name}, cannot validate it")
+
+    reference, reference_time = predict(model_name, inputs)
+    report = {
+        "model": model_name,
+        "images": len(names),
+        "threshold": THRESHOLD,
+        "fp32_inference_time": reference_time,
+        "variants": {},
+    }
+    for variant in variants:
+        masks, inference_time = predict(f"{model_name}:{variant}", inputs)
+        ious = [mask_iou(ref, mask) for ref, mask in zip(reference, masks)]
+        report["variants"][variant] = {
+            "mean_iou": float(np.mean(ious)),
+            "min_iou": float(np.min(ious)),
+            "worst_image": names[int(np.argmin(ious))],
+            "mean_abs_alpha_error": float(np.mean([
+                np.abs(ref - mask).mean() for ref, mask in zip(reference, masks)
+            ])),
+            "inference_time": inference_time,
+            "speedup": reference_time / inference_time if inference_time else None,
+            "per_image_iou": dict(zip(names, ious)),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', help='directory of validation images, instead of the synthetic set')
+    parser.add_argument('--synthetic-count', type=int, default=12,
+                        help='synthetic scenes to generate when no --images are given')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic scenes')
+    parser.add_argument('--model', default='u2net', help='rembg model the variants were built from')
+    parser.add_argument('--variants', default='int8,ort',
+                        help=f"comma separated variants to check, of: {', '.join(MODEL_VARIANTS)}")
+    parser.add_argument('--min-iou', type=float, default=0.95,
+                        help='lowest acceptable mean IoU against FP32')
+    parser.add_argument('--json', help='also write the full report to this file')
+    args = parser.parse_args()
+
+    if args.images:
+        paths = image_files(args.images)
+        if not paths:
+            parser.error(f"no images found in {args.images}")
+        images = directory_images(paths)
+    else:
+        if args.synthetic_count < 1:
+            parser.error("--synthetic-count must be at least 1")
+        images = synthetic_images(args.synthetic_count, args.seed)
+    variants = [variant.strip() for variant in args.variants.split(',') if variant.strip()]
+
+    report = validate(args.model, variants, images)
+
+    print(f"{args.model}: {report['images']} images, FP32 {report['fp32_inference_time'] * 1000:.1f} ms/image")
+    failed = []
+    for variant, result in report["variants"].items():
+        print(
+            f"  {variant:12s} mean IoU {result['mean_iou']:.4f}  min {result['min_iou']:.4f} "
+            f"({result['worst_image']})  alpha error {result['mean_abs_alpha_error']:.4f}  "
+            f"{result['inference_time'] * 1000:.1f} ms/image"
+        )
+        if result['mean_iou'] < args.min_iou:
+            failed.append(variant)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if failed:
+        print(f"Below minimum IoU {args.min_iou}: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()